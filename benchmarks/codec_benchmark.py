@@ -0,0 +1,45 @@
+"""Compare encode/decode latency and payload size of each registered
+codec across some realistic argument shapes. Run from the repository
+root with:
+
+    python benchmarks/codec_benchmark.py [iterations]
+
+Shapes which a codec cannot encode are reported as unsupported, since
+calls with those arguments would fall back to the pickle codec."""
+
+import sys
+import timeit
+from datetime import datetime
+from uuid import uuid1
+
+from deferrable.codec import registered_codec_ids, get_codec
+
+SHAPES = [
+    ('single id', ((str(uuid1()),), [])),
+    ('ids and flags', (('team', str(uuid1()), 42), [('force', True), ('notify', False)])),
+    ('id list', ((range(1000),), [])),
+    ('rendered template', ((u'<p>Hello \xc9vry</p>' * 200,), [('subject', u'Your weekly stats')])),
+    ('nested dict', (({'user': {'id': 1, 'name': 'abc', 'tags': ['a', 'b'] * 20}},), [])),
+    ('datetime', ((datetime.now(),), [])),
+]
+
+def benchmark_codec(codec, value, iterations):
+    encoded = codec.encode(value)
+    encode_time = timeit.timeit(lambda: codec.encode(value), number=iterations)
+    decode_time = timeit.timeit(lambda: codec.decode(encoded), number=iterations)
+    return len(encoded), encode_time / iterations * 1e6, decode_time / iterations * 1e6
+
+def main(iterations):
+    print '{:<20} {:<10} {:>10} {:>12} {:>12}'.format('shape', 'codec', 'bytes', 'encode (us)', 'decode (us)')
+    for shape_name, value in SHAPES:
+        for codec_id in registered_codec_ids():
+            codec = get_codec(codec_id)
+            try:
+                size, encode_us, decode_us = benchmark_codec(codec, value, iterations)
+            except (TypeError, ValueError):
+                print '{:<20} {:<10} {:>10}'.format(shape_name, codec_id, 'unsupported')
+                continue
+            print '{:<20} {:<10} {:>10} {:>12.2f} {:>12.2f}'.format(shape_name, codec_id, size, encode_us, decode_us)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -1,3 +1,5 @@
 from .dockets import DocketsBackendFactory
 from .memory import InMemoryBackendFactory
 from .sqs import SQSBackendFactory
+from .sqlite import SQLiteBackendFactory
+from .segmented_log import SegmentedLogBackendFactory
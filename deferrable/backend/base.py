@@ -21,3 +21,7 @@ class Backend(object):
         self.group = group
         self.queue = queue
         self.error_queue = error_queue
+
+    def reset_connections(self):
+        self.queue.reset_connections()
+        self.error_queue.reset_connections()
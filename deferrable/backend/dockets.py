@@ -4,18 +4,29 @@ import dockets.queue
 
 from .base import BackendFactory, Backend
 from ..queue.dockets import DocketsQueue
+from ..pickling import DEFAULT_COMPRESSION_THRESHOLD
 
 class DocketsBackendFactory(BackendFactory):
-    def __init__(self, redis_client, wait_time=3, timeout=300):
+    def __init__(self, redis_client, wait_time=3, timeout=300,
+                 compression=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, use_envelopes=False):
+        """Jobs are written in the format older versions of Deferrable read unless
+        `use_envelopes` is set, which is required for `compression`. Only set it
+        once every consumer is running a version which reads envelopes."""
         self.redis_client = redis_client
         self.wait_time = wait_time
         self.timeout = timeout
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.use_envelopes = use_envelopes
 
     def _create_backend_for_group(self, group):
         queue = DocketsQueue(self.redis_client,
                              self._queue_name(group),
                              self.wait_time,
-                             self.timeout)
+                             self.timeout,
+                             compression=self.compression,
+                             compression_threshold=self.compression_threshold,
+                             use_envelopes=self.use_envelopes)
         error_queue = queue.make_error_queue()
         return DocketsBackend(group, queue, error_queue)
 
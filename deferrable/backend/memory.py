@@ -2,13 +2,14 @@ from .base import BackendFactory, Backend
 from ..queue.memory import InMemoryQueue
 
 class InMemoryBackendFactory(BackendFactory):
-    def __init__(self, timeout=None):
+    def __init__(self, timeout=None, visibility_timeout=30):
         self.timeout = timeout
+        self.visibility_timeout = visibility_timeout
 
     def _create_backend_for_group(self, group):
         queue_name = self._queue_name(group)
-        queue = InMemoryQueue(queue_name, self.timeout)
-        error_queue = InMemoryQueue(queue_name, self.timeout)
+        queue = InMemoryQueue(queue_name, self.timeout, self.visibility_timeout)
+        error_queue = InMemoryQueue(queue_name, self.timeout, self.visibility_timeout)
         return InMemoryBackend(group, queue, error_queue)
 
 class InMemoryBackend(Backend):
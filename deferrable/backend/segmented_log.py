@@ -0,0 +1,49 @@
+import os
+
+from .base import BackendFactory, Backend
+from ..queue.segmented_log import SegmentedLogQueue, DEFAULT_SEGMENT_SIZE
+from ..pickling import DEFAULT_COMPRESSION_THRESHOLD
+
+class SegmentedLogBackendFactory(BackendFactory):
+    def __init__(self, directory, timeout=None, visibility_timeout=30, poll_interval=0.05,
+                 segment_size=DEFAULT_SEGMENT_SIZE, fsync=False,
+                 compression=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        """All backends created by this factory store each of their queues as a
+        log in its own subdirectory of `directory`. Any number of processes on
+        the same host may push to a queue, but only one may pop from it.
+
+        - timeout: Seconds for which pop blocks waiting for an item.
+        - visibility_timeout: Seconds after which an in-flight item is redelivered
+                              if it has not been completed or touched.
+        - poll_interval: Seconds between checks for items appended by other
+                         processes during a blocking pop.
+        - segment_size: Bytes after which appends roll over to a new segment.
+                        Segments are only deleted once they have been rolled over.
+        - fsync: Whether to fsync every append.
+        """
+        self.directory = directory
+        self.timeout = timeout
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
+    def _create_queue(self, queue_name):
+        return SegmentedLogQueue(os.path.join(self.directory, queue_name), self.timeout,
+                                 visibility_timeout=self.visibility_timeout,
+                                 poll_interval=self.poll_interval,
+                                 segment_size=self.segment_size,
+                                 fsync=self.fsync,
+                                 compression=self.compression,
+                                 compression_threshold=self.compression_threshold)
+
+    def _create_backend_for_group(self, group):
+        queue_name = self._queue_name(group)
+        queue = self._create_queue(queue_name)
+        error_queue = self._create_queue('{}_error'.format(queue_name))
+        return SegmentedLogBackend(group, queue, error_queue)
+
+class SegmentedLogBackend(Backend):
+    pass
@@ -0,0 +1,38 @@
+from .base import BackendFactory, Backend
+from ..queue.sqlite import SQLiteQueue
+from ..pickling import DEFAULT_COMPRESSION_THRESHOLD
+
+class SQLiteBackendFactory(BackendFactory):
+    def __init__(self, path, timeout=None, visibility_timeout=30, poll_interval=0.1,
+                 compression=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        """All backends created by this factory store their queues in the SQLite
+        database at `path`, which is created if it does not exist. Any number of
+        processes on the same host may share the database.
+
+        - timeout: Seconds for which pop blocks waiting for an item.
+        - visibility_timeout: Seconds after which an in-flight item is redelivered
+                              if it has not been completed or touched.
+        - poll_interval: Seconds between checks for new items during a blocking pop.
+        """
+        self.path = path
+        self.timeout = timeout
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
+    def _create_queue(self, queue_name):
+        return SQLiteQueue(self.path, queue_name, self.timeout,
+                           visibility_timeout=self.visibility_timeout,
+                           poll_interval=self.poll_interval,
+                           compression=self.compression,
+                           compression_threshold=self.compression_threshold)
+
+    def _create_backend_for_group(self, group):
+        queue_name = self._queue_name(group)
+        queue = self._create_queue(queue_name)
+        error_queue = self._create_queue('{}_error'.format(queue_name))
+        return SQLiteBackend(group, queue, error_queue)
+
+class SQLiteBackend(Backend):
+    pass
@@ -1,8 +1,11 @@
 from .base import BackendFactory, Backend
 from ..queue.sqs import SQSQueue
+from ..pickling import DEFAULT_COMPRESSION_THRESHOLD
 
 class SQSBackendFactory(BackendFactory):
-    def __init__(self, sqs_connection_thunk, visibility_timeout=30, wait_time=20, name_suffix=None):
+    def __init__(self, sqs_connection_thunk, visibility_timeout=30, wait_time=20, name_suffix=None,
+                 compression=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, use_envelopes=False,
+                 push_concurrency=4, push_retries=3, prefetch=0, prefetch_threads=1):
         """To allow backends to be initialized lazily, this factory requires a thunk
         (parameter-less closure) which returns an initialized SQS connection. This thunk
         is called as late as possible to initialize the connection and perform operations
@@ -18,6 +21,26 @@ class SQSBackendFactory(BackendFactory):
         # will just pass your environment here.
         self.name_suffix = name_suffix
 
+        # Compress serialized items larger than compression_threshold bytes using
+        # one of the compressions in `pickling.COMPRESSIONS`, e.g. 'zlib'.
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
+        # Jobs are written in the format older versions of Deferrable read unless
+        # `use_envelopes` is set, which is required for `compression`. Only set it
+        # once every consumer is running a version which reads envelopes.
+        self.use_envelopes = use_envelopes
+
+        # Batch pushes larger than SQS allows in one request are split up and sent
+        # from `push_concurrency` threads, retrying failed messages `push_retries` times.
+        self.push_concurrency = push_concurrency
+        self.push_retries = push_retries
+
+        # Main queues can receive up to `prefetch` messages ahead of time from
+        # `prefetch_threads` threads, so that pops rarely wait on SQS.
+        self.prefetch = prefetch
+        self.prefetch_threads = prefetch_threads
+
     def _create_backend_for_group(self, group):
         formatted_name = group
         if self.name_suffix:
@@ -25,12 +48,24 @@ class SQSBackendFactory(BackendFactory):
         error_queue = SQSQueue(self.sqs_connection_thunk,
                                self._queue_name('{}_error'.format(formatted_name)),
                                self.visibility_timeout,
-                               self.wait_time)
+                               self.wait_time,
+                               compression=self.compression,
+                               compression_threshold=self.compression_threshold,
+                               use_envelopes=self.use_envelopes,
+                               push_concurrency=self.push_concurrency,
+                               push_retries=self.push_retries)
         queue = SQSQueue(self.sqs_connection_thunk,
                          self._queue_name(formatted_name),
                          self.visibility_timeout,
                          self.wait_time,
-                         redrive_queue=error_queue)
+                         redrive_queue=error_queue,
+                         compression=self.compression,
+                         compression_threshold=self.compression_threshold,
+                         use_envelopes=self.use_envelopes,
+                         push_concurrency=self.push_concurrency,
+                         push_retries=self.push_retries,
+                         prefetch=self.prefetch,
+                         prefetch_threads=self.prefetch_threads)
         return SQSBackend(group, queue, error_queue)
 
 class SQSBackend(Backend):
@@ -0,0 +1,74 @@
+"""Small thread-safe caches used to avoid repeating work on hot paths."""
+
+import time
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Bounded mapping which evicts the least recently used key once it
+    holds `maxsize` keys. A `maxsize` of 0 disables caching."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_or_load(self, key, loader):
+        """Returns a tuple of (value, hit). On a miss, the value is produced by
+        calling `loader()`, outside of the cache's lock, and then cached."""
+        with self._lock:
+            if key in self._data:
+                value = self._data.pop(key)
+                self._data[key] = value
+                self.hits += 1
+                return value, True
+            self.misses += 1
+        value = loader()
+        if self.maxsize:
+            with self._lock:
+                self._data[key] = value
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return value, False
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class TTLCache(object):
+    """Bounded mapping whose entries expire `ttl` seconds after they are set.
+    Once it holds `maxsize` keys, the least recently used key is evicted."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                return default
+            self._data[key] = entry
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        if not self.maxsize or ttl <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
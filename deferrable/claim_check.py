@@ -0,0 +1,132 @@
+"""Claim checks keep queue operations small for deferred calls with very
+large arguments. When the encoded args and kwargs of an item exceed a
+threshold, they are moved to a `BlobStore` and the item carries only a
+reference to them under `CLAIM_CHECK_KEY`. The consumer fetches the
+arguments from the store only when it is about to execute the item, and
+the blob is deleted once the item's envelope has been completed.
+
+Blobs for items which are sent to the error queue are kept, so that the
+item can still be executed if it is redriven. Stores which support it
+should be given an expiry to clean these up eventually."""
+
+import os
+import errno
+from uuid import uuid1
+
+from .pickling import encode_item, decode_item
+
+CLAIM_CHECK_KEY = 'claim_check'
+CLAIM_CHECK_FIELDS = ('args', 'kwargs')
+
+DEFAULT_CLAIM_CHECK_THRESHOLD = 64 * 1024
+
+class BlobStore(object):
+    """Abstract class for storing claim-checked payloads. Your
+    subclass should override all private methods."""
+
+    def _put(self, key, data):
+        raise NotImplementedError()
+
+    def _get(self, key):
+        """Should raise KeyError if the key does not exist."""
+        raise NotImplementedError()
+
+    def _delete(self, key):
+        """Should not raise if the key does not exist."""
+        raise NotImplementedError()
+
+    def put(self, key, data):
+        return self._put(key, data)
+
+    def get(self, key):
+        return self._get(key)
+
+    def delete(self, key):
+        return self._delete(key)
+
+class FileSystemBlobStore(BlobStore):
+    """Stores each blob as a file in `directory`. Only useful if every
+    producer and consumer shares the directory, e.g. on a single host or
+    a network filesystem."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _put(self, key, data):
+        # Write then rename so that readers never see a partial blob
+        temporary_path = self._path('.{}.tmp'.format(key))
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+        os.rename(temporary_path, self._path(key))
+
+    def _get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(key)
+            raise
+
+    def _delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+class RedisBlobStore(BlobStore):
+    def __init__(self, redis_client, prefix='deferrable.claim_check', expire_seconds=None):
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.expire_seconds = expire_seconds
+
+    def _key(self, key):
+        return '{}.{}'.format(self.prefix, key)
+
+    def _put(self, key, data):
+        self.redis_client.set(self._key(key), data, ex=self.expire_seconds)
+
+    def _get(self, key):
+        data = self.redis_client.get(self._key(key))
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    def _delete(self, key):
+        self.redis_client.delete(self._key(key))
+
+def check_in_item(store, item, threshold):
+    """Move the item's arguments to the store if they are larger than `threshold`
+    bytes. Modifies the item in place. Returns True if the item was checked in."""
+    if CLAIM_CHECK_KEY in item:
+        return False
+    if sum(len(item[field]) for field in CLAIM_CHECK_FIELDS) <= threshold:
+        return False
+    key = str(uuid1())
+    store.put(key, encode_item({field: item[field] for field in CLAIM_CHECK_FIELDS}))
+    for field in CLAIM_CHECK_FIELDS:
+        del item[field]
+    item[CLAIM_CHECK_KEY] = key
+    return True
+
+def check_out_item(store, item):
+    """Return a copy of the item with its arguments restored from the store. The
+    item itself keeps its reference, so it can be safely pushed again for a retry."""
+    if CLAIM_CHECK_KEY not in item:
+        return item
+    checked_out = dict(item)
+    checked_out.update(decode_item(store.get(item[CLAIM_CHECK_KEY])))
+    return checked_out
+
+def release_item(store, item):
+    if CLAIM_CHECK_KEY in item:
+        store.delete(item[CLAIM_CHECK_KEY])
@@ -0,0 +1,106 @@
+"""Codecs control how the args and kwargs of a deferred call are
+serialized. The codec used is selected per Deferrable instance or per
+`@deferrable` function by its CODEC_ID, and is stored in the queued
+item so that the consumer can decode it.
+
+The following codecs are registered by default:
+
+- pickle  : Highest pickle protocol. Handles any picklable argument.
+- marshal : Fast path for primitive arguments (None, bool, int, long,
+            float, str, unicode, and tuples, lists and dicts of these).
+            Round-trips types exactly, but only between consumers running
+            the same Python version.
+- json    : JSON-compatible primitive arguments. Tuples are decoded as
+            lists and byte strings as unicode. Dicts with keys which are
+            not strings are not JSON-compatible.
+
+If a codec cannot encode the arguments of a particular call (e.g. a
+datetime passed to a function using the json codec), the call falls
+back to the pickle codec. Additional codecs can be registered with
+`register_codec`."""
+
+import json
+import marshal
+import cPickle as pickle
+
+# Binary pickles (protocol 2 and up) always start with the PROTO opcode,
+# which can never appear at the start of a string_escape'd protocol 0 pickle
+PROTO_OPCODE = '\x80'
+
+class Codec(object):
+    """Abstract class for argument codecs. Your subclass should set
+    a unique CODEC_ID and implement `encode` and `decode`. `encode`
+    should raise TypeError or ValueError for objects it cannot encode."""
+    CODEC_ID = None
+
+    def encode(self, obj):
+        raise NotImplementedError()
+
+    def decode(self, string):
+        raise NotImplementedError()
+
+class PickleCodec(Codec):
+    CODEC_ID = 'pickle'
+
+    def encode(self, obj):
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, string):
+        # Legacy fields may arrive as unicode after passing through JSON
+        if isinstance(string, bytes) and string.startswith(PROTO_OPCODE):
+            return pickle.loads(string)
+        return pickle.loads(string.decode('string_escape'))
+
+class MarshalCodec(Codec):
+    CODEC_ID = 'marshal'
+
+    def encode(self, obj):
+        return marshal.dumps(obj)
+
+    def decode(self, string):
+        return marshal.loads(string)
+
+def _check_json_keys(obj):
+    """json silently converts non-string dict keys to strings, which would
+    change the arguments, so refuse them instead."""
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            if not isinstance(key, basestring):
+                raise TypeError('Dict key {!r} is not a string'.format(key))
+            _check_json_keys(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            _check_json_keys(value)
+
+class JSONCodec(Codec):
+    CODEC_ID = 'json'
+
+    def encode(self, obj):
+        _check_json_keys(obj)
+        return json.dumps(obj, separators=(',', ':'))
+
+    def decode(self, string):
+        return json.loads(string)
+
+DEFAULT_CODEC_ID = PickleCodec.CODEC_ID
+
+_codecs = {}
+
+def register_codec(codec):
+    if codec.CODEC_ID is None:
+        raise ValueError('CODEC_ID must be provided')
+    if codec.CODEC_ID in _codecs:
+        raise ValueError('CODEC_ID {} is already in use'.format(codec.CODEC_ID))
+    _codecs[codec.CODEC_ID] = codec
+
+def registered_codec_ids():
+    return sorted(_codecs)
+
+def get_codec(codec_id):
+    try:
+        return _codecs[codec_id]
+    except KeyError:
+        raise ValueError('No codec registered with CODEC_ID {}'.format(codec_id))
+
+for _codec in [PickleCodec(), MarshalCodec(), JSONCodec()]:
+    register_codec(_codec)
@@ -16,17 +16,66 @@ still holds."""
 
 import math
 import time
+import hashlib
+
+from .pickling import dumps, method_name
 
 class DebounceStrategy(object):
     PUSH_NOW = 1
     PUSH_DELAYED = 2
     SKIP = 3
 
+def _method_key(item):
+    return item['method_id'] if 'method_id' in item else item['method']
+
+def _digest(item):
+    """Stable digest of the item's method and encoded arguments. Each part is
+    length-prefixed so that different splits of the same bytes cannot collide."""
+    digest = hashlib.sha1()
+    for part in (_method_key(item), item['args'], item['kwargs']):
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        digest.update('{}:'.format(len(part)))
+        digest.update(part)
+    return digest.hexdigest()
+
+DEBOUNCE_KEY = "debounce.{}.{}"
+LAST_PUSH_KEY = "last_push.{}.{}"
+
 def _debounce_key(item):
-    return u"debounce.{}.{}.{}".format(item['method'], item['args'], item['kwargs'])
+    return debounce_keys(item)[1]
 
 def _last_push_key(item):
-    return u"last_push.{}.{}.{}".format(item['method'], item['args'], item['kwargs'])
+    return debounce_keys(item)[0]
+
+# Keys written by older versions embedded the protocol 0, string_escape'd pickles
+# of the method, the args tuple and the sorted kwargs items. These are still read
+# during the migration window (see `apply_debounce`).
+LEGACY_KEY_SUFFIX = u"{}.{}.{}"
+
+def legacy_key_suffix(pickled_method, args, kwargs):
+    """The part of an older version's debounce keys which follows the prefix.
+    `pickled_method` is `dumps(method, legacy=True)`, which callers making many
+    calls to the same method can compute once."""
+    return LEGACY_KEY_SUFFIX.format(pickled_method, dumps(args, legacy=True),
+                                    dumps(sorted(kwargs.items()), legacy=True))
+
+def _legacy_debounce_key(suffix):
+    return u"debounce." + suffix
+
+def _legacy_last_push_key(suffix):
+    return u"last_push." + suffix
+
+def debounce_keys(item, name=None, legacy_suffix=None):
+    """Returns the last push and debounce keys for the item, followed by the
+    legacy versions of each if a `legacy_suffix` from `legacy_key_suffix` is
+    given. `name` is the method's ID; if it is not given it is taken from the
+    item, which decodes the method unless the item carries a method ID."""
+    name, digest = name or method_name(item), _digest(item)
+    keys = [LAST_PUSH_KEY.format(name, digest), DEBOUNCE_KEY.format(name, digest)]
+    if legacy_suffix is not None:
+        keys.extend([_legacy_last_push_key(legacy_suffix), _legacy_debounce_key(legacy_suffix)])
+    return keys
 
 def set_debounce_keys_for_push_now(redis_client, item, debounce_seconds):
     """Set a key in Redis indicating the last time this item was potentially
@@ -36,13 +85,76 @@ def set_debounce_keys_for_push_now(redis_client, item, debounce_seconds):
     redis_client.set(_last_push_key(item), time.time(), px=int(2*debounce_seconds*1000))
 
 def set_debounce_keys_for_push_delayed(redis_client, item, seconds_to_delay, debounce_seconds):
-    redis_client.scripts.set_debounce_keys(keys=[_last_push_key(item),
-                                                 _debounce_key(item)],
+    redis_client.scripts.set_debounce_keys(keys=debounce_keys(item),
                                            args=[time.time(), seconds_to_delay, debounce_seconds])
 
+def apply_debounce(redis_client, item, debounce_seconds, debounce_always_delay, keys=None, local_cache=None):
+    """Decide the debounce strategy for the item and set its debounce keys
+    accordingly, atomically and in a single round-trip. Returns the same
+    (strategy, seconds_to_delay) tuple as `get_debounce_strategy`. Unlike
+    calling `get_debounce_strategy` followed by the matching `set_debounce_keys_*`
+    function, concurrent producers cannot both decide to PUSH_NOW.
+
+    `keys` may be given as returned by `debounce_keys`, otherwise they are built
+    from the item. If they include the legacy keys, keys written by older
+    producers are also taken into account, so that debounce windows opened
+    before an upgrade are still honoured. Only the new keys are ever written. Legacy keys expire
+    within twice the debounce window, after which they can be left out.
+
+    If a `local_cache` (a `cache.TTLCache`) is given, SKIPs are remembered in it
+    for as long as Redis guarantees them, and repeat pushes inside that time
+    return SKIP without a round-trip. Only SKIPs are cached: any other decision
+    changes the keys in Redis, so the next push must consult it again."""
+    keys = keys or debounce_keys(item)
+    if local_cache is not None and local_cache.get(keys[1]):
+        return DebounceStrategy.SKIP, 0
+
+    now = time.time()
+    response = redis_client.scripts.debounce(keys=keys, args=_debounce_args(now, debounce_seconds, debounce_always_delay))
+    return _parse_debounce_response(response, keys[1], local_cache, now)
+
+def apply_debounce_batch(redis_client, requests, local_cache=None):
+    """Batched equivalent of `apply_debounce`. Takes a list of (keys, debounce_seconds,
+    debounce_always_delay) tuples, with the keys as returned by `debounce_keys`, and evaluates all of them in a single pipelined
+    round-trip. Items are evaluated in order, so duplicates within a batch are
+    debounced against each other.
+
+    Returns a list with a (strategy, seconds_to_delay) tuple for each request, in
+    order, or the exception raised while evaluating that request."""
+    results = [None] * len(requests)
+    pending = []
+    pipeline = redis_client.pipeline(transaction=False)
+    now = time.time()
+    for index, (keys, debounce_seconds, debounce_always_delay) in enumerate(requests):
+        if local_cache is not None and local_cache.get(keys[1]):
+            results[index] = (DebounceStrategy.SKIP, 0)
+            continue
+        redis_client.scripts.debounce(keys=keys, args=_debounce_args(now, debounce_seconds, debounce_always_delay),
+                                      client=pipeline)
+        pending.append((index, keys[1]))
+
+    if pending:
+        for (index, cache_key), response in zip(pending, pipeline.execute(raise_on_error=False)):
+            if isinstance(response, Exception):
+                results[index] = response
+            else:
+                results[index] = _parse_debounce_response(response, cache_key, local_cache, now)
+    return results
+
+def _debounce_args(now, debounce_seconds, debounce_always_delay):
+    return [now, debounce_seconds, 1 if debounce_always_delay else 0]
+
+def _parse_debounce_response(response, cache_key, local_cache, now):
+    strategy, seconds_to_delay, seconds_to_skip = response
+    if local_cache is not None:
+        # Count the skip from when we asked, so it never outlives the key in Redis
+        local_cache.set(cache_key, True, float(seconds_to_skip) - (time.time() - now))
+    seconds_to_delay = float(seconds_to_delay)
+    # Brokers such as SQS only accept whole seconds of delay
+    return int(strategy), int(seconds_to_delay) if seconds_to_delay.is_integer() else seconds_to_delay
+
 def get_debounce_strategy(redis_client, item, debounce_seconds, debounce_always_delay):
-    last_push_time, debounce_value = redis_client.scripts.get_debounce_keys(keys=[_last_push_key(item),
-                                                                                  _debounce_key(item)])
+    last_push_time, debounce_value = redis_client.scripts.get_debounce_keys(keys=debounce_keys(item))
 
     if debounce_value:
         return DebounceStrategy.SKIP, 0
@@ -4,14 +4,30 @@ import logging
 from uuid import uuid1
 import socket
 from traceback import format_exc
-
-from .pickling import loads, dumps, build_later_item, unpickle_method_call, pretty_unpickle
-from .debounce import (get_debounce_strategy, set_debounce_keys_for_push_now,
-                       set_debounce_keys_for_push_delayed, DebounceStrategy)
+from multiprocessing.pool import ThreadPool
+
+from .pickling import (loads, dumps, build_later_item_with_codec, serialize_method,
+                       unpickle_method, unpickle_args, pretty_unpickle, method_name)
+from .cache import LRUCache, TTLCache
+from .item import LazyItem
+from .codec import get_codec, PickleCodec, DEFAULT_CODEC_ID
+from .registry import register_method, method_id
+from .debounce import (apply_debounce, apply_debounce_batch, debounce_keys, legacy_key_suffix,
+                       LEGACY_KEY_SUFFIX, DebounceStrategy)
 from .ttl import add_ttl_metadata_to_item, item_is_expired
 from .backoff import apply_exponential_backoff_options, apply_exponential_backoff_delay
 from .redis import initialize_redis_client
 from .delay import MAXIMUM_DELAY_SECONDS
+from .claim_check import check_in_item, check_out_item, release_item, DEFAULT_CLAIM_CHECK_THRESHOLD
+
+def _chunks(items, size):
+    for index in xrange(0, len(items), size):
+        yield items[index:index + size]
+
+class ExecutionOutcome(object):
+    DONE = 0
+    RETRY = 1
+    ERROR = 2
 
 class Deferrable(object):
     """
@@ -25,6 +41,38 @@ class Deferrable(object):
     - instance.run_once(): Method to pop one deferred function off the backend queue and
                            execute it, subject to execution properties on the deferrable
                            instance and the specific deferred task itself (e.g. TTL)
+    - instance.run_batch(n): Batched equivalent of run_once, using the queue's batch
+                             pop, push and complete operations
+
+    Non-blocking variants of `later`, `run_once` and `process` are available with an
+    `_async` suffix. These run on a thread pool owned by the instance and return a
+    `multiprocessing.pool.AsyncResult`.
+
+    If `use_method_ids` is True, queued items refer to their method by its ID in the
+    method registry rather than by a pickle of it. Only enable this once every
+    consumer is running a version which understands these items.
+
+    Pickled fields are written in the format older consumers read unless the
+    backend's queue has `use_envelopes` set (see the SQS and Dockets backend
+    factories), in which case they are written as binary pickles.
+
+    Debounce keys are derived from a digest of the item's method and arguments.
+    While `legacy_debounce_keys` is True, keys in the format written by older
+    versions are also honoured, at the cost of reading two more keys on every
+    debounced push. This can be turned off once every producer has been
+    upgraded for longer than twice the longest debounce window.
+
+    If `debounce_cache_size` is set, producers remember up to that many debounced
+    items which Redis has told them to skip, and skip repeat pushes of them
+    without a Redis round-trip until their debounce window ends.
+
+    If a `claim_check_store` is provided, the arguments of any item whose encoded
+    args and kwargs exceed `claim_check_threshold` bytes are moved to the store
+    and only a reference is queued. See the `claim_check` module.
+
+    If an `error_index` is provided, every item pushed to the error queue is
+    also recorded in it, so that errors can be broken down by method and error
+    type without reading the error queue. See the `error_index` module.
 
     The following events are emitted by Deferrable and may be consumed by
     registering event handlers with the appropriate `on_{event}` methods,
@@ -42,13 +90,29 @@ class Deferrable(object):
     - on_debounce_hit   : item was not queued subject to debounce constraints
     - on_debounce_miss  : item is configured for debounce but was queued
     - on_debounce_error : exception encountered while processing debounce logic (item will still be queued)
+    - on_unpickle_cache_hit  : item's method or error classes were found in the consumer's unpickle cache
+    - on_unpickle_cache_miss : item's method or error classes had to be unpickled
     """
 
-    def __init__(self, backend, redis_client=None, default_error_classes=None, default_max_attempts=5):
+    def __init__(self, backend, redis_client=None, default_error_classes=None, default_max_attempts=5,
+                 executor_size=10, default_codec=DEFAULT_CODEC_ID,
+                 claim_check_store=None, claim_check_threshold=DEFAULT_CLAIM_CHECK_THRESHOLD,
+                 use_method_ids=False, unpickle_cache_size=256, legacy_debounce_keys=True,
+                 debounce_cache_size=0, error_index=None):
         self.backend = backend
         self._redis_client = redis_client
         self.default_error_classes = default_error_classes
         self.default_max_attempts = default_max_attempts
+        self.default_codec = get_codec(default_codec).CODEC_ID
+        self.executor_size = executor_size
+        self.claim_check_store = claim_check_store
+        self.claim_check_threshold = claim_check_threshold
+        self.error_index = error_index
+        self.use_method_ids = use_method_ids
+        self.legacy_debounce_keys = legacy_debounce_keys
+        self.debounce_cache = TTLCache(debounce_cache_size) if debounce_cache_size else None
+        # Consumers see the same handful of methods and error classes over and over
+        self.unpickle_cache = LRUCache(unpickle_cache_size)
 
         self._metadata_producer_consumers = []
         self._event_consumers = []
@@ -59,6 +123,19 @@ class Deferrable(object):
             self._initialized_redis_client = initialize_redis_client(self._redis_client)
         return self._initialized_redis_client
 
+    @property
+    def legacy_pickles(self):
+        """Whether pickled fields must be readable by older consumers, which is
+        the case for as long as the queue writes items in its legacy format."""
+        return not getattr(self.backend.queue, 'use_envelopes', True)
+
+    @property
+    def executor(self):
+        """Thread pool used by the non-blocking `*_async` methods, created on first use."""
+        if not hasattr(self, '_initialized_executor'):
+            self._initialized_executor = ThreadPool(self.executor_size)
+        return self._initialized_executor
+
     def deferrable(self, *args, **kwargs):
         """Decorator. Use this to register a function with this Deferrable
         instance. Example usage:
@@ -86,39 +163,175 @@ class Deferrable(object):
         envelope, item = self.backend.queue.pop()
         return self.process(envelope, item)
 
+    def run_batch(self, batch_size):
+        """Batched equivalent of `run_once`. Pops up to `batch_size` items
+        in a single operation, executes each of them and then pushes any
+        retries and completes the envelopes using the queue's batch operations.
+        Returns the number of items popped."""
+        queue = self.backend.queue
+        batch = queue.pop_batch(min(batch_size, queue.MAX_POP_BATCH_SIZE))
+        if not batch:
+            self._emit('empty', None)
+            return 0
+        self.process_batch(batch)
+        return len(batch)
+
+    def run_once_async(self):
+        """Non-blocking equivalent of `run_once`. The pop and processing happen on
+        this instance's executor, so several calls keep several pops in flight.
+        Returns a `multiprocessing.pool.AsyncResult`."""
+        return self.executor.apply_async(self.run_once)
+
+    def process_async(self, envelope, item):
+        """Non-blocking equivalent of `process`. Returns a `multiprocessing.pool.AsyncResult`."""
+        return self.executor.apply_async(self.process, (envelope, item))
+
     def process(self, envelope, item):
         if not envelope:
             self._emit('empty', item)
             return
         self._emit('pop', item)
-        item_error_classes = loads(item['error_classes']) or tuple()
+        outcome = self._execute(item)
+        if outcome == ExecutionOutcome.RETRY:
+            self.backend.queue.push(item)
+            self._emit('retry', item)
 
-        for producer_consumer in self._metadata_producer_consumers:
-            producer_consumer._consume_metadata_from_item(item)
+        self.backend.queue.complete(envelope)
+        self._emit('complete', item)
+        if outcome == ExecutionOutcome.DONE:
+            self._release_claim_check(item)
+
+    def process_batch(self, batch):
+        """Process a list of (envelope, item) tuples as returned by `Queue.pop_batch`.
+        Retries are pushed with a batch push and all envelopes are completed with a
+        batch complete. If a retry fails to push, its envelope is not completed so
+        that the queue can redeliver it."""
+        queue = self.backend.queue
+        to_complete, to_retry = [], []
+        for envelope, item in batch:
+            self._emit('pop', item)
+            outcome = self._execute(item)
+            if outcome == ExecutionOutcome.RETRY:
+                to_retry.append((envelope, item))
+            else:
+                to_complete.append((envelope, item, outcome))
 
+        retry_items = [item for _, item in to_retry]
+        for (envelope, item), (_, success) in zip(to_retry, self._push_batch(queue, retry_items)):
+            if success:
+                self._emit('retry', item)
+                to_complete.append((envelope, item, ExecutionOutcome.RETRY))
+            else:
+                logging.error("Failed to push retry for item, leaving it in flight: {}".format(item))
+
+        for chunk in _chunks(to_complete, queue.MAX_COMPLETE_BATCH_SIZE):
+            results = queue.complete_batch([envelope for envelope, _, _ in chunk])
+            for (envelope, item, outcome), (_, success) in zip(chunk, results):
+                if success:
+                    self._emit('complete', item)
+                    if outcome == ExecutionOutcome.DONE:
+                        self._release_claim_check(item)
+                else:
+                    logging.error("Failed to complete envelope for item: {}".format(item))
+
+    def _execute(self, item):
+        """Run the deferred method on a popped item, subject to its TTL and retry
+        settings. Items which exhaust their retries or raise a non-retriable error
+        are pushed to the error queue. Returns an `ExecutionOutcome`. On RETRY, the
+        item's attempt count and delay have already been updated and it should be
+        pushed back onto the main queue for another attempt."""
+        # Check the TTL before decoding anything, so that expired items are cheap to drain
+        if item_is_expired(item):
+            logging.warn("Deferrable job dropped with expired TTL: {}".format(self._pretty_unpickle_expired(item)))
+            self._emit('expire', item)
+            return ExecutionOutcome.DONE
+
+        lazy_item = LazyItem(item, method_loader=self._load_method,
+                             # The item itself keeps its claim check reference, so that it can be retried
+                             args_loader=lambda item: unpickle_args(self._check_out_item(item)),
+                             error_classes_loader=self._load_error_classes)
         try:
-            if item_is_expired(item):
-                logging.warn("Deferrable job dropped with expired TTL: {}".format(pretty_unpickle(item)))
-                self._emit('expire', item)
-                self.backend.queue.complete(envelope)
-                self._emit('complete', item)
-                return
-            method, args, kwargs = unpickle_method_call(item)
-            method(*args, **kwargs)
-        except tuple(item_error_classes):
+            for producer_consumer in self._metadata_producer_consumers:
+                producer_consumer._consume_metadata_from_item(item)
+            lazy_item.method(*lazy_item.args, **lazy_item.kwargs)
+        # Only evaluated, and so only decoded, if the method raises
+        except lazy_item.error_classes:
             attempts, max_attempts = item['attempts'], item['max_attempts']
             if attempts >= max_attempts - 1:
-                self._push_item_to_error_queue(item)
-            else:
-                item['attempts'] += 1
-                apply_exponential_backoff_delay(item)
-                self.backend.queue.push(item)
-                self._emit('retry', item)
+                self._push_item_to_error_queue(item, self._error_method_name(item, lazy_item))
+                return ExecutionOutcome.ERROR
+            item['attempts'] += 1
+            apply_exponential_backoff_delay(item)
+            return ExecutionOutcome.RETRY
+        except Exception:
+            self._push_item_to_error_queue(item, self._error_method_name(item, lazy_item))
+            return ExecutionOutcome.ERROR
+        return ExecutionOutcome.DONE
+
+    def _error_method_name(self, item, lazy_item):
+        """Name of the item's method for the error index. The method is never
+        decoded again here, so one which could not be loaded is recorded as unknown."""
+        if 'method_id' in item or 'object' in item:
+            return method_name(item)
+        if lazy_item.is_decoded('method'):
+            try:
+                return method_id(lazy_item.method)
+            except Exception:
+                pass
+        return 'unknown'
+
+    def _pretty_unpickle_expired(self, item):
+        try:
+            return pretty_unpickle(item, include_args=False, method=self._load_method(item))
+        except Exception:
+            return item.get('method_id', '<unknown method>')
+
+    def _load_cached(self, key, item, loader):
+        value, hit = self.unpickle_cache.get_or_load(key, loader)
+        self._emit('unpickle_cache_hit' if hit else 'unpickle_cache_miss', item)
+        return value
+
+    def _load_method(self, item):
+        if 'method_id' in item:
+            key = ('method_id', item['method_id'])
+        elif 'object' in item:
+            # Bound to an object which is unpickled afresh for each item, so not cacheable
+            return unpickle_method(item)
+        else:
+            key = ('method', item['method'])
+        return self._load_cached(key, item, lambda: unpickle_method(item))
+
+    def _load_error_classes(self, item):
+        return self._load_cached(('error_classes', item['error_classes']), item,
+                                 lambda: tuple(loads(item['error_classes']) or ()))
+
+    def _check_in_item(self, item):
+        if self.claim_check_store:
+            check_in_item(self.claim_check_store, item, self.claim_check_threshold)
+
+    def _check_out_item(self, item):
+        if not self.claim_check_store:
+            if 'args' not in item:
+                raise ValueError('Item has a claim check but no claim_check_store is configured')
+            return item
+        return check_out_item(self.claim_check_store, item)
+
+    def _release_claim_check(self, item):
+        """Delete the item's claim-checked arguments once its envelope is complete.
+        Failures are logged, since the item itself has already been processed."""
+        if not self.claim_check_store:
+            return
+        try:
+            release_item(self.claim_check_store, item)
         except Exception:
-            self._push_item_to_error_queue(item)
+            logging.exception("Error releasing claim check for item")
 
-        self.backend.queue.complete(envelope)
-        self._emit('complete', item)
+    def reset_connections(self):
+        """Discard all broker and Redis connections held by this instance so that
+        they are re-created on next use. Call this in a child process after forking."""
+        self.backend.reset_connections()
+        if self.redis_client:
+            self.redis_client.connection_pool.reset()
 
     def register_metadata_producer_consumer(self, producer_consumer):
         for existing in self._metadata_producer_consumers:
@@ -144,9 +357,19 @@ class Deferrable(object):
             if hasattr(event_consumer, handler_name):
                 getattr(event_consumer, handler_name)(item)
 
-    def _push_item_to_error_queue(self, item):
+    def _push_batch(self, queue, items):
+        """Push items to the given queue in chunks no larger than the queue's
+        MAX_PUSH_BATCH_SIZE. Returns a list of (item, success) in the same
+        format as `Queue.push_batch`."""
+        result = []
+        for chunk in _chunks(items, queue.MAX_PUSH_BATCH_SIZE):
+            result.extend(queue.push_batch(chunk))
+        return result
+
+    def _push_item_to_error_queue(self, item, method=None):
         """Put information about the current exception into the item's `error`
-        key and push the transformed item to the error queue."""
+        key and push the transformed item to the error queue. `method` is the
+        name of the item's method for the error index, if it is already known."""
         exc_info = sys.exc_info()
         assert exc_info[0], "_push_error_item must be called from inside an exception handler"
         error_info = {
@@ -162,8 +385,18 @@ class Deferrable(object):
         if 'delay' in item:
             del item['delay']
         self.backend.error_queue.push(item)
+        if self.error_index:
+            self._record_error(item, method)
         self._emit('error', item)
 
+    def _record_error(self, item, method=None):
+        """The index is only for reporting, so failing to update it must not
+        affect processing."""
+        try:
+            self.error_index.record(self.backend.group, item, method)
+        except Exception:
+            logging.exception('Error recording item in error index')
+
     def _validate_deferrable_args_compile_time(self, delay_seconds, debounce_seconds, debounce_always_delay, ttl_seconds):
         """Validation check which can be run at compile-time on decorated functions. This
         cannot do any bounds checking on the time arguments, which can be reified from
@@ -187,7 +420,7 @@ class Deferrable(object):
             if delay_seconds > ttl_seconds or debounce_seconds > ttl_seconds:
                 raise ValueError('delay_seconds or debounce_seconds must be less than ttl_seconds')
 
-    def _apply_delay_and_skip_for_debounce(self, item, debounce_seconds, debounce_always_delay):
+    def _apply_delay_and_skip_for_debounce(self, item, debounce_seconds, debounce_always_delay, keys=None):
         """Modifies the item in place to meet the debouncing constraints set by `debounce_seconds`
         and `debounce_always_delay`. For more detail, see the `debouncing` module.
 
@@ -198,45 +431,142 @@ class Deferrable(object):
         queued for processing. We do not want a failure in debounce to stop the item from being
         processed."""
         try:
-            debounce_strategy, seconds_to_delay = get_debounce_strategy(self.redis_client, item, debounce_seconds, debounce_always_delay)
-
-            if debounce_strategy == DebounceStrategy.SKIP:
-                item['debounce_skip'] = True
-                self._emit('debounce_hit', item)
-                return
-            self._emit('debounce_miss', item)
-
-            if debounce_strategy == DebounceStrategy.PUSH_NOW:
-                set_debounce_keys_for_push_now(self.redis_client, item, debounce_seconds)
-            elif debounce_strategy == DebounceStrategy.PUSH_DELAYED:
-                set_debounce_keys_for_push_delayed(self.redis_client, item, seconds_to_delay, debounce_seconds)
-
-            item['delay'] = seconds_to_delay
+            debounce_strategy, seconds_to_delay = apply_debounce(self.redis_client, item, debounce_seconds, debounce_always_delay,
+                                                                 keys=keys, local_cache=self.debounce_cache)
         except: # Skip debouncing if we hit an error, don't fail completely
             logging.exception("Encountered error while attempting to process debounce")
-            item['delay'] = 0
-            self._emit('debounce_error', item)
+            self._apply_debounce_error(item)
+            return
+        self._apply_debounce_strategy(item, debounce_strategy, seconds_to_delay)
+
+    def _apply_debounce_strategy(self, item, debounce_strategy, seconds_to_delay):
+        if debounce_strategy == DebounceStrategy.SKIP:
+            item['debounce_skip'] = True
+            self._emit('debounce_hit', item)
+            return
+        self._emit('debounce_miss', item)
+        item['delay'] = seconds_to_delay
+
+    def _apply_debounce_error(self, item):
+        item['delay'] = 0
+        self._emit('debounce_error', item)
+
+    def _apply_delay(self, item, keys=None):
+        """Set the final delay on an item built by `later`, running debounce if it
+        is configured with the item's debounce `keys`. Returns False if the item was
+        debounced and should be skipped."""
+        debounce_seconds = item['original_debounce_seconds']
+        if debounce_seconds:
+            self._apply_delay_and_skip_for_debounce(item, debounce_seconds, item['original_debounce_always_delay'], keys)
+            if item.get('debounce_skip'):
+                return False
+        else:
+            item['delay'] = item['original_delay_seconds']
+
+        # Final delay value calculated
+        item['original_delay'] = item['delay']
+        return True
+
+    def _apply_delays(self, items_and_keys):
+        """Batched equivalent of `_apply_delay`, which takes a list of (item, keys)
+        tuples and evaluates debounce for all of the items in a single Redis
+        round-trip. Returns the items which were not debounced, in their original order."""
+        items = [item for item, _ in items_and_keys]
+        debounced = [(item, keys) for item, keys in items_and_keys if item['original_debounce_seconds']]
+        if debounced:
+            try:
+                results = apply_debounce_batch(self.redis_client,
+                                               [(keys or debounce_keys(item), item['original_debounce_seconds'],
+                                                 item['original_debounce_always_delay'])
+                                                for item, keys in debounced],
+                                               local_cache=self.debounce_cache)
+            except: # Skip debouncing if we hit an error, don't fail completely
+                logging.exception("Encountered error while attempting to process debounce")
+                results = [None] * len(debounced)
+            for (item, _), result in zip(debounced, results):
+                if result is None or isinstance(result, Exception):
+                    if result is not None:
+                        logging.error("Encountered error while attempting to process debounce: {}".format(result))
+                    self._apply_debounce_error(item)
+                else:
+                    self._apply_debounce_strategy(item, *result)
+
+        survivors = []
+        for item in items:
+            if item.get('debounce_skip'):
+                continue
+            if not item['original_debounce_seconds']:
+                item['delay'] = item['original_delay_seconds']
+            # Final delay value calculated
+            item['original_delay'] = item['delay']
+            survivors.append(item)
+        return survivors
+
+    def _push_item(self, item, keys=None):
+        if not self._apply_delay(item, keys):
+            return
+        self._check_in_item(item)
+        self.backend.queue.push(item)
+        self._emit('push', item)
 
     def _deferrable(self, method, error_classes=None, max_attempts=None,
                     delay_seconds=0, debounce_seconds=0, debounce_always_delay=False, ttl_seconds=0,
-                    use_exponential_backoff=True):
+                    use_exponential_backoff=True, codec=None):
         self._validate_deferrable_args_compile_time(delay_seconds, debounce_seconds, debounce_always_delay, ttl_seconds)
-
-        def later(*args, **kwargs):
-
+        # So that consumers which import the method's module resolve its ID without a module lookup
+        item_method_id = register_method(method)
+        item_codec = get_codec(codec).CODEC_ID if codec is not None else self.default_codec
+        item_error_classes = error_classes if error_classes is not None else self.default_error_classes
+        item_max_attempts = max_attempts if max_attempts is not None else self.default_max_attempts
+        serialized = {}
+
+        def get_serialized():
+            """The method and error classes are the same for every invocation, so
+            serialize them once. This cannot happen at decoration time, since the
+            method's module attribute is only bound once the decorator returns and
+            pickle needs it to find the method."""
+            if not serialized:
+                serialized.update({
+                    'method': serialize_method(method, self.use_method_ids, self.legacy_pickles),
+                    'error_classes': dumps(item_error_classes, self.legacy_pickles)
+                })
+                if debounce_seconds and self.legacy_debounce_keys:
+                    serialized['legacy_debounce_method'] = dumps(method, legacy=True)
+            return serialized
+
+        def build_debounce_keys(item, args, kwargs):
+            """The debounce keys for an item built by `build_item`, or None if it is
+            not debounced. The method ID is the one captured at decoration time, so
+            the method is never decoded. Older versions' keys embed the pickles they
+            wrote, which are the item's own fields if it was written in their format."""
+            if not item['original_debounce_seconds']:
+                return None
+            legacy_suffix = None
+            if self.legacy_debounce_keys:
+                if self.legacy_pickles and item['codec'] == PickleCodec.CODEC_ID and 'method_id' not in item:
+                    legacy_suffix = LEGACY_KEY_SUFFIX.format(item['method'], item['args'], item['kwargs'])
+                else:
+                    legacy_suffix = legacy_key_suffix(get_serialized()['legacy_debounce_method'], args, kwargs)
+            return debounce_keys(item, item_method_id, legacy_suffix)
+
+        def build_item(*args, **kwargs):
+            """Build the queue item for a single invocation, applying TTL, backoff
+            and metadata. This does no I/O, so it is safe to call on the producer's
+            own thread even when the push happens elsewhere. The delay is finalized
+            by `_apply_delay` just before the item is pushed."""
             delay_actual = delay_seconds() if callable(delay_seconds) else delay_seconds
             debounce_actual = debounce_seconds() if callable(debounce_seconds) else debounce_seconds
             ttl_actual = ttl_seconds() if callable(ttl_seconds) else ttl_seconds
 
             self._validate_deferrable_args_run_time(delay_actual, debounce_actual, ttl_actual)
 
-            item = build_later_item(method, *args, **kwargs)
+            fields = get_serialized()
+            item = build_later_item_with_codec(item_codec, method, args, kwargs,
+                                               serialized_method=fields['method'], legacy=self.legacy_pickles)
             now = time.time()
-            item_error_classes = error_classes if error_classes is not None else self.default_error_classes
-            item_max_attempts = max_attempts if max_attempts is not None else self.default_max_attempts
             item.update({
                 'group': self.backend.group,
-                'error_classes': dumps(item_error_classes),
+                'error_classes': fields['error_classes'],
                 'attempts': 0,
                 'max_attempts': item_max_attempts,
                 'first_push_time': now,
@@ -249,21 +579,45 @@ class Deferrable(object):
             if ttl_actual:
                 add_ttl_metadata_to_item(item, ttl_actual)
 
-            if debounce_actual:
-                self._apply_delay_and_skip_for_debounce(item, debounce_actual, debounce_always_delay)
-                if item.get('debounce_skip'):
-                    return
-            else:
-                item['delay'] = delay_actual
-
-            # Final delay value calculated
-            item['original_delay'] = item['delay']
-
             for producer_consumer in self._metadata_producer_consumers:
-                producer_consumer._apply_metadata_to_item(item)
+                producer_consumer._apply_metadata_to_item(item, self.legacy_pickles)
 
-            self.backend.queue.push(item)
-            self._emit('push', item)
+            return item
+
+        def later(*args, **kwargs):
+            item = build_item(*args, **kwargs)
+            self._push_item(item, build_debounce_keys(item, args, kwargs))
+
+        def later_async(*args, **kwargs):
+            """Non-blocking equivalent of `later`. The item is built on the calling
+            thread, while debounce and the push happen on this instance's executor.
+            Returns a `multiprocessing.pool.AsyncResult`."""
+            item = build_item(*args, **kwargs)
+            return self.executor.apply_async(self._push_item, (item, build_debounce_keys(item, args, kwargs)))
+
+        def later_many(calls):
+            """Batched equivalent of `later`. Takes an iterable of (args, kwargs)
+            tuples and pushes the resulting items using the queue's batch push,
+            chunked to the queue's MAX_PUSH_BATCH_SIZE. Debounce is evaluated for
+            all of the items in a single Redis round-trip. Returns a list of the
+            items which failed to push."""
+            items_and_keys = []
+            for args, kwargs in calls:
+                item = build_item(*args, **kwargs)
+                items_and_keys.append((item, build_debounce_keys(item, args, kwargs)))
+            items = self._apply_delays(items_and_keys)
+            for item in items:
+                self._check_in_item(item)
+
+            failed_items = []
+            for item, success in self._push_batch(self.backend.queue, items):
+                if success:
+                    self._emit('push', item)
+                else:
+                    failed_items.append(item)
+            return failed_items
 
         method.later = later
+        method.later_many = later_many
+        method.later_async = later_async
         return method
@@ -0,0 +1,148 @@
+"""Error indexes count the items sent to the error queue by method, error
+type and the hour in which they errored, and remember the IDs of the most
+recent errors for each method and error type. They are updated as each
+item is pushed to the error queue, so that questions like "which task is
+failing, and with what?" can be answered instantly during an incident,
+without popping and unpickling every item in the error queue.
+
+Counts are kept per hour, so time ranges in queries are rounded out to
+whole hours. Hours older than the index's retention are dropped."""
+
+import time
+import threading
+from collections import Counter, defaultdict, deque
+
+from .pickling import method_name
+
+HOUR_SECONDS = 60 * 60
+DIMENSIONS = ('method', 'error_type', 'hour')
+
+DEFAULT_RETENTION_HOURS = 72
+DEFAULT_RECENT_IDS_SIZE = 100
+DEFAULT_QUERY_SECONDS = 24 * HOUR_SECONDS
+
+def _hour(timestamp):
+    """Start of the hour containing `timestamp`, in epoch seconds."""
+    return int(timestamp // HOUR_SECONDS) * HOUR_SECONDS
+
+class ErrorIndex(object):
+    """Abstract class for error indexes. Your subclass should override
+    all private methods."""
+
+    def _record(self, group, hour, method, error_type, error_id):
+        raise NotImplementedError()
+
+    def _counts(self, group, hours):
+        """Should return a dict of {(hour, method, error_type): count} for the given hours."""
+        raise NotImplementedError()
+
+    def _recent_ids(self, group, method, error_type):
+        """Should return the IDs of the most recent errors, newest first."""
+        raise NotImplementedError()
+
+    def record(self, group, item, method=None):
+        """Record an item which has just been pushed to the error queue. `method`
+        is the name of the item's method if the caller already knows it, since
+        otherwise it is taken from the item, which may unpickle the method."""
+        error = item['error']
+        return self._record(group, _hour(error['ts']), method or method_name(item), error['error_type'], error['id'])
+
+    def top(self, group, by=('method', 'error_type'), since=None, until=None, n=10):
+        """Returns a list of up to `n` dicts, most frequent first, each holding a
+        value for every dimension in `by` and the `count` of errors with those
+        values. Dimensions are 'method', 'error_type' and 'hour'. Only errors
+        between `since` and `until` (epoch seconds) are counted, which default
+        to the last 24 hours."""
+        for dimension in by:
+            if dimension not in DIMENSIONS:
+                raise ValueError('Unknown dimension {}, expected one of {}'.format(dimension, DIMENSIONS))
+        until = time.time() if until is None else until
+        since = until - DEFAULT_QUERY_SECONDS if since is None else since
+        hours = range(_hour(since), _hour(until) + 1, HOUR_SECONDS)
+
+        totals = Counter()
+        for (hour, method, error_type), count in self._counts(group, hours).iteritems():
+            values = {'hour': hour, 'method': method, 'error_type': error_type}
+            totals[tuple(values[dimension] for dimension in by)] += count
+        return [dict(zip(by, key), count=count) for key, count in totals.most_common(n)]
+
+    def recent_ids(self, group, method, error_type):
+        """IDs of the most recent errors for this method and error type, newest
+        first. These are the `error.id` of the items in the error queue."""
+        return self._recent_ids(group, method, error_type)
+
+class InMemoryErrorIndex(ErrorIndex):
+    """Index kept in the memory of the process. Only useful when errors are
+    recorded and queried in the same process, e.g. with the in-memory backend."""
+
+    def __init__(self, retention_hours=DEFAULT_RETENTION_HOURS, recent_ids_size=DEFAULT_RECENT_IDS_SIZE):
+        self.retention_hours = retention_hours
+        self.recent_ids_size = recent_ids_size
+        self._lock = threading.Lock()
+        self._hourly_counts = defaultdict(Counter)
+        self._recent = {}
+
+    def _record(self, group, hour, method, error_type, error_id):
+        with self._lock:
+            self._hourly_counts[(group, hour)][(method, error_type)] += 1
+            key = (group, method, error_type)
+            if key not in self._recent:
+                self._recent[key] = deque(maxlen=self.recent_ids_size)
+            self._recent[key].appendleft(error_id)
+
+            oldest_hour = _hour(time.time()) - self.retention_hours * HOUR_SECONDS
+            for expired_key in [key for key in self._hourly_counts if key[1] < oldest_hour]:
+                del self._hourly_counts[expired_key]
+
+    def _counts(self, group, hours):
+        with self._lock:
+            return {(hour, method, error_type): count
+                    for hour in hours
+                    for (method, error_type), count in self._hourly_counts.get((group, hour), {}).iteritems()}
+
+    def _recent_ids(self, group, method, error_type):
+        with self._lock:
+            return list(self._recent.get((group, method, error_type), ()))
+
+class RedisErrorIndex(ErrorIndex):
+    """Index shared by every producer and consumer using the same Redis. Each
+    hour's counts are a hash, and recording an error is one round-trip."""
+
+    def __init__(self, redis_client, prefix='deferrable.error_index',
+                 retention_hours=DEFAULT_RETENTION_HOURS, recent_ids_size=DEFAULT_RECENT_IDS_SIZE):
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.retention_hours = retention_hours
+        self.recent_ids_size = recent_ids_size
+
+    def _counts_key(self, group, hour):
+        return '{}.{}.counts.{}'.format(self.prefix, group or 'default', hour)
+
+    def _recent_key(self, group, method, error_type):
+        return '{}.{}.recent.{}|{}'.format(self.prefix, group or 'default', method, error_type)
+
+    def _record(self, group, hour, method, error_type, error_id):
+        expire_seconds = self.retention_hours * HOUR_SECONDS
+        counts_key = self._counts_key(group, hour)
+        recent_key = self._recent_key(group, method, error_type)
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.hincrby(counts_key, '{}|{}'.format(method, error_type), 1)
+        pipeline.expire(counts_key, expire_seconds)
+        pipeline.lpush(recent_key, error_id)
+        pipeline.ltrim(recent_key, 0, self.recent_ids_size - 1)
+        pipeline.expire(recent_key, expire_seconds)
+        pipeline.execute()
+
+    def _counts(self, group, hours):
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for hour in hours:
+            pipeline.hgetall(self._counts_key(group, hour))
+        counts = {}
+        for hour, hourly_counts in zip(hours, pipeline.execute()):
+            for field, count in hourly_counts.iteritems():
+                method, _, error_type = field.rpartition('|')
+                counts[(hour, method, error_type)] = int(count)
+        return counts
+
+    def _recent_ids(self, group, method, error_type):
+        return self.redis_client.lrange(self._recent_key(group, method, error_type), 0, -1)
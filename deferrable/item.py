@@ -0,0 +1,45 @@
+"""LazyItem wraps a popped queue item so that its serialized fields are
+only decoded when they are first needed. Items which are dropped before
+execution (e.g. on TTL expiry) therefore never pay for decoding their
+method, error classes or arguments."""
+
+from .pickling import loads, unpickle_method, unpickle_args
+
+class LazyItem(object):
+    def __init__(self, item, method_loader=unpickle_method, args_loader=unpickle_args,
+                 error_classes_loader=None):
+        """Each loader takes the raw item. `error_classes_loader` should return a
+        tuple, and defaults to unpickling the item's `error_classes`."""
+        self.item = item
+        self._method_loader = method_loader
+        self._args_loader = args_loader
+        self._error_classes_loader = error_classes_loader or _load_error_classes
+        self._decoded = {}
+
+    def _get(self, field, loader):
+        if field not in self._decoded:
+            self._decoded[field] = loader(self.item)
+        return self._decoded[field]
+
+    @property
+    def method(self):
+        return self._get('method', self._method_loader)
+
+    @property
+    def args(self):
+        return self._get('call_args', self._args_loader)[0]
+
+    @property
+    def kwargs(self):
+        return self._get('call_args', self._args_loader)[1]
+
+    @property
+    def error_classes(self):
+        return self._get('error_classes', self._error_classes_loader)
+
+    def is_decoded(self, field):
+        """Whether `field` ('method', 'args', 'kwargs' or 'error_classes') has been decoded."""
+        return ('call_args' if field in ('args', 'kwargs') else field) in self._decoded
+
+def _load_error_classes(item):
+    return tuple(loads(item['error_classes']) or ())
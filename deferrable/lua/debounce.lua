@@ -0,0 +1,62 @@
+-- Decides the debounce strategy for an item and updates its keys in a
+-- single atomic step. Returns {strategy, secondsToDelay, secondsToSkip},
+-- with strategy matching the values of DebounceStrategy in debounce.py.
+-- secondsToSkip is how much longer further pushes of the item are
+-- guaranteed to be skipped, which producers may use to cache SKIPs.
+--
+-- KEYS[3] and KEYS[4], if given, are the legacy last push and debounce
+-- keys for the item. These are read but never written.
+local PUSH_NOW = 1
+local PUSH_DELAYED = 2
+local SKIP = 3
+
+local lastPushKey = KEYS[1]
+local debounceKey = KEYS[2]
+local legacyLastPushKey = KEYS[3]
+local legacyDebounceKey = KEYS[4]
+
+local now = tonumber(ARGV[1])
+local debounceSeconds = tonumber(ARGV[2])
+local alwaysDelay = ARGV[3] == '1'
+
+local lastPushTtl = math.ceil(2 * debounceSeconds * 1000)
+
+-- Milliseconds until the key expires, 0 if it has no expiry, or nil if it does not exist
+local function remainingMilliseconds(key)
+    local ttl = redis.call('pttl', key)
+    if ttl == -2 then
+        return nil
+    end
+    return math.max(ttl, 0)
+end
+
+local skipMilliseconds = remainingMilliseconds(debounceKey)
+if legacyDebounceKey then
+    local legacySkipMilliseconds = remainingMilliseconds(legacyDebounceKey)
+    if legacySkipMilliseconds and (not skipMilliseconds or legacySkipMilliseconds > skipMilliseconds) then
+        skipMilliseconds = legacySkipMilliseconds
+    end
+end
+if skipMilliseconds then
+    return {SKIP, '0', tostring(skipMilliseconds / 1000)}
+end
+
+local secondsToDelay = debounceSeconds
+if not alwaysDelay then
+    local lastPushTime = tonumber(redis.call('get', lastPushKey))
+    if legacyLastPushKey then
+        local legacyLastPushTime = tonumber(redis.call('get', legacyLastPushKey))
+        if legacyLastPushTime and (not lastPushTime or legacyLastPushTime > lastPushTime) then
+            lastPushTime = legacyLastPushTime
+        end
+    end
+    if not lastPushTime or now - lastPushTime > debounceSeconds then
+        redis.call('set', lastPushKey, ARGV[1], 'PX', lastPushTtl)
+        return {PUSH_NOW, '0', '0'}
+    end
+    secondsToDelay = math.ceil(debounceSeconds - (now - lastPushTime))
+end
+
+redis.call('set', lastPushKey, tostring(now + secondsToDelay), 'PX', lastPushTtl)
+redis.call('set', debounceKey, '_', 'PX', math.ceil(debounceSeconds * 1000))
+return {PUSH_DELAYED, tostring(secondsToDelay), tostring(debounceSeconds)}
@@ -23,8 +23,8 @@ class MetadataProducerConsumer(object):
         """Receives the same metadata dict returned by the producer."""
         pass
 
-    def _apply_metadata_to_item(self, item):
-        item.setdefault('metadata', {})[self.NAMESPACE] = dumps(self.produce_metadata())
+    def _apply_metadata_to_item(self, item, legacy=False):
+        item.setdefault('metadata', {})[self.NAMESPACE] = dumps(self.produce_metadata(), legacy)
 
     def _consume_metadata_from_item(self, item):
         metadata = item.get('metadata', {}).get(self.NAMESPACE)
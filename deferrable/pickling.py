@@ -1,20 +1,137 @@
 """Unified pickling imports throughout the project. Any module in this
 project, or any external code which needs direct access to the serialized
 deferred item, should use the functions defined here instead of importing
-`pickle` or `cPickle` directly."""
+`pickle` or `cPickle` directly.
 
+Individual item fields (args, kwargs, method, etc.) are pickled with the
+highest available protocol. Queues which need to serialize the whole item
+for transport should use `encode_item` and `decode_item`, which frame a
+single binary pickle of the item with a small header:
+
+    ENVELOPE_MAGIC (2 bytes) | version (1 byte) | flags (1 byte) | payload
+
+If the item is encoded with a `compression` and its pickle is larger than
+`compression_threshold` bytes, the payload is compressed and the flags hold
+the compression used. Compressed payloads are preceded by their raw size
+as a 4 byte unsigned int, so that stats can be reported without decompressing.
+
+Both functions remain able to read items written by older versions, whose
+fields were protocol 0 pickles encoded with `string_escape`. Older versions
+can read neither binary fields nor envelopes, so until every consumer has
+been upgraded, producers keep writing fields with `dumps(obj, legacy=True)`
+and queues keep writing items in their legacy format (see the `use_envelopes`
+argument to the SQS and Dockets backend factories).
+
+The args and kwargs of a deferred call are encoded with the codec named
+by the item's `codec` key (see the `codec` module), defaulting to pickle.
+The method is either pickled under `method`, or referenced by its ID in
+the method registry under `method_id` (see the `registry` module)."""
+
+import bz2
+import zlib
+import struct
+import logging
 import cPickle as pickle
 
+from .codec import PickleCodec, get_codec, DEFAULT_CODEC_ID
+from .registry import register_method, get_method, method_id
+
+ENVELOPE_MAGIC = '\xde\xfe'
+ENVELOPE_VERSION = 1
+ENVELOPE_HEADER = struct.Struct('>2sBB')
+RAW_SIZE = struct.Struct('>I')
+
+# Compression name -> (envelope flag, compress, decompress)
+COMPRESSIONS = {
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'bz2': (2, bz2.compress, bz2.decompress)
+}
+COMPRESSION_FLAGS = {flag: name for name, (flag, _, _) in COMPRESSIONS.iteritems()}
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+# Key under which queues record the sizes of an item's encoded payload,
+# so that event consumers can report on them
+PAYLOAD_STATS_KEY = 'payload_stats'
+
+_pickle_codec = PickleCodec()
+
 def loads(string):
     if string is None:
         return None
-    return pickle.loads(string.decode('string_escape'))
+    return _pickle_codec.decode(string)
+
+def dumps(obj, legacy=False):
+    """With `legacy`, writes the protocol 0, string_escape'd pickle which
+    older versions read, rather than a binary pickle."""
+    if legacy:
+        return pickle.dumps(obj).encode('string_escape')
+    return _pickle_codec.encode(obj)
+
+def is_encoded_item(payload):
+    return isinstance(payload, bytes) and payload.startswith(ENVELOPE_MAGIC)
+
+def validate_compression(compression, use_envelopes=True):
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError('Unsupported compression {}'.format(compression))
+    if compression is not None and not use_envelopes:
+        raise ValueError('Compression is only supported with use_envelopes')
+
+def encode_item(item, compression=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD):
+    raw = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+    if compression and len(raw) > compression_threshold:
+        flag, compress, _ = COMPRESSIONS[compression]
+        compressed = compress(raw)
+        # Not worth the consumer's time to decompress if we saved nothing
+        if len(compressed) < len(raw):
+            header = ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, flag)
+            return header + RAW_SIZE.pack(len(raw)) + compressed
+    return ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, 0) + raw
+
+def _unpack_header(payload):
+    _, version, flags = ENVELOPE_HEADER.unpack_from(payload)
+    if version > ENVELOPE_VERSION:
+        raise ValueError('Unsupported envelope version {}'.format(version))
+    if flags and flags not in COMPRESSION_FLAGS:
+        raise ValueError('Unsupported envelope flags {}'.format(flags))
+    return flags
 
-def dumps(obj):
-    return pickle.dumps(obj).encode('string_escape')
+def decode_item(payload):
+    if not is_encoded_item(payload):
+        # Written by an older version with `dumps` on the whole item
+        return loads(payload)
+    flags = _unpack_header(payload)
+    if flags:
+        _, _, decompress = COMPRESSIONS[COMPRESSION_FLAGS[flags]]
+        return pickle.loads(decompress(payload[ENVELOPE_HEADER.size + RAW_SIZE.size:]))
+    return pickle.loads(payload[ENVELOPE_HEADER.size:])
 
-def pretty_unpickle(item):
-    method, args, kwargs = unpickle_method_call(item)
+def payload_stats(payload):
+    """Returns the compression used for an encoded payload, along with its
+    encoded size and the size of the item's uncompressed pickle."""
+    if not is_encoded_item(payload):
+        return {'compression': None, 'encoded_size': len(payload), 'raw_size': len(payload)}
+    flags = _unpack_header(payload)
+    if flags:
+        raw_size, = RAW_SIZE.unpack_from(payload, ENVELOPE_HEADER.size)
+    else:
+        raw_size = len(payload) - ENVELOPE_HEADER.size
+    return {'compression': COMPRESSION_FLAGS.get(flags),
+            'encoded_size': len(payload),
+            'raw_size': raw_size}
+
+def pretty_unpickle(item, include_args=True, method=None):
+    """Describe the item's method call for logging. With `include_args=False`,
+    the args and kwargs are left undecoded. The `method` may be given if the
+    caller has already loaded it."""
+    if method is None:
+        method = unpickle_method(item)
+    if 'args' not in item:
+        # Arguments offloaded to a claim check are not fetched just for logging
+        args = kwargs = '<claim check {}>'.format(item.get('claim_check'))
+    elif not include_args:
+        args = kwargs = '<not decoded>'
+    else:
+        args, kwargs = unpickle_args(item)
     return str({
         'method': method.func_code.co_name,
         'filename': method.func_code.co_filename,
@@ -23,21 +140,73 @@ def pretty_unpickle(item):
         'kwargs': str(kwargs)
     })
 
+def serialize_method(method, use_method_id=False, legacy=False):
+    """Returns the item fields which identify `method`. These are fixed for
+    a given method, so callers deferring it repeatedly should compute them
+    once and pass them to `build_later_item_with_codec`."""
+    if use_method_id:
+        return {'method_id': register_method(method)}
+    return {'method': dumps(method, legacy)}
+
 def build_later_item(method, *args, **kwargs):
-    return {
-        'args': dumps(args),
-        'kwargs': dumps(sorted(kwargs.items())),
-        'method': dumps(method)
+    return build_later_item_with_codec(DEFAULT_CODEC_ID, method, args, kwargs)
+
+def _encode_args(codec, args, sorted_kwargs, legacy):
+    if legacy and codec.CODEC_ID == _pickle_codec.CODEC_ID:
+        return dumps(args, legacy), dumps(sorted_kwargs, legacy)
+    return codec.encode(args), codec.encode(sorted_kwargs)
+
+def build_later_item_with_codec(codec_id, method, args, kwargs, serialized_method=None, legacy=False):
+    """Falls back to the pickle codec if the requested codec cannot
+    encode these particular arguments. `serialized_method` may be given
+    as returned by `serialize_method` to avoid serializing the method again.
+    With `legacy`, pickled fields are written in the format older versions read."""
+    sorted_kwargs = sorted(kwargs.items())
+    codec = get_codec(codec_id)
+    try:
+        encoded_args, encoded_kwargs = _encode_args(codec, args, sorted_kwargs, legacy)
+    except (TypeError, ValueError):
+        logging.debug("Codec {} could not encode arguments, falling back to pickle".format(codec_id))
+        codec = _pickle_codec
+        encoded_args, encoded_kwargs = _encode_args(codec, args, sorted_kwargs, legacy)
+    item = {
+        'args': encoded_args,
+        'kwargs': encoded_kwargs,
+        'codec': codec.CODEC_ID
     }
+    item.update(serialized_method or serialize_method(method, legacy=legacy))
+    return item
 
-def unpickle_method_call(item):
+def unpickle_method(item):
+    if 'method_id' in item:
+        return get_method(item['method_id'])
     if 'object' in item:
         obj = loads(item['object'])
-        method = getattr(obj, item['method'])
-    else:
-        method = loads(item['method'])
-    args = loads(item['args'])
-    kwargs = loads(item['kwargs'])
+        return getattr(obj, item['method'])
+    return loads(item['method'])
+
+def method_name(item):
+    """Readable name for the item's method, for keys, filters and reports. Only
+    the method is decoded, and only if the item does not carry a method ID.
+    Returns 'unknown' if the method cannot be decoded."""
+    if 'method_id' in item:
+        return item['method_id']
+    if 'object' in item:
+        return item['method']
+    try:
+        return method_id(unpickle_method(item))
+    except Exception:
+        return 'unknown'
+
+def unpickle_method_call(item):
+    method = unpickle_method(item)
+    args, kwargs = unpickle_args(item)
+    return method, args, kwargs
+
+def unpickle_args(item):
+    codec = get_codec(item.get('codec', DEFAULT_CODEC_ID))
+    args = codec.decode(item['args'])
+    kwargs = codec.decode(item['kwargs'])
     if isinstance(kwargs, list):
         kwargs = dict(kwargs)
-    return method, args, kwargs
+    return args, kwargs
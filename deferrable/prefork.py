@@ -0,0 +1,232 @@
+"""PreforkSupervisor runs a Deferrable consumer across several forked
+child processes. This is intended for CPU-bound tasks, which would be
+limited by the GIL when run in a threaded `Worker`.
+
+Each child resets the connections it inherited from the parent, then
+runs its own `Worker`. Children which crash are restarted, and children
+may be recycled once they have processed a given number of tasks or
+their RSS grows past a limit. Every child reports the events it has
+emitted back to the parent, which aggregates them in `event_counts`.
+
+On SIGTERM or SIGINT, the supervisor forwards SIGTERM to its children,
+waits for them to drain and exit, and then returns."""
+
+import os
+import json
+import errno
+import select
+import signal
+import logging
+import resource
+import threading
+import multiprocessing
+
+from .worker import Worker
+
+SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+class EventCounter(object):
+    """Event consumer which counts every event emitted by a Deferrable instance."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if not attr.startswith('on_'):
+            raise AttributeError(attr)
+        event = attr[3:]
+        def handler(item):
+            with self._lock:
+                self._counts[event] = self._counts.get(event, 0) + 1
+        return handler
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+class _ChildRecycler(object):
+    """Event consumer which stops a child's worker once it has completed
+    `max_tasks` items or its peak RSS exceeds `max_rss_kb`."""
+
+    def __init__(self, worker, max_tasks, max_rss_kb):
+        self.worker = worker
+        self.max_tasks = max_tasks
+        self.max_rss_kb = max_rss_kb
+        self.completed = 0
+        # Called from every consumer thread in the child
+        self._lock = threading.Lock()
+
+    def on_complete(self, item):
+        with self._lock:
+            self.completed += 1
+            completed = self.completed
+        if self.max_tasks and completed >= self.max_tasks:
+            logging.info("Recycling child {} after {} tasks".format(os.getpid(), completed))
+            self.worker.stop()
+        elif self.max_rss_kb:
+            # ru_maxrss is reported in kilobytes on Linux
+            rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if rss_kb > self.max_rss_kb:
+                logging.info("Recycling child {} with RSS of {}KB".format(os.getpid(), rss_kb))
+                self.worker.stop()
+
+class PreforkSupervisor(object):
+    def __init__(self, deferrable_instance, processes=None, concurrency=1,
+                 max_tasks_per_child=None, max_rss_kb=None, poll_interval=1, **worker_kwargs):
+        """
+        - processes: Number of child processes to run. Defaults to the number of CPUs.
+        - concurrency: Number of consumer threads in each child's `Worker`.
+        - max_tasks_per_child: Recycle a child after it completes this many items.
+        - max_rss_kb: Recycle a child once its peak RSS exceeds this many kilobytes.
+        - poll_interval: Seconds between supervisor checks on its children.
+
+        Any further keyword arguments are passed through to each child's `Worker`.
+        """
+        self.deferrable = deferrable_instance
+        self.processes = processes or multiprocessing.cpu_count()
+        self.concurrency = concurrency
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_rss_kb = max_rss_kb
+        self.poll_interval = poll_interval
+        self.worker_kwargs = worker_kwargs
+
+        self.event_counts = {}
+        self._children = {}
+        self._buffers = {}
+        self._stopping = False
+
+    def run(self):
+        """Run the supervisor in the foreground until SIGTERM or SIGINT is received.
+        Must be called from the main thread."""
+        previous_handlers = {}
+        for signum in SIGNALS:
+            previous_handlers[signum] = signal.signal(signum, self._handle_signal)
+        try:
+            while not self._stopping:
+                while len(self._children) < self.processes:
+                    self._spawn()
+                self._read_event_counts(self.poll_interval)
+                self._reap()
+            self._terminate_children()
+        finally:
+            for signum, handler in previous_handlers.iteritems():
+                signal.signal(signum, handler)
+
+    def stop(self):
+        self._stopping = True
+
+    def _handle_signal(self, signum, frame):
+        logging.info("Received signal {}, stopping child processes".format(signum))
+        self.stop()
+
+    def _spawn(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            for fd in self._children.itervalues():
+                os.close(fd)
+            exit_code = 0
+            try:
+                self._run_child(write_fd)
+            except Exception:
+                logging.exception("Unexpected error in deferrable child process")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        os.close(write_fd)
+        self._children[pid] = read_fd
+        self._buffers[read_fd] = ''
+        logging.info("Started child process {}".format(pid))
+
+    def _run_child(self, write_fd):
+        self.deferrable.reset_connections()
+        worker = Worker(self.deferrable, concurrency=self.concurrency, **self.worker_kwargs)
+        counter = EventCounter()
+        self.deferrable.register_event_consumer(counter)
+        self.deferrable.register_event_consumer(_ChildRecycler(worker, self.max_tasks_per_child, self.max_rss_kb))
+        for signum in SIGNALS:
+            signal.signal(signum, lambda signum, frame: worker.stop())
+
+        worker.start()
+        reported = {}
+        while not worker.stopping:
+            self._sleep(self.poll_interval)
+            reported = self._report_event_counts(write_fd, counter, reported)
+        worker.join()
+        self._report_event_counts(write_fd, counter, reported)
+        os.close(write_fd)
+
+    def _sleep(self, seconds):
+        # Unlike time.sleep, select returns early when a signal arrives
+        try:
+            select.select([], [], [], seconds)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+    def _report_event_counts(self, write_fd, counter, reported):
+        """Send the counts accumulated since the last report to the parent. Each report
+        is a single JSON line, written in one call so that it cannot be interleaved."""
+        counts = counter.snapshot()
+        delta = {event: count - reported.get(event, 0)
+                 for event, count in counts.iteritems()
+                 if count != reported.get(event, 0)}
+        if delta:
+            os.write(write_fd, json.dumps(delta) + '\n')
+        return counts
+
+    def _read_event_counts(self, timeout):
+        fds = self._children.values()
+        try:
+            readable, _, _ = select.select(fds, [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        for fd in readable:
+            self._read_from_child(fd)
+
+    def _read_from_child(self, fd):
+        data = os.read(fd, 65536)
+        if not data:
+            return False
+        lines = (self._buffers[fd] + data).split('\n')
+        self._buffers[fd] = lines.pop()
+        for line in lines:
+            for event, count in json.loads(line).iteritems():
+                self.event_counts[event] = self.event_counts.get(event, 0) + count
+        return True
+
+    def _reap(self):
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid == 0:
+                return
+            fd = self._children.pop(pid)
+            # Collect anything the child reported just before exiting
+            while self._read_from_child(fd):
+                pass
+            os.close(fd)
+            del self._buffers[fd]
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                logging.info("Child process {} exited".format(pid))
+            else:
+                logging.error("Child process {} died with status {}".format(pid, status))
+
+    def _terminate_children(self):
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+        while self._children:
+            self._read_event_counts(self.poll_interval)
+            self._reap()
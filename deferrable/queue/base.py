@@ -55,6 +55,13 @@ class Queue(object):
         """
         raise NotImplementedError()
 
+    def _reset_connections(self):
+        """Discard any connections to the broker so that they are lazily
+        re-created on next use. Called in child processes after a fork, since
+        sockets cannot be safely shared with the parent. Queues which do not
+        hold connections do not need to override this."""
+        return None
+
     def push(self, item):
         return self._push(item)
 
@@ -87,3 +94,6 @@ class Queue(object):
 
     def stats(self):
         return self._stats()
+
+    def reset_connections(self):
+        return self._reset_connections()
@@ -1,39 +1,148 @@
 from __future__ import absolute_import
 
+import sys
+import time
 import logging
 from uuid import uuid1
+from itertools import islice
 
 import dockets.queue
 import dockets.error_queue
 
+from dockets.json_serializer import JsonSerializer
+from dockets.redis_compatibility import compatible_lrem
+
 from .base import Queue
+from ..codec import DEFAULT_CODEC_ID, PROTO_OPCODE
+from ..pickling import (encode_item, decode_item, is_encoded_item, payload_stats, validate_compression,
+                        DEFAULT_COMPRESSION_THRESHOLD, PAYLOAD_STATS_KEY)
+
+# Item fields which hold pickles
+PICKLED_FIELDS = ('method', 'object', 'args', 'kwargs', 'error_classes')
+
+def _readable_by_older_consumers(item):
+    if item.get('codec', DEFAULT_CODEC_ID) != DEFAULT_CODEC_ID:
+        return False
+    fields = [item.get(field) for field in PICKLED_FIELDS] + (item.get('metadata') or {}).values()
+    return not any(isinstance(field, bytes) and field.startswith(PROTO_OPCODE) for field in fields)
+
+class DocketsEnvelope(dict):
+    """A popped main queue envelope, which remembers the exact bytes it was
+    stored as. Completing it removes those bytes from the working queue, rather
+    than whichever envelope Dockets' `complete` would pop, so that several
+    threads sharing a worker ID can complete their envelopes in any order."""
+
+    def __init__(self, envelope, serialized_envelope):
+        super(DocketsEnvelope, self).__init__(envelope)
+        self.serialized_envelope = serialized_envelope
+
+class DocketsSerializer(object):
+    """Serializes Dockets envelopes with the Deferrable envelope format if
+    `use_envelopes` is set, and otherwise with the default Dockets JSON
+    serializer, which older consumers read. Either format can be read.
+    Items which older consumers cannot read anyway, because they use a codec
+    other than pickle or hold binary pickles, may not survive JSON, so they
+    are always written as envelopes.
+
+    Dockets wraps main queue items in its own envelope, while error items are
+    serialized directly. Payload stats are recorded on the item in either case."""
+
+    def __init__(self, compression=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, use_envelopes=False):
+        validate_compression(compression, use_envelopes)
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.use_envelopes = use_envelopes
+        self.json_serializer = JsonSerializer()
+
+    @staticmethod
+    def _item(obj):
+        item = obj.get('item')
+        if not isinstance(item, dict):
+            item = obj
+        return item
+
+    def serialize(self, obj):
+        item = self._item(obj)
+        if self.use_envelopes or not _readable_by_older_consumers(item):
+            payload = encode_item(obj, self.compression, self.compression_threshold)
+        else:
+            payload = self.json_serializer.serialize(obj)
+        item[PAYLOAD_STATS_KEY] = payload_stats(payload)
+        return payload
+
+    def deserialize(self, payload):
+        if is_encoded_item(payload):
+            obj = decode_item(payload)
+        else:
+            obj = self.json_serializer.deserialize(payload)
+        self._item(obj)[PAYLOAD_STATS_KEY] = payload_stats(payload)
+        if isinstance(obj.get('item'), dict):
+            return DocketsEnvelope(obj, payload)
+        return obj
+
+class _DocketsPipeline(object):
+    """Wraps a redis-py pipeline to be passed to Dockets methods. Dockets only uses
+    a pipeline it is given if the pipeline is truthy, but redis-py pipelines are
+    falsy until a command has been queued on them, so an empty one would be
+    silently replaced with a pipeline of its own. Everything else is delegated
+    to the pipeline, and `__class__` is reported as the pipeline's so that the
+    isinstance checks in Dockets and redis-py still see it as one."""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    @property
+    def __class__(self):
+        return type(self.pipeline)
+
+    def __nonzero__(self):
+        return True
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+def _pipeline(redis_client):
+    """Returns a pipeline which can be passed to Dockets methods."""
+    return _DocketsPipeline(redis_client.pipeline())
 
 class DocketsQueue(Queue):
-    def __init__(self, redis_client, queue_name, wait_time, timeout):
+    def __init__(self, redis_client, queue_name, wait_time, timeout,
+                 compression=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, use_envelopes=False):
+        self.use_envelopes = use_envelopes
         self.queue = dockets.queue.Queue(redis_client,
                                          queue_name,
                                          use_error_queue=True,
                                          wait_time=wait_time,
-                                         timeout=timeout)
+                                         timeout=timeout,
+                                         serializer=DocketsSerializer(compression, compression_threshold,
+                                                                      use_envelopes))
 
     def make_error_queue(self):
         return DocketsErrorQueue(self.queue)
 
-    def _push(self, item):
+    def _push(self, item, pipeline=None):
         push_kwargs = {}
         if 'delay' in item:
             push_kwargs['delay'] = item['delay'] or None
-        return self.queue.push(item, **push_kwargs)
+        return self.queue.push(item, pipeline=pipeline, **push_kwargs)
 
     def _push_batch(self, items):
+        """Pushes every item in a single pipeline. Items which cannot be serialized
+        fail individually, while a Redis error fails the whole batch."""
         result = []
+        pipeline = _pipeline(self.queue.redis)
         for item in items:
             try:
-                self._push(item)
+                self._push(item, pipeline=pipeline)
                 result.append((item, True))
             except Exception:
                 logging.exception("Error pushing item {}".format(item))
                 result.append((item, False))
+        try:
+            pipeline.execute()
+        except Exception:
+            logging.exception("Error pushing batch to Dockets queue {}".format(self.queue.name))
+            return [(item, False) for item in items]
         return result
 
     def _pop(self):
@@ -42,29 +151,73 @@ class DocketsQueue(Queue):
             return envelope, envelope.get('item')
         return None, None
 
-    def _pop_batch(self, batch_size):
-        batch = []
+    def _pop_available(self, batch_size):
+        """Moves up to `batch_size` envelopes to this worker's working queue without
+        blocking. Due delayed items are moved onto the queue first, all in the same
+        pipeline, mirroring what `dockets.queue.Queue.pop` does for a single item."""
+        dockets_queue = self.queue
+        pipeline = _pipeline(dockets_queue.redis)
+        dockets_queue._move_delayed_items(keys=[dockets_queue._delayed_queue_key(),
+                                                dockets_queue._payload_key(),
+                                                dockets_queue._queue_key()],
+                                          args=[time.time(), dockets_queue.mode == dockets_queue.FIFO],
+                                          client=pipeline)
+        dockets_queue._event_registrar.on_delay_pop(num_popped=None, pipeline=pipeline)
         for _ in range(batch_size):
-            envelope, item = self._pop()
-            if envelope:
-                batch.append((envelope, item))
-            else:
-                break
+            pipeline.rpoplpush(dockets_queue._queue_key(), dockets_queue._working_queue_key())
+        serialized_envelopes = pipeline.execute()[-batch_size:]
+
+        batch = []
+        for serialized_envelope in serialized_envelopes:
+            if not serialized_envelope:
+                continue
+            try:
+                envelope = dockets_queue._serializer.deserialize(serialized_envelope)
+            except Exception:
+                error_pipeline = _pipeline(dockets_queue.redis)
+                dockets_queue.raw_complete(serialized_envelope, pipeline=error_pipeline)
+                dockets_queue._event_registrar.on_operation_error(exc_info=sys.exc_info(), pipeline=error_pipeline)
+                error_pipeline.execute()
+                continue
+            batch.append((envelope, envelope.get('item')))
         return batch
 
+    def _pop_batch(self, batch_size):
+        """Pops whatever is available in one round-trip. Only if nothing is available
+        do we block, for up to the queue's wait time, for the first item."""
+        batch = self._pop_available(batch_size)
+        if batch or int(self.queue._wait_time) <= 0:
+            return batch
+        envelope, item = self._pop()
+        if envelope is None:
+            return []
+        return [(envelope, item)] + (self._pop_available(batch_size - 1) if batch_size > 1 else [])
+
     def _touch(self, envelope, seconds):
         """Dockets heartbeat is consumer-level and does not
         utilize the envelope or seconds arguments."""
         return self.queue._heartbeat()
 
+    def _complete_envelope(self, envelope, pipeline):
+        """Remove the envelope itself from the working queue. Dockets' own `complete`
+        pops the head of the working queue, which is only the right envelope if
+        envelopes are completed in the order they were popped."""
+        serialized_envelope = getattr(envelope, 'serialized_envelope', None)
+        if serialized_envelope is None:
+            return self.queue.complete(envelope, pipeline=pipeline)
+        return compatible_lrem(pipeline, self.queue._working_queue_key(), 1, serialized_envelope)
+
     def _complete(self, envelope):
-        return self.queue.complete(envelope)
+        pipeline = _pipeline(self.queue.redis)
+        self._complete_envelope(envelope, pipeline)
+        return bool(pipeline.execute()[0])
 
     def _complete_batch(self, envelopes):
-        # Dockets doesn't return any information from complete, so here we go...
+        """Each complete succeeds if its envelope was still in the working queue."""
+        pipeline = _pipeline(self.queue.redis)
         for envelope in envelopes:
-            self._complete(envelope)
-        return [(envelope, True) for envelope in envelopes]
+            self._complete_envelope(envelope, pipeline)
+        return [(envelope, bool(response)) for envelope, response in zip(envelopes, pipeline.execute())]
 
     def _flush(self):
         while True:
@@ -78,6 +231,12 @@ class DocketsQueue(Queue):
                 'in_flight': self.queue.working(),
                 'delayed': self.queue.delayed()}
 
+    def _reset_connections(self):
+        self.queue.redis.connection_pool.reset()
+
+# Number of errors fetched per HSCAN when reading or flushing an error queue
+SCAN_BATCH_SIZE = 500
+
 class DocketsErrorQueue(Queue):
     FIFO = False
     SUPPORTS_DELAY = False
@@ -86,7 +245,7 @@ class DocketsErrorQueue(Queue):
     def __init__(self, parent_dockets_queue):
         self.queue = dockets.error_queue.ErrorQueue(parent_dockets_queue)
 
-    def _push(self, item):
+    def _push(self, item, pipeline=None):
         """This error ID dance is Dockets-specific, since we need the ID
         to interface with the hash error queue. Other backends shouldn't
         need to do this and should use the envelope properly instead."""
@@ -96,30 +255,59 @@ class DocketsErrorQueue(Queue):
             logging.warn('No error ID found for item, will generate and add one: {}'.format(item))
             error_id = str(uuid1())
             item.setdefault('error', {})['id'] = error_id
-        return self.queue.queue_error_item(error_id, item)
+        return self.queue.queue_error_item(error_id, item, pipeline=pipeline)
 
     def _push_batch(self, items):
         result = []
+        pipeline = _pipeline(self.queue.redis)
         for item in items:
             try:
-                self._push(item)
+                self._push(item, pipeline=pipeline)
                 result.append((item, True))
             except Exception:
                 logging.exception("Error pushing item {}".format(item))
                 result.append((item, False))
+        try:
+            pipeline.execute()
+        except Exception:
+            logging.exception("Error pushing batch to Dockets error queue {}".format(self.queue.name))
+            return [(item, False) for item in items]
         return result
 
+    def _scan(self, count):
+        """Yields lists of (error_id, serialized error) from the error hash, fetching
+        roughly `count` at a time with HSCAN, so that neither Redis nor we ever
+        have to handle the whole hash at once. Errors deleted while scanning are
+        fine: every error present for the whole scan is yielded at least once."""
+        redis_client = self.queue.redis
+        cursor = 0
+        while True:
+            cursor, errors = redis_client.hscan(self.queue._hash_key(), cursor, count=count)
+            if errors:
+                yield errors.items()
+            if not cursor:
+                return
+
+    def _deserialize(self, serialized_error):
+        return self.queue._serializer.deserialize(serialized_error)
+
+    def iter_errors(self, batch_size=SCAN_BATCH_SIZE):
+        """Yields (envelope, item) tuples for every error in the queue, fetching
+        about `batch_size` of them per round-trip. Errors may be completed while
+        iterating. As with `pop`, nothing is removed until it is completed."""
+        for errors in self._scan(batch_size):
+            for _, serialized_error in errors:
+                error = self._deserialize(serialized_error)
+                yield error, error
+
     def _pop(self):
         """Dockets Error Queues are not actually queues, they're hashes. There's no way
         for us to implement a pure pop that doesn't expose us to the risk of dropping
         data. As such, we're going to return the first error in that hash but not actually
         remove it until we call `_complete` later on. This keeps our data safe but may
         deliver errors multiple times. That should be okay."""
-        error_ids = self.queue.error_ids()
-        if error_ids:
-            error_id = error_ids[0]
-            error = self.queue.error(error_id)
-            return error, error
+        for envelope, item in self.iter_errors(batch_size=1):
+            return envelope, item
         return None, None
 
     def _pop_batch(self, batch_size):
@@ -127,29 +315,39 @@ class DocketsErrorQueue(Queue):
         from our queue.
         Again, this does not actually pop from the queue until we call _complete on
         each queued item"""
-        error_ids = self.queue.error_ids()
-        batch = []
-        if error_ids:
-            for error_id in error_ids[:batch_size]:
-                error = self.queue.error(error_id)
-                batch.append((error, error))
-        return batch
+        return list(islice(self.iter_errors(batch_size=batch_size), batch_size))
 
     def _touch(self, envelope, seconds):
         return None
 
-    def _complete(self, envelope):
+    @staticmethod
+    def _error_id(envelope):
         error_id = envelope['error']['id']
         if not error_id:
             raise AttributeError('Error item has no id field: {}'.format(envelope))
-        return self.queue.delete_error(error_id)
+        return error_id
+
+    def _complete(self, envelope):
+        return self.queue.redis.hdel(self.queue._hash_key(), self._error_id(envelope))
 
     def _complete_batch(self, envelopes):
-        return [(envelope, bool(self._complete(envelope))) for envelope in envelopes]
+        """Deletes every error in one round-trip. Dockets' `delete_error` also calls
+        the main queue's `delete` hook, which is a no-op for the queues we create,
+        so the errors are deleted directly."""
+        error_ids = [self._error_id(envelope) for envelope in envelopes]
+        pipeline = self.queue.redis.pipeline(transaction=False)
+        for error_id in error_ids:
+            pipeline.hdel(self.queue._hash_key(), error_id)
+        return [(envelope, bool(deleted)) for envelope, deleted in zip(envelopes, pipeline.execute())]
 
     def _flush(self):
-        for error_id in self.queue.error_ids():
-            self.queue.delete_error(error_id)
+        """Deletes errors a scan batch at a time, rather than deleting the whole hash
+        at once, which would block Redis for as long as that takes."""
+        for errors in self._scan(SCAN_BATCH_SIZE):
+            self.queue.redis.hdel(self.queue._hash_key(), *[error_id for error_id, _ in errors])
 
     def _stats(self):
         return {'available': self.queue.length()}
+
+    def _reset_connections(self):
+        self.queue.redis.connection_pool.reset()
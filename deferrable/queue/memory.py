@@ -1,93 +1,155 @@
 from __future__ import absolute_import
 
 import time
-import logging
-from Queue import Queue as PythonQueue, PriorityQueue, Empty
+import heapq
+import threading
+from uuid import uuid1
+from itertools import count
+from collections import deque
 
 from .base import Queue
 
-class InMemoryQueue(Queue):
-    """InMemoryQueue does not support reclamation of items that
-    were popped but never completed. Pop is final and complete is a no-op.
+class InMemoryEnvelope(object):
+    """Receipt for a single delivery of an item. Each pop creates a new
+    envelope, so completing a stale envelope for an item which has since
+    been reclaimed and redelivered has no effect."""
+
+    def __init__(self, item, visible_at):
+        self.id = str(uuid1())
+        self.item = item
+        self.visible_at = visible_at
 
-    Really, you probably only want to use this backend for testing."""
+class InMemoryQueue(Queue):
+    """Single-process queue with the same delivery semantics as the
+    networked backends. Delayed items are held in a heap and popped items
+    stay in flight until they are completed. In-flight items which are not
+    completed or touched within `visibility_timeout` seconds are reclaimed
+    to the back of the queue.
 
-    RECLAIMS_TO_BACK_OF_QUEUE = False
+    Blocking pops wait on a condition variable, and wake as soon as an item
+    is pushed or the next delayed or in-flight item becomes due. All
+    operations are safe to call from multiple threads."""
 
-    def __init__(self, group, timeout):
+    def __init__(self, group, timeout, visibility_timeout=30):
         self.group = group
-        self.queue = PythonQueue()
-        self.delay_queue = PriorityQueue()
         self.timeout = timeout
-
-    def _push_to_delay_queue(self, item, delay_seconds):
-        score = time.time() + delay_seconds
-        self.delay_queue.put((score, item))
-
-    def _move_from_delay_queue(self):
-        now = time.time()
-        while True:
-            try:
-                score, item = self.delay_queue.get(block=False)
-                if score < now:
-                    self.queue.put(item)
-                else:
-                    break
-            except Empty:
-                return
-        # If you get to here, you popped something you shouldn't have
-        # because it wasn't time for it to go yet
-        self.delay_queue.put((score, item))
-
-    def _push(self, item):
+        self.visibility_timeout = visibility_timeout
+        self._condition = threading.Condition()
+        # Ties in the heaps are broken by insertion order, never by comparing items
+        self._sequence = count()
+        self._reset()
+
+    def _reset(self):
+        self._available = deque()
+        self._delayed = []
+        self._in_flight = {}
+        # Deadlines of in-flight envelopes. Entries for envelopes which have since been
+        # completed or touched are stale, and are discarded when they reach the top.
+        self._visibility_deadlines = []
+
+    def _promote(self, now):
+        """Move due delayed items and expired in-flight items to the available queue."""
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, item = heapq.heappop(self._delayed)
+            self._available.append(item)
+        while self._visibility_deadlines and self._visibility_deadlines[0][0] <= now:
+            visible_at, _, envelope = heapq.heappop(self._visibility_deadlines)
+            if self._in_flight.get(envelope.id) is envelope and envelope.visible_at == visible_at:
+                del self._in_flight[envelope.id]
+                self._available.append(envelope.item)
+
+    def _next_due(self):
+        due = [heap[0][0] for heap in (self._delayed, self._visibility_deadlines) if heap]
+        return min(due) if due else None
+
+    def _push_unlocked(self, item, now):
         if item.get('delay'):
-            self._push_to_delay_queue(item, item['delay'])
+            heapq.heappush(self._delayed, (now + item['delay'], next(self._sequence), item))
         else:
-            self.queue.put(item)
+            self._available.append(item)
+
+    def _push(self, item):
+        with self._condition:
+            self._push_unlocked(item, time.time())
+            # Wake every waiter, since a new delayed item may be due before the one they are waiting for
+            self._condition.notify_all()
 
     def _push_batch(self, items):
-        result = []
-        for item in items:
-            try:
-                self._push(item)
-                result.append((item, True))
-            except Exception:
-                logging.exception("Error pushing item {}".format(item))
-                result.append((item, False))
-        return result
+        with self._condition:
+            now = time.time()
+            for item in items:
+                self._push_unlocked(item, now)
+            self._condition.notify_all()
+        return [(item, True) for item in items]
+
+    def _deliver(self, now):
+        envelope = InMemoryEnvelope(self._available.popleft(), now + self.visibility_timeout)
+        self._in_flight[envelope.id] = envelope
+        heapq.heappush(self._visibility_deadlines, (envelope.visible_at, next(self._sequence), envelope))
+        return envelope
+
+    def _wait_for_available(self):
+        """Wait up to `timeout` seconds for an item to become available. Must be
+        called with the condition held. Returns the current time."""
+        now = time.time()
+        deadline = now + self.timeout if self.timeout else now
+        while True:
+            self._promote(now)
+            if self._available or now >= deadline:
+                return now
+            next_due = self._next_due()
+            self._condition.wait(min(deadline, next_due) - now if next_due else deadline - now)
+            now = time.time()
 
     def _pop(self):
-        self._move_from_delay_queue()
-        try:
-            result = self.queue.get(block=bool(self.timeout), timeout=self.timeout)
-            return result, result
-        except Empty:
-            return None, None
+        with self._condition:
+            now = self._wait_for_available()
+            if not self._available:
+                return None, None
+            envelope = self._deliver(now)
+            return envelope, envelope.item
 
     def _pop_batch(self, batch_size):
-        batch = []
-        for _ in range(batch_size):
-            envelope, item = self._pop()
-            if envelope:
-                batch.append((envelope, item))
-            else:
-                break
-        return batch
+        """Waits up to `timeout` seconds for the first item, then returns
+        whatever else is available without waiting further."""
+        with self._condition:
+            now = self._wait_for_available()
+            batch = []
+            while self._available and len(batch) < batch_size:
+                envelope = self._deliver(now)
+                batch.append((envelope, envelope.item))
+            return batch
 
     def _touch(self, envelope, seconds):
-        return None
+        with self._condition:
+            if self._in_flight.get(envelope.id) is not envelope:
+                return False
+            envelope.visible_at = time.time() + seconds
+            heapq.heappush(self._visibility_deadlines, (envelope.visible_at, next(self._sequence), envelope))
+            # A waiter may be sleeping until the old deadline, which is harmless
+            return True
+
+    def _complete_unlocked(self, envelope):
+        if self._in_flight.get(envelope.id) is not envelope:
+            return False
+        del self._in_flight[envelope.id]
+        return True
 
     def _complete(self, envelope):
-        return None
+        with self._condition:
+            return self._complete_unlocked(envelope)
 
     def _complete_batch(self, envelopes):
-        return [(envelope, True) for envelope in envelopes]
+        with self._condition:
+            return [(envelope, self._complete_unlocked(envelope)) for envelope in envelopes]
 
     def _flush(self):
-        self.queue = PythonQueue()
-        self.delay_queue = PriorityQueue()
+        with self._condition:
+            self._reset()
 
     def _stats(self):
-        return {'available': self.queue.qsize(),
-                'in_flight': 0,
-                'delayed': self.delay_queue.qsize()}
+        with self._condition:
+            self._promote(time.time())
+            return {'available': len(self._available),
+                    'in_flight': len(self._in_flight),
+                    'delayed': len(self._delayed)}
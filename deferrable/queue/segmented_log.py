@@ -0,0 +1,464 @@
+from __future__ import absolute_import
+
+import os
+import mmap
+import time
+import heapq
+import fcntl
+import struct
+import threading
+from uuid import uuid1
+from itertools import count
+from collections import deque, namedtuple
+
+from .base import Queue
+from ..pickling import (encode_item, decode_item, payload_stats, validate_compression,
+                        DEFAULT_COMPRESSION_THRESHOLD, PAYLOAD_STATS_KEY)
+
+# Each record in a segment is its payload length and the time at which it
+# becomes visible (for delayed items), followed by the encoded item
+RECORD_HEADER = struct.Struct('>Id')
+# Each entry in a segment's ack file is the offset of a completed record
+ACK_ENTRY = struct.Struct('>Q')
+
+SEGMENT_SUFFIX = '.log'
+ACK_SUFFIX = '.ack'
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+SegmentedLogEnvelope = namedtuple('SegmentedLogEnvelope', ['segment', 'offset', 'receipt'])
+
+def _segment_path(directory, segment):
+    return os.path.join(directory, '{:020d}{}'.format(segment, SEGMENT_SUFFIX))
+
+def _ack_path(directory, segment):
+    return os.path.join(directory, '{:020d}{}'.format(segment, ACK_SUFFIX))
+
+def _list_segments(directory):
+    return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                  if name.endswith(SEGMENT_SUFFIX))
+
+class _Writer(object):
+    """Appends records to the newest segment of a log directory. Appends from
+    every process are serialized with an exclusive lock on `write.lock`."""
+
+    def __init__(self, directory, segment_size, fsync):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._lock_file = open(os.path.join(directory, 'write.lock'), 'a')
+        self._segment = None
+        self._file = None
+
+    @property
+    def lock(self):
+        return self._lock
+
+    def lock_all_processes(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def unlock_all_processes(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def append(self, data):
+        with self._lock:
+            self.lock_all_processes()
+            try:
+                self._prepare(len(data))
+                self._file.write(data)
+                self._file.flush()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+            finally:
+                self.unlock_all_processes()
+
+    def _open(self, segment):
+        if self._file:
+            self._file.close()
+        self._segment = segment
+        self._file = open(_segment_path(self.directory, segment), 'ab')
+        self._repair_tail()
+
+    def _repair_tail(self):
+        """Truncate any partial record left at the end of the segment by a crash,
+        so that the records we append can be read."""
+        size = os.fstat(self._file.fileno()).st_size
+        position = 0
+        with open(self._file.name, 'rb') as f:
+            while position + RECORD_HEADER.size <= size:
+                f.seek(position)
+                length, _ = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                if position + RECORD_HEADER.size + length > size:
+                    break
+                position += RECORD_HEADER.size + length
+        if position < size:
+            self._file.truncate(position)
+
+    def _prepare(self, length):
+        # Another process may have flushed the log or rotated to a new segment
+        if self._file is None or os.fstat(self._file.fileno()).st_nlink == 0:
+            segments = _list_segments(self.directory)
+            self._open(segments[-1] if segments else 0)
+        while os.path.exists(_segment_path(self.directory, self._segment + 1)):
+            self._open(self._segment + 1)
+        size = os.fstat(self._file.fileno()).st_size
+        if size and size + length > self.segment_size:
+            self._open(self._segment + 1)
+
+    def reset(self):
+        """Forget the current segment. Must be called with the locks held."""
+        if self._file:
+            self._file.close()
+        self._segment = None
+        self._file = None
+
+    def close(self):
+        self.reset()
+        self._lock_file.close()
+
+class _Segment(object):
+    def __init__(self, directory, number):
+        self.number = number
+        self.path = _segment_path(directory, number)
+        self.ack_path = _ack_path(directory, number)
+        self.read_position = 0
+        self.record_count = 0
+        self.acked = set()
+        if os.path.exists(self.ack_path):
+            with open(self.ack_path, 'rb') as f:
+                data = f.read()
+            # Ignore a partial entry left by a crash
+            for index in xrange(len(data) // ACK_ENTRY.size):
+                self.acked.add(ACK_ENTRY.unpack_from(data, index * ACK_ENTRY.size)[0])
+        self._file = open(self.path, 'rb')
+        self._map = None
+        self._ack_file = None
+
+    def size(self):
+        return os.fstat(self._file.fileno()).st_size
+
+    @property
+    def map(self):
+        """Read-only map of the segment, remapped whenever the segment has grown."""
+        size = self.size()
+        if size and (self._map is None or len(self._map) < size):
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+        return self._map
+
+    def read_payload(self, offset):
+        segment_map = self.map
+        length, _ = RECORD_HEADER.unpack_from(segment_map, offset)
+        start = offset + RECORD_HEADER.size
+        return segment_map[start:start + length]
+
+    def ack(self, offsets):
+        if self._ack_file is None:
+            self._ack_file = open(self.ack_path, 'ab')
+        self._ack_file.write(''.join(ACK_ENTRY.pack(offset) for offset in offsets))
+        self._ack_file.flush()
+        self.acked.update(offsets)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        if self._ack_file is not None:
+            self._ack_file.close()
+        self._file.close()
+
+    def delete(self):
+        self.close()
+        for path in (self.path, self.ack_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+class _Consumer(object):
+    """Delivery state for a log directory. Only one process may consume from a
+    directory at a time, which is enforced with a lock on `consume.lock`. All
+    queue instances for the directory within that process share this state."""
+
+    def __init__(self, directory, writer):
+        self.directory = directory
+        self.writer = writer
+        self._lock_file = open(os.path.join(directory, 'consume.lock'), 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self._lock_file.close()
+            raise RuntimeError('Log {} is already being consumed by another process'.format(directory))
+        self.condition = threading.Condition()
+        self._sequence = count()
+        self._reset()
+
+    def _reset(self):
+        self._segments = {}
+        self._next_segment = None
+        # Record locations are (segment, offset) tuples
+        self._available = deque()
+        self._delayed = []
+        self._in_flight = {}
+        # Stale entries for completed or touched envelopes are discarded when they reach the top
+        self._visibility_deadlines = []
+
+    def _scan(self, now):
+        """Index any records appended since the last scan. Only headers are read."""
+        if self._next_segment is None:
+            segments = _list_segments(self.directory)
+            for number in segments:
+                self._segments[number] = _Segment(self.directory, number)
+            self._next_segment = segments[-1] + 1 if segments else 0
+        while os.path.exists(_segment_path(self.directory, self._next_segment)):
+            self._segments[self._next_segment] = _Segment(self.directory, self._next_segment)
+            self._next_segment += 1
+
+        for number in sorted(self._segments):
+            segment = self._segments[number]
+            size = segment.size()
+            if segment.read_position < size:
+                self._scan_segment(segment, size, now)
+            self._compact(segment)
+
+    def _scan_segment(self, segment, size, now):
+        segment_map = segment.map
+        position = segment.read_position
+        while position + RECORD_HEADER.size <= size:
+            length, visible_at = RECORD_HEADER.unpack_from(segment_map, position)
+            if position + RECORD_HEADER.size + length > size:
+                # The writer has not finished appending this record
+                break
+            segment.record_count += 1
+            if position not in segment.acked:
+                location = (segment.number, position)
+                if visible_at > now:
+                    heapq.heappush(self._delayed, (visible_at, next(self._sequence), location))
+                else:
+                    self._available.append(location)
+            position += RECORD_HEADER.size + length
+        segment.read_position = position
+
+    def _compact(self, segment):
+        """Delete the segment once it is sealed and every record in it has been completed."""
+        sealed = segment.number < self._next_segment - 1
+        if (sealed and segment.read_position == segment.size()
+                and len(segment.acked) == segment.record_count):
+            segment.delete()
+            del self._segments[segment.number]
+
+    def _promote(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, location = heapq.heappop(self._delayed)
+            self._available.append(location)
+        while self._visibility_deadlines and self._visibility_deadlines[0][0] <= now:
+            visible_at, _, envelope = heapq.heappop(self._visibility_deadlines)
+            entry = self._in_flight.get(envelope[:2])
+            if entry and entry[0] == envelope and entry[1] == visible_at:
+                del self._in_flight[envelope[:2]]
+                self._available.append(envelope[:2])
+
+    def _next_due(self):
+        due = [heap[0][0] for heap in (self._delayed, self._visibility_deadlines) if heap]
+        return min(due) if due else None
+
+    def receive(self, batch_size, timeout, visibility_timeout, poll_interval):
+        """Returns a list of (envelope, payload), waiting up to `timeout` seconds for
+        the first record. Records appended by other processes are only noticed when
+        polling, so waits are capped at `poll_interval`."""
+        with self.condition:
+            now = time.time()
+            deadline = now + (timeout or 0)
+            while True:
+                self._scan(now)
+                self._promote(now)
+                if self._available or now >= deadline:
+                    break
+                wait = min(deadline - now, poll_interval)
+                next_due = self._next_due()
+                if next_due is not None:
+                    wait = min(wait, max(next_due - now, 0))
+                self.condition.wait(wait)
+                now = time.time()
+
+            batch = []
+            while self._available and len(batch) < batch_size:
+                location = self._available.popleft()
+                envelope = SegmentedLogEnvelope(location[0], location[1], str(uuid1()))
+                visible_at = now + visibility_timeout
+                self._in_flight[location] = (envelope, visible_at)
+                heapq.heappush(self._visibility_deadlines, (visible_at, next(self._sequence), envelope))
+                batch.append((envelope, self._segments[location[0]].read_payload(location[1])))
+            return batch
+
+    def touch(self, envelope, seconds):
+        with self.condition:
+            entry = self._in_flight.get(envelope[:2])
+            if not entry or entry[0] != envelope:
+                return False
+            visible_at = time.time() + seconds
+            self._in_flight[envelope[:2]] = (envelope, visible_at)
+            heapq.heappush(self._visibility_deadlines, (visible_at, next(self._sequence), envelope))
+            return True
+
+    def complete(self, envelopes):
+        """Returns a list of booleans indicating which envelopes were completed."""
+        with self.condition:
+            results = []
+            acks = {}
+            for envelope in envelopes:
+                entry = self._in_flight.get(envelope[:2])
+                if not entry or entry[0] != envelope:
+                    results.append(False)
+                    continue
+                del self._in_flight[envelope[:2]]
+                acks.setdefault(envelope.segment, []).append(envelope.offset)
+                results.append(True)
+            for number, offsets in acks.iteritems():
+                segment = self._segments[number]
+                segment.ack(offsets)
+                self._compact(segment)
+            return results
+
+    def stats(self):
+        with self.condition:
+            now = time.time()
+            self._scan(now)
+            self._promote(now)
+            return {'available': len(self._available),
+                    'in_flight': len(self._in_flight),
+                    'delayed': len(self._delayed)}
+
+    def flush(self):
+        """Delete every segment in the log, including any being appended to by other processes."""
+        with self.condition, self.writer.lock:
+            self.writer.lock_all_processes()
+            try:
+                for segment in self._segments.itervalues():
+                    segment.close()
+                for name in os.listdir(self.directory):
+                    if name.endswith(SEGMENT_SUFFIX) or name.endswith(ACK_SUFFIX):
+                        os.remove(os.path.join(self.directory, name))
+                self.writer.reset()
+                self._reset()
+            finally:
+                self.writer.unlock_all_processes()
+
+    def close(self):
+        for segment in self._segments.itervalues():
+            segment.close()
+        self._lock_file.close()
+
+# Writers and consumers are shared by every queue instance for the same
+# directory within a process, keyed by the directory's real path
+_registry_lock = threading.Lock()
+_writers = {}
+_consumers = {}
+
+class SegmentedLogQueue(Queue):
+    """File-backed queue for a single host. Items are appended to segment
+    files, and read back through a memory map of each segment. Completed
+    items are recorded in a small ack file alongside each segment, and
+    segments are deleted once they have been rotated out and every item in
+    them has been completed.
+
+    Any number of processes may push to the same log directory, but only
+    one process at a time may pop from it. Within that process, any number
+    of threads may pop. Delayed items, in-flight items and their visibility
+    timeouts are tracked in the consuming process's memory, so after a
+    restart every item which was not completed is delivered again.
+
+    By default appends are flushed to the OS but not fsynced, so items
+    survive a crash of the process but not of the host. Set `fsync=True`
+    to trade throughput for durability."""
+
+    def __init__(self, directory, timeout, visibility_timeout=30, poll_interval=0.05,
+                 segment_size=DEFAULT_SEGMENT_SIZE, fsync=False,
+                 compression=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        validate_compression(compression)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = os.path.realpath(directory)
+        self.timeout = timeout
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
+    @property
+    def writer(self):
+        with _registry_lock:
+            if self.directory not in _writers:
+                _writers[self.directory] = _Writer(self.directory, self.segment_size, self.fsync)
+            return _writers[self.directory]
+
+    @property
+    def consumer(self):
+        writer = self.writer
+        with _registry_lock:
+            if self.directory not in _consumers:
+                _consumers[self.directory] = _Consumer(self.directory, writer)
+            return _consumers[self.directory]
+
+    def _encode_record(self, item, now):
+        payload = encode_item(item, self.compression, self.compression_threshold)
+        item[PAYLOAD_STATS_KEY] = payload_stats(payload)
+        return RECORD_HEADER.pack(len(payload), now + (item.get('delay') or 0)) + payload
+
+    def _decode(self, payload):
+        item = decode_item(payload)
+        item[PAYLOAD_STATS_KEY] = payload_stats(payload)
+        return item
+
+    def _wake_consumer(self):
+        consumer = _consumers.get(self.directory)
+        if consumer is not None:
+            with consumer.condition:
+                consumer.condition.notify_all()
+
+    def _push(self, item):
+        self.writer.append(self._encode_record(item, time.time()))
+        self._wake_consumer()
+
+    def _push_batch(self, items):
+        now = time.time()
+        self.writer.append(''.join(self._encode_record(item, now) for item in items))
+        self._wake_consumer()
+        return [(item, True) for item in items]
+
+    def _receive(self, batch_size):
+        batch = self.consumer.receive(batch_size, self.timeout, self.visibility_timeout, self.poll_interval)
+        return [(envelope, self._decode(payload)) for envelope, payload in batch]
+
+    def _pop(self):
+        batch = self._receive(1)
+        if not batch:
+            return None, None
+        return batch[0]
+
+    def _pop_batch(self, batch_size):
+        return self._receive(batch_size)
+
+    def _touch(self, envelope, seconds):
+        return self.consumer.touch(envelope, seconds)
+
+    def _complete(self, envelope):
+        return self.consumer.complete([envelope])[0]
+
+    def _complete_batch(self, envelopes):
+        return zip(envelopes, self.consumer.complete(envelopes))
+
+    def _flush(self):
+        self.consumer.flush()
+
+    def _stats(self):
+        return self.consumer.stats()
+
+    def _reset_connections(self):
+        """Drop the writer and consumer state inherited from a parent process.
+        The parent keeps its consume lock, so a forked child may push but not pop."""
+        with _registry_lock:
+            for registry in (_consumers, _writers):
+                state = registry.pop(self.directory, None)
+                if state is not None:
+                    state.close()
@@ -0,0 +1,226 @@
+from __future__ import absolute_import
+
+import time
+import logging
+import sqlite3
+import threading
+from uuid import uuid1
+from collections import namedtuple
+from contextlib import contextmanager
+
+from .base import Queue
+from ..pickling import (encode_item, decode_item, payload_stats, validate_compression,
+                        DEFAULT_COMPRESSION_THRESHOLD, PAYLOAD_STATS_KEY)
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS deferrable_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        queue TEXT NOT NULL,
+        payload BLOB NOT NULL,
+        visible_at REAL NOT NULL,
+        receipt TEXT
+    )""",
+    """CREATE INDEX IF NOT EXISTS deferrable_items_queue_visible_at
+        ON deferrable_items (queue, visible_at)"""
+]
+
+# Each delivery of an item gets a new receipt, so that a consumer holding
+# an envelope from before its item was reclaimed cannot complete or touch it
+SQLiteEnvelope = namedtuple('SQLiteEnvelope', ['id', 'receipt'])
+
+class SQLiteQueue(Queue):
+    """Durable queue stored in a SQLite database, which may be shared by any
+    number of processes on the same host. Each item is a row whose
+    `visible_at` is pushed into the future while it is delayed or in flight.
+    In-flight items which are not completed or touched before their
+    visibility timeout expires are redelivered.
+
+    The database runs in WAL mode so that readers do not block the writer.
+    Every operation, including batch operations, is a single transaction.
+    Blocking pops poll the database every `poll_interval` seconds, since
+    SQLite cannot notify other processes of new items.
+
+    Rows which cannot be decoded are logged and moved to the
+    `undecodable_queue_name` queue in the same database, so that they are
+    not redelivered to every consumer but can still be inspected."""
+
+    # Reclaimed items keep their original position in the queue
+    RECLAIMS_TO_BACK_OF_QUEUE = False
+
+    MAX_PUSH_BATCH_SIZE = 500
+    MAX_POP_BATCH_SIZE = 500
+    MAX_COMPLETE_BATCH_SIZE = 500
+
+    def __init__(self, path, queue_name, timeout, visibility_timeout=30, poll_interval=0.1,
+                 compression=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        validate_compression(compression)
+        self.path = path
+        self.queue_name = queue_name
+        self.timeout = timeout
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.undecodable_queue_name = '{}_undecodable'.format(queue_name)
+
+        # sqlite3 connections cannot be shared between threads
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Transactions are managed explicitly in `_transaction`
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                connection.execute(statement)
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """Takes the write lock up front, so that concurrent poppers
+        cannot select the same rows."""
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _encode(self, item):
+        payload = encode_item(item, self.compression, self.compression_threshold)
+        item[PAYLOAD_STATS_KEY] = payload_stats(payload)
+        return sqlite3.Binary(payload)
+
+    def _decode(self, payload):
+        payload = str(payload)
+        item = decode_item(payload)
+        item[PAYLOAD_STATS_KEY] = payload_stats(payload)
+        return item
+
+    def _push_batch(self, items):
+        now = time.time()
+        rows = [(self.queue_name, self._encode(item), now + (item.get('delay') or 0)) for item in items]
+        try:
+            with self._transaction() as connection:
+                connection.executemany('INSERT INTO deferrable_items (queue, payload, visible_at) VALUES (?, ?, ?)', rows)
+        except sqlite3.Error:
+            logging.exception("Error pushing batch to SQLite queue {}".format(self.queue_name))
+            return [(item, False) for item in items]
+        return [(item, True) for item in items]
+
+    def _push(self, item):
+        with self._transaction() as connection:
+            connection.execute('INSERT INTO deferrable_items (queue, payload, visible_at) VALUES (?, ?, ?)',
+                               (self.queue_name, self._encode(item), time.time() + (item.get('delay') or 0)))
+
+    def _receive(self, batch_size):
+        now = time.time()
+        with self._transaction() as connection:
+            rows = connection.execute('SELECT id, payload FROM deferrable_items '
+                                      'WHERE queue = ? AND visible_at <= ? ORDER BY id LIMIT ?',
+                                      (self.queue_name, now, batch_size)).fetchall()
+            envelopes = [SQLiteEnvelope(row_id, str(uuid1())) for row_id, _ in rows]
+            connection.executemany('UPDATE deferrable_items SET receipt = ?, visible_at = ? WHERE id = ?',
+                                   [(envelope.receipt, now + self.visibility_timeout, envelope.id)
+                                    for envelope in envelopes])
+
+        batch, undecodable = [], []
+        for envelope, (_, payload) in zip(envelopes, rows):
+            try:
+                batch.append((envelope, self._decode(payload)))
+            except Exception:
+                logging.exception("Error decoding item {} in SQLite queue {}, moving it to {}".format(
+                    envelope.id, self.queue_name, self.undecodable_queue_name))
+                undecodable.append(envelope)
+        if undecodable:
+            self._move_undecodable(undecodable)
+        return batch
+
+    def _move_undecodable(self, envelopes):
+        try:
+            with self._transaction() as connection:
+                connection.executemany('UPDATE deferrable_items SET queue = ?, receipt = NULL WHERE id = ? AND receipt = ?',
+                                       [(self.undecodable_queue_name, envelope.id, envelope.receipt)
+                                        for envelope in envelopes])
+        except sqlite3.Error:
+            # They will be redelivered, and moved again, after their visibility timeout
+            logging.exception("Error moving undecodable items in SQLite queue {}".format(self.queue_name))
+
+    def _seconds_until_next_visible(self):
+        next_visible_at, = self.connection.execute('SELECT MIN(visible_at) FROM deferrable_items WHERE queue = ?',
+                                                   (self.queue_name,)).fetchone()
+        return None if next_visible_at is None else next_visible_at - time.time()
+
+    def _receive_with_timeout(self, batch_size):
+        deadline = time.time() + (self.timeout or 0)
+        while True:
+            batch = self._receive(batch_size)
+            remaining = deadline - time.time()
+            if batch or remaining <= 0:
+                return batch
+            # Sleep no longer than it takes for the next delayed or in-flight item to become visible
+            next_visible = self._seconds_until_next_visible()
+            wait = min(self.poll_interval, remaining)
+            if next_visible is not None:
+                wait = min(wait, max(next_visible, 0))
+            time.sleep(wait)
+
+    def _pop(self):
+        batch = self._receive_with_timeout(1)
+        if not batch:
+            return None, None
+        return batch[0]
+
+    def _pop_batch(self, batch_size):
+        return self._receive_with_timeout(batch_size)
+
+    def _touch(self, envelope, seconds):
+        with self._transaction() as connection:
+            cursor = connection.execute('UPDATE deferrable_items SET visible_at = ? WHERE id = ? AND receipt = ?',
+                                        (time.time() + seconds, envelope.id, envelope.receipt))
+        return cursor.rowcount == 1
+
+    def _complete(self, envelope):
+        with self._transaction() as connection:
+            cursor = connection.execute('DELETE FROM deferrable_items WHERE id = ? AND receipt = ?',
+                                        (envelope.id, envelope.receipt))
+        return cursor.rowcount == 1
+
+    def _complete_batch(self, envelopes):
+        result = []
+        try:
+            with self._transaction() as connection:
+                for envelope in envelopes:
+                    cursor = connection.execute('DELETE FROM deferrable_items WHERE id = ? AND receipt = ?',
+                                                (envelope.id, envelope.receipt))
+                    result.append((envelope, cursor.rowcount == 1))
+        except sqlite3.Error:
+            logging.exception("Error completing batch in SQLite queue {}".format(self.queue_name))
+            return [(envelope, False) for envelope in envelopes]
+        return result
+
+    def _flush(self):
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM deferrable_items WHERE queue = ?', (self.queue_name,))
+
+    def _stats(self):
+        now = time.time()
+        available, in_flight, delayed = self.connection.execute(
+            'SELECT '
+            'COALESCE(SUM(visible_at <= ?), 0), '
+            'COALESCE(SUM(visible_at > ? AND receipt IS NOT NULL), 0), '
+            'COALESCE(SUM(visible_at > ? AND receipt IS NULL), 0) '
+            'FROM deferrable_items WHERE queue = ?', (now, now, now, self.queue_name)).fetchone()
+        return {'available': available,
+                'in_flight': in_flight,
+                'delayed': delayed}
+
+    def _reset_connections(self):
+        # Connections must not be used across a fork, so drop them without closing
+        self._local = threading.local()
@@ -1,29 +1,228 @@
 from __future__ import absolute_import
 
+import sys
+import time
+import logging
+import threading
 from uuid import uuid1
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+import base64
 import json
 
-from boto.sqs.message import Message
+from boto.sqs.message import RawMessage
 
 from .base import Queue
-from ..pickling import dumps, loads
+from ..pickling import (dumps, encode_item, decode_item, payload_stats, validate_compression,
+                        DEFAULT_COMPRESSION_THRESHOLD, PAYLOAD_STATS_KEY)
+
+class EnvelopeMessage(RawMessage):
+    """SQS message bodies must be text, so the binary envelope is base64-encoded
+    on the wire. Bodies written by older versions through boto's default `Message`
+    class were base64-encoded in the same way and decode to their legacy format,
+    which is also what is written unless the queue has `use_envelopes` set."""
+
+    def encode(self, value):
+        return base64.b64encode(value)
+
+    def decode(self, value):
+        return base64.b64decode(value)
+
+# How long a prefetch thread sleeps after an error receiving from SQS
+PREFETCH_ERROR_SLEEP_SECONDS = 1
+# Long poll used by prefetch threads when the queue has no wait time of its own
+PREFETCH_WAIT_SECONDS = 20
+
+# Limits on a single SendMessageBatch request
+SEND_BATCH_MAX_MESSAGES = 10
+SEND_BATCH_MAX_BYTES = 256 * 1024
+
+def _send_batch_chunks(entries):
+    """Split (id, body, delay) entries into chunks which fit in a single
+    SendMessageBatch request, preserving their order."""
+    chunks = []
+    chunk, chunk_bytes = [], 0
+    for entry in entries:
+        if chunk and (len(chunk) == SEND_BATCH_MAX_MESSAGES or chunk_bytes + len(entry[1]) > SEND_BATCH_MAX_BYTES):
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append(entry)
+        chunk_bytes += len(entry[1])
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+class SQSPrefetcher(object):
+    """Keeps up to `buffer_size` messages received ahead of time for an
+    `SQSQueue`, so that pops are served from memory instead of waiting on a
+    receive. Background threads, each with its own connection, keep receives
+    in flight whenever there is room in the buffer.
+
+    A message's visibility timeout starts when it is received, so messages
+    are never handed out once they have been buffered for `max_age` seconds.
+    They are released back to SQS instead, so another consumer can take them."""
+
+    def __init__(self, sqs_queue, buffer_size, threads, max_age):
+        self.sqs_queue = sqs_queue
+        self.buffer_size = buffer_size
+        self.threads = threads
+        self.max_age = max_age
+        # (message, time its receive was requested) in the order received
+        self._buffer = deque()
+        # Slots claimed by receives which are in progress
+        self._reserved = 0
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopping = False
+
+    def _start(self):
+        """Must be called with the condition held."""
+        if self._threads:
+            return
+        for index in range(self.threads):
+            thread = threading.Thread(target=self._run, name='deferrable-sqs-prefetch-{}'.format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _take_stale(self, now):
+        """Remove and return buffered messages which are too old to hand out.
+        Must be called with the condition held."""
+        if not any(now - received_at > self.max_age for _, received_at in self._buffer):
+            return []
+        stale = [message for message, received_at in self._buffer if now - received_at > self.max_age]
+        self._buffer = deque(entry for entry in self._buffer if now - entry[1] <= self.max_age)
+        self._condition.notify_all()
+        return stale
+
+    def _release(self, queue, messages):
+        for index in xrange(0, len(messages), SEND_BATCH_MAX_MESSAGES):
+            chunk = messages[index:index + SEND_BATCH_MAX_MESSAGES]
+            try:
+                queue.connection.change_message_visibility_batch(queue, [(message, 0) for message in chunk])
+            except Exception:
+                logging.exception("Error releasing {} prefetched messages".format(len(chunk)))
+
+    def _run(self):
+        queue = None
+        while True:
+            with self._condition:
+                stale = []
+                while not self._stopping and len(self._buffer) + self._reserved >= self.buffer_size:
+                    # Wake up in time to release messages before they go stale in the buffer
+                    self._condition.wait(self.max_age / 2.0)
+                    stale.extend(self._take_stale(time.time()))
+                stopping = self._stopping
+                if not stopping:
+                    count = min(SEND_BATCH_MAX_MESSAGES, self.buffer_size - len(self._buffer) - self._reserved)
+                    self._reserved += count
+            if stopping:
+                if stale:
+                    self._release(self.sqs_queue.queue, stale)
+                return
+
+            messages = []
+            requested_at = time.time()
+            try:
+                queue = queue or self.sqs_queue._get_queue_instance(self.sqs_queue.sqs_connection_thunk())
+                if stale:
+                    self._release(queue, stale)
+                # Always long poll, so that idle threads do not spin against an empty queue
+                messages = queue.get_messages(num_messages=count,
+                                              visibility_timeout=self.sqs_queue.visibility_timeout,
+                                              wait_time_seconds=self.sqs_queue.wait_time or PREFETCH_WAIT_SECONDS)
+            except Exception:
+                logging.exception("Error prefetching from SQS queue {}".format(self.sqs_queue.queue_name))
+                time.sleep(PREFETCH_ERROR_SLEEP_SECONDS)
+
+            with self._condition:
+                self._reserved -= count
+                stopped = self._stopping
+                if not stopped:
+                    self._buffer.extend((message, requested_at) for message in messages)
+                self._condition.notify_all()
+            if stopped and messages:
+                self._release(queue, messages)
+
+    def take(self, batch_size, timeout):
+        """Returns up to `batch_size` messages, waiting up to `timeout` seconds for
+        the first one."""
+        with self._condition:
+            self._start()
+            now = time.time()
+            deadline = now + (timeout or 0)
+            stale = []
+            while True:
+                stale.extend(self._take_stale(now))
+                if self._buffer or self._stopping or now >= deadline:
+                    break
+                self._condition.wait(deadline - now)
+                now = time.time()
+            batch = [self._buffer.popleft()[0] for _ in range(min(batch_size, len(self._buffer)))]
+            if batch:
+                self._condition.notify_all()
+        if stale:
+            self._release(self.sqs_queue.queue, stale)
+        return batch
+
+    def clear(self):
+        """Forget buffered messages, e.g. because the queue was purged."""
+        with self._condition:
+            self._buffer.clear()
+            self._condition.notify_all()
+
+    def stop(self):
+        """Stop receiving and release any buffered messages back to SQS. Receives
+        which are in progress finish in the background, and release whatever
+        they receive."""
+        with self._condition:
+            self._stopping = True
+            messages = [message for message, _ in self._buffer]
+            self._buffer.clear()
+            self._condition.notify_all()
+        if messages:
+            self._release(self.sqs_queue.queue, messages)
 
 class SQSQueue(Queue):
     FIFO = False
-    MAX_PUSH_BATCH_SIZE = 10
+    # Batches are split into as many SendMessageBatch requests as they need
+    MAX_PUSH_BATCH_SIZE = sys.maxint
     MAX_POP_BATCH_SIZE = 10
     MAX_COMPLETE_BATCH_SIZE = 10
 
-    def __init__(self, sqs_connection_thunk, queue_name, visibility_timeout, wait_time, redrive_queue=None):
+    def __init__(self, sqs_connection_thunk, queue_name, visibility_timeout, wait_time, redrive_queue=None,
+                 compression=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, use_envelopes=False,
+                 push_concurrency=4, push_retries=3, push_retry_delay=0.1,
+                 prefetch=0, prefetch_threads=1, prefetch_max_age=None):
+        """If `prefetch` is set, up to that many messages are received ahead of time
+        by `prefetch_threads` background threads, and pops are served from them.
+        Prefetched messages are released rather than popped once they have been
+        held for `prefetch_max_age` seconds, which defaults to a quarter of the
+        visibility timeout, or of the queue's own if `visibility_timeout` is None.
+        See `SQSPrefetcher`."""
+        validate_compression(compression, use_envelopes)
         self.sqs_connection_thunk = sqs_connection_thunk
         self.queue_name = queue_name
         self.visibility_timeout = visibility_timeout
         self.wait_time = wait_time
         self.redrive_queue = redrive_queue
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.use_envelopes = use_envelopes
+        self.push_concurrency = push_concurrency
+        self.push_retries = push_retries
+        self.push_retry_delay = push_retry_delay
 
         self._sqs_connection = None
         self._queue = None
+        self._push_pool = None
+        # boto connections are not thread-safe, so each push thread gets its own
+        self._push_local = threading.local()
+
+        self.prefetch = prefetch
+        self.prefetch_threads = prefetch_threads
+        self.prefetch_max_age = prefetch_max_age
+        self._prefetcher = None
 
     @property
     def sqs_connection(self):
@@ -37,18 +236,32 @@ class SQSQueue(Queue):
             self._queue = self._get_queue_instance()
         return self._queue
 
-    def _get_queue_instance(self):
-        instance = self.sqs_connection.get_queue(self.queue_name)
+    @property
+    def push_pool(self):
+        if self._push_pool is None:
+            self._push_pool = ThreadPool(self.push_concurrency)
+        return self._push_pool
+
+    def _push_thread_queue(self):
+        queue = getattr(self._push_local, 'queue', None)
+        if queue is None:
+            queue = self._push_local.queue = self._get_queue_instance(self.sqs_connection_thunk())
+        return queue
+
+    def _get_queue_instance(self, sqs_connection=None):
+        sqs_connection = sqs_connection or self.sqs_connection
+        instance = sqs_connection.get_queue(self.queue_name)
 
         # Create queue if it doesn't exist yet and we passed that option to the constructor
         if instance is None:
-            instance = self.sqs_connection.create_queue(self.queue_name, visibility_timeout=self.visibility_timeout)
+            instance = sqs_connection.create_queue(self.queue_name, visibility_timeout=self.visibility_timeout)
             if self.redrive_queue:
                 policy = json.dumps({'maxReceiveCount': 5, 'deadLetterTargetArn': self.redrive_queue.queue.arn})
                 instance.set_attribute('RedrivePolicy', policy)
 
         if not instance:
             raise ValueError('No queue found with name {}'.format(self.queue_name))
+        instance.set_message_class(EnvelopeMessage)
         return instance
 
     def _slow_flush(self):
@@ -64,39 +277,126 @@ class SQSQueue(Queue):
                 break
         self.wait_time = stored_wait_time
 
+    def _encode(self, item):
+        if self.use_envelopes:
+            payload = encode_item(item, self.compression, self.compression_threshold)
+        else:
+            payload = dumps(item, legacy=True)
+        item[PAYLOAD_STATS_KEY] = payload_stats(payload)
+        return payload
+
+    def _decode(self, message):
+        payload = message.get_body()
+        item = decode_item(payload)
+        item[PAYLOAD_STATS_KEY] = payload_stats(payload)
+        return item
+
     def _push(self, item):
-        message = Message()
-        message.set_body(dumps(item))
+        message = EnvelopeMessage()
+        message.set_body(self._encode(item))
         return self.queue.write(message, delay_seconds=item.get('delay') or None)
 
     def _push_batch(self, items):
+        """Pushes any number of items, split into as few SendMessageBatch requests
+        as SQS allows. Requests are sent concurrently from a pool of
+        `push_concurrency` threads, and failed entries are retried up to
+        `push_retries` times with exponential backoff."""
         id_map = OrderedDict()
-        payloads = []
+        entries = []
+        results = {}
         for item in items:
-            message = Message()
-            message.set_body(dumps(item))
+            message = EnvelopeMessage()
+            message.set_body(self._encode(item))
             new_message_id = str(uuid1())
             id_map[new_message_id] = item
-            payloads.append((new_message_id, message.get_body_encoded(), item.get('delay') or 0))
-        response = self.queue.write_batch(payloads)
-        success_ids = {success['id'] for success in response.results}
-        return [(item, item_id in success_ids)
+            body = message.get_body_encoded()
+            if len(body) > SEND_BATCH_MAX_BYTES:
+                logging.error("Item is too large to push to SQS ({} bytes): {}".format(len(body), item))
+                results[new_message_id] = False
+                continue
+            entries.append((new_message_id, body, item.get('delay') or 0))
+
+        chunks = _send_batch_chunks(entries)
+        if len(chunks) > 1:
+            chunk_results = self.push_pool.map(lambda chunk: self._send_batch_chunk(self._push_thread_queue(), chunk),
+                                               chunks)
+        else:
+            chunk_results = [self._send_batch_chunk(self.queue, chunk) for chunk in chunks]
+        for chunk_result in chunk_results:
+            results.update(chunk_result)
+        return [(item, results[item_id])
                 for item_id, item in id_map.iteritems()]
 
+    def _send_batch_chunk(self, queue, entries):
+        """Returns a dict of {entry id: success}. Entries which SQS rejects as
+        the sender's fault (e.g. an invalid delay) are not retried."""
+        results = {}
+        for attempt in xrange(self.push_retries + 1):
+            if attempt:
+                time.sleep(self.push_retry_delay * 2 ** (attempt - 1))
+            try:
+                response = queue.write_batch(entries)
+            except Exception:
+                logging.exception("Error pushing batch of {} items to SQS queue {}".format(len(entries), self.queue_name))
+                continue
+            for success in response.results:
+                results[success['id']] = True
+            retry_ids = set()
+            for failure in response.errors:
+                if failure.get('sender_fault') == 'true':
+                    logging.error("SQS rejected item: {}".format(failure.get('error_message')))
+                    results[failure['id']] = False
+                else:
+                    retry_ids.add(failure['id'])
+            entries = [entry for entry in entries if entry[0] in retry_ids]
+            if not entries:
+                break
+        for entry in entries:
+            results[entry[0]] = False
+        return results
+
+    @property
+    def prefetcher(self):
+        if self._prefetcher is None:
+            if self.prefetch_max_age is None:
+                self.prefetch_max_age = self._effective_visibility_timeout() / 4.0
+            self._prefetcher = SQSPrefetcher(self, self.prefetch, self.prefetch_threads, self.prefetch_max_age)
+        return self._prefetcher
+
+    def _effective_visibility_timeout(self):
+        """The visibility timeout SQS applies to our receives, which is the queue's
+        own if we do not give one."""
+        if self.visibility_timeout is not None:
+            return self.visibility_timeout
+        return int(self.queue.get_attributes('VisibilityTimeout')['VisibilityTimeout'])
+
+    def stop_prefetch(self):
+        """Stop prefetching and release any prefetched messages, e.g. before the
+        consumer shuts down. Prefetching starts again on the next pop."""
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
+
     def _pop(self):
+        if self.prefetch:
+            batch = self._pop_batch(1)
+            return batch[0] if batch else (None, None)
         message = self.queue.read(visibility_timeout=self.visibility_timeout,
                                   wait_time_seconds=self.wait_time)
         if not message:
             return None, None
-        return message, loads(message.get_body())
+        return message, self._decode(message)
 
     def _pop_batch(self, batch_size):
-        messages = self.queue.get_messages(num_messages=batch_size,
-                                           visibility_timeout=self.visibility_timeout,
-                                           wait_time_seconds=self.wait_time)
+        if self.prefetch:
+            messages = self.prefetcher.take(batch_size, self.wait_time)
+        else:
+            messages = self.queue.get_messages(num_messages=batch_size,
+                                               visibility_timeout=self.visibility_timeout,
+                                               wait_time_seconds=self.wait_time)
         batch = []
         for message in messages:
-            batch.append((message, loads(message.get_body())))
+            batch.append((message, self._decode(message)))
         return batch
 
     def _touch(self, envelope, seconds):
@@ -118,6 +418,17 @@ class SQSQueue(Queue):
 
     def _flush(self):
         self.sqs_connection.purge_queue(self.queue)
+        if self._prefetcher is not None:
+            self._prefetcher.clear()
+
+    def _reset_connections(self):
+        self._sqs_connection = None
+        self._queue = None
+        # The pool's threads do not survive a fork
+        self._push_pool = None
+        self._push_local = threading.local()
+        # Prefetched messages belong to the parent, which still has them buffered
+        self._prefetcher = None
 
     def _stats(self):
         attributes = self.queue.get_attributes()
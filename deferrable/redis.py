@@ -2,7 +2,7 @@ from pkg_resources import resource_string
 
 from attrdict import AttrDict
 
-LUA_SCRIPTS = ['get_debounce_keys', 'set_debounce_keys']
+LUA_SCRIPTS = ['get_debounce_keys', 'set_debounce_keys', 'debounce']
 
 def initialize_redis_client(redis_client):
     if not redis_client:
@@ -0,0 +1,301 @@
+"""Redrive moves items from a backend's error queue back onto its main
+queue, for example once a downstream outage is over. The error queue is
+read a batch at a time, and each batch of matching items is pushed with
+`push_batch` and then completed on the error queue with `complete_batch`.
+Several batches are pushed concurrently, optionally subject to a rate
+limit. Redriven items start again from their first attempt, and with their
+full TTL.
+
+Items are only completed on the error queue once they have been pushed, so
+an interrupted redrive can simply be run again. On brokers where popping
+an error hides it (everything but Dockets), items which are scanned but
+not redriven are made visible again once the scan is finished. If a scan
+outlasts the error queue's visibility timeout, those items become visible
+again during it. Each error is only considered once per scan, and the scan
+ends once a batch contains only errors it has already seen.
+
+From the command line, pass an importable `module:attribute` which is a
+`BackendFactory`, or a callable returning one:
+
+    python -m deferrable.redrive myapp.queues:backend_factory --group emails \\
+        --error-type TimeoutError --since 2026-10-16T09:00 --dry-run
+"""
+
+import sys
+import time
+import logging
+import argparse
+import calendar
+import threading
+from datetime import datetime
+from itertools import islice
+from importlib import import_module
+from multiprocessing.pool import ThreadPool
+
+from .pickling import method_name
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_CONCURRENCY = 4
+
+class ErrorFilter(object):
+    def __init__(self, error_types=None, method_names=None, groups=None, since=None, until=None):
+        """Matches error items on every criterion which is given.
+
+        - error_types: Exception class names, as in the item's `error.error_type`.
+        - method_names: Module-qualified method names, e.g. 'myapp.tasks.send_email'.
+        - groups: Groups the items were originally pushed to.
+        - since, until: Bounds, in epoch seconds, on when the item errored.
+        """
+        self.error_types = set(error_types) if error_types else None
+        self.method_names = set(method_names) if method_names else None
+        self.groups = set(groups) if groups else None
+        self.since = since
+        self.until = until
+
+    def matches(self, item):
+        error = item.get('error') or {}
+        if self.error_types is not None and error.get('error_type') not in self.error_types:
+            return False
+        if self.groups is not None and item.get('group') not in self.groups:
+            return False
+        if self.since is not None and error.get('ts', 0) < self.since:
+            return False
+        if self.until is not None and error.get('ts', 0) >= self.until:
+            return False
+        # Checked last, since it may need to unpickle the method
+        if self.method_names is not None and method_name(item) not in self.method_names:
+            return False
+        return True
+
+class RateLimiter(object):
+    """Thread-safe limit on the number of items processed per second."""
+
+    def __init__(self, items_per_second):
+        self.interval = 1.0 / items_per_second
+        self._next_time = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, count):
+        """Reserve `count` items' worth of time, sleeping until it arrives."""
+        with self._lock:
+            now = time.time()
+            start = max(self._next_time, now)
+            self._next_time = start + count * self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def _iter_error_batches(error_queue, batch_size):
+    """Yields lists of (envelope, item) covering the whole error queue once."""
+    if hasattr(error_queue, 'iter_errors'):
+        # Error queues which do not hide popped items, like Dockets', would otherwise
+        # return the same items forever if any of them are not completed
+        errors = error_queue.iter_errors(batch_size=batch_size)
+        while True:
+            batch = list(islice(errors, batch_size))
+            if not batch:
+                return
+            yield batch
+    else:
+        while True:
+            batch = error_queue.pop_batch(batch_size)
+            if not batch:
+                return
+            yield batch
+
+def _error_id(item):
+    return (item.get('error') or {}).get('id')
+
+def _redriven_item(item):
+    """Copy of the item ready to run again. The error is dropped from the copy only,
+    since some error queues need it to complete the original. Its TTL starts again,
+    since it would otherwise be dropped unrun once its original deadline had passed."""
+    redriven = dict(item)
+    redriven.pop('error', None)
+    now = time.time()
+    redriven['attempts'] = 0
+    redriven['last_push_time'] = now
+    if redriven.get('ttl_seconds'):
+        redriven['item_queued_timestamp'] = now
+    return redriven
+
+class Redrive(object):
+    def __init__(self, backend, error_filter=None, batch_size=DEFAULT_BATCH_SIZE, concurrency=DEFAULT_CONCURRENCY,
+                 items_per_second=None, limit=None, dry_run=False):
+        """
+        - error_filter: An `ErrorFilter`. By default every error is redriven.
+        - batch_size: Items per push and complete, capped at the queues' batch limits.
+        - concurrency: Number of batches pushed and completed at once.
+        - items_per_second: Optional limit on the rate at which items are pushed.
+        - limit: Optional maximum number of items to redrive.
+        - dry_run: Only count the matching items, without pushing or completing anything.
+        """
+        self.backend = backend
+        self.error_filter = error_filter or ErrorFilter()
+        self.batch_size = min(batch_size,
+                              backend.error_queue.MAX_POP_BATCH_SIZE,
+                              backend.error_queue.MAX_COMPLETE_BATCH_SIZE,
+                              backend.queue.MAX_PUSH_BATCH_SIZE)
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(items_per_second) if items_per_second else None
+        self.limit = limit
+        self.dry_run = dry_run
+
+        self._stats = {'scanned': 0, 'matched': 0, 'redriven': 0, 'failed': 0}
+        self._stats_lock = threading.Lock()
+        # Envelopes popped but not completed, to be made visible again at the end
+        self._unfinished = []
+        # IDs of the errors scanned so far, to recognise those popped again
+        self._seen_error_ids = set()
+
+    def _count(self, stat, count):
+        with self._stats_lock:
+            self._stats[stat] += count
+
+    def run(self):
+        """Redrive every matching item. Returns a dict with the number of items
+        `scanned`, `matched`, `redriven`, and `failed` to push or complete."""
+        pool = ThreadPool(self.concurrency)
+        # Bound the batches read ahead of the pushes, so that popped items are not
+        # left waiting long enough to hit their visibility timeout
+        pending = threading.BoundedSemaphore(self.concurrency * 2)
+        results = []
+        try:
+            for batch in _iter_error_batches(self.backend.error_queue, self.batch_size):
+                scanned = self._stats['scanned']
+                matched = self._select(batch)
+                if self._stats['scanned'] == scanned:
+                    # Everything left has already been scanned and has become visible again
+                    break
+                if matched and not self.dry_run:
+                    pending.acquire()
+                    results.append(pool.apply_async(self._redrive_batch, (matched, pending)))
+                if self.limit is not None and self._stats['matched'] >= self.limit:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+            self._release_unfinished()
+        for result in results:
+            result.get()
+        logging.info('Redrive of {} {}: {}'.format(self.backend.group, 'counted' if self.dry_run else 'finished',
+                                                   self._stats))
+        return dict(self._stats)
+
+    def _select(self, batch):
+        """Returns the (envelope, item) tuples from the batch which should be redriven.
+        Errors which have already been scanned are skipped, and not counted again."""
+        matched, unmatched, scanned = [], [], 0
+        for envelope, item in batch:
+            error_id = _error_id(item)
+            if error_id is not None:
+                if error_id in self._seen_error_ids:
+                    unmatched.append(envelope)
+                    continue
+                self._seen_error_ids.add(error_id)
+            scanned += 1
+            room = self.limit is None or self._stats['matched'] + len(matched) < self.limit
+            if room and self.error_filter.matches(item):
+                matched.append((envelope, item))
+            else:
+                unmatched.append(envelope)
+        self._count('scanned', scanned)
+        self._count('matched', len(matched))
+        self._unfinished.extend(unmatched)
+        if self.dry_run:
+            self._unfinished.extend(envelope for envelope, _ in matched)
+        return matched
+
+    def _redrive_batch(self, batch, pending):
+        try:
+            if self.rate_limiter:
+                self.rate_limiter.acquire(len(batch))
+            push_result = self.backend.queue.push_batch([_redriven_item(item) for _, item in batch])
+            pushed = []
+            for (envelope, _), (_, success) in zip(batch, push_result):
+                if success:
+                    pushed.append(envelope)
+                else:
+                    self._unfinished.append(envelope)
+            failed = len(batch) - len(pushed)
+            if pushed:
+                for envelope, success in self.backend.error_queue.complete_batch(pushed):
+                    if not success:
+                        # Already pushed, so it will run again, but it also stays in the error queue
+                        logging.warn('Redriven item was not removed from the error queue: {}'.format(envelope))
+                        failed += 1
+            self._count('redriven', len(pushed))
+            self._count('failed', failed)
+        except Exception:
+            logging.exception('Error redriving batch of {} items'.format(len(batch)))
+            self._count('failed', len(batch))
+            self._unfinished.extend(envelope for envelope, _ in batch)
+        finally:
+            pending.release()
+
+    def _release_unfinished(self):
+        if hasattr(self.backend.error_queue, 'iter_errors'):
+            return
+        for envelope in self._unfinished:
+            try:
+                self.backend.error_queue.touch(envelope, 0)
+            except Exception:
+                logging.exception('Error releasing error queue envelope {}'.format(envelope))
+        self._unfinished = []
+
+def redrive(backend, error_filter=None, **kwargs):
+    """Redrive matching items from `backend.error_queue` to `backend.queue`.
+    Takes the same keyword arguments as `Redrive`, and returns its stats."""
+    return Redrive(backend, error_filter, **kwargs).run()
+
+def _parse_time(value):
+    """Epoch seconds, or an ISO 8601 UTC time like 2026-10-16T09:00[:00]."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for time_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(datetime.strptime(value, time_format).utctimetuple())
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Invalid time: {}'.format(value))
+
+def _load_backend_factory(path):
+    module_name, _, attribute = path.partition(':')
+    factory = getattr(import_module(module_name), attribute)
+    if not hasattr(factory, 'create_backend_for_group'):
+        factory = factory()
+    return factory
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m deferrable.redrive',
+                                     description='Redrive items from error queues back to their main queues.')
+    parser.add_argument('factory', help='module:attribute of a BackendFactory, or of a callable returning one')
+    parser.add_argument('--group', action='append', dest='groups',
+                        help='Group to redrive. May be repeated. Defaults to the ungrouped backend.')
+    parser.add_argument('--error-type', action='append', dest='error_types', help='May be repeated.')
+    parser.add_argument('--method', action='append', dest='method_names',
+                        help='Module-qualified method name. May be repeated.')
+    parser.add_argument('--since', type=_parse_time, help='Epoch seconds or UTC ISO time.')
+    parser.add_argument('--until', type=_parse_time, help='Epoch seconds or UTC ISO time.')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--rate', type=float, dest='items_per_second', help='Maximum items pushed per second.')
+    parser.add_argument('--limit', type=int, help='Maximum items to redrive per group.')
+    parser.add_argument('--dry-run', action='store_true', help='Only count the matching items.')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = _parse_args(argv)
+    factory = _load_backend_factory(args.factory)
+    error_filter = ErrorFilter(error_types=args.error_types, method_names=args.method_names,
+                               since=args.since, until=args.until)
+    for group in args.groups or [None]:
+        stats = redrive(factory.create_backend_for_group(group), error_filter,
+                        batch_size=args.batch_size, concurrency=args.concurrency,
+                        items_per_second=args.items_per_second, limit=args.limit, dry_run=args.dry_run)
+        print '{}: {}'.format(group or '(no group)', ', '.join('{} {}'.format(stats[key], key) for key in
+                                                               ('scanned', 'matched', 'redriven', 'failed')))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,41 @@
+"""Registry of deferrable methods keyed by their module-qualified name.
+Every method decorated with `@deferrable` is registered here, so that
+items can refer to their method by this short ID instead of carrying a
+pickle of it (see the `use_method_ids` argument to `Deferrable`).
+
+A consumer which has not yet imported the method's module imports it on
+first lookup, just as unpickling the method would."""
+
+import sys
+from importlib import import_module
+
+_methods = {}
+
+def method_id(method):
+    return '{}.{}'.format(method.__module__, method.__name__)
+
+def register_method(method):
+    """Register the method under its module-qualified name, replacing any
+    method previously registered there (e.g. if its module was reloaded).
+    Returns the method's ID."""
+    key = method_id(method)
+    _methods[key] = method
+    return key
+
+def registered_method_ids():
+    return sorted(_methods)
+
+def get_method(key):
+    try:
+        return _methods[key]
+    except KeyError:
+        pass
+    module_name, _, name = key.rpartition('.')
+    try:
+        if module_name not in sys.modules:
+            import_module(module_name)
+        # Importing the module registers its methods, but fall back to the module
+        # attribute for methods registered by some other means
+        return _methods.get(key) or getattr(sys.modules[module_name], name)
+    except (ImportError, AttributeError, KeyError, ValueError):
+        raise ValueError('No method registered with ID {}'.format(key))
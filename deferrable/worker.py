@@ -0,0 +1,143 @@
+"""Worker provides a multi-threaded consumer runtime for a Deferrable
+instance. Each consumer thread pops and processes items in a loop, while
+a background heartbeat thread touches any in-flight envelopes which are
+approaching the end of their visibility timeout. This allows long-running
+tasks to be processed without the broker redelivering them to another
+consumer.
+
+On SIGTERM or SIGINT, the worker stops popping new items and waits for
+the items currently being processed to complete before returning."""
+
+import signal
+import time
+import logging
+import threading
+
+# Used for queues which do not expose their own visibility timeout
+DEFAULT_TOUCH_SECONDS = 30
+
+# How long a consumer thread sleeps after an unexpected error talking
+# to the queue, so that we do not spin against a broken broker
+ERROR_SLEEP_SECONDS = 1
+
+class Worker(object):
+    def __init__(self, deferrable_instance, concurrency=1, heartbeat_interval=5, touch_seconds=None):
+        """
+        - concurrency: Number of consumer threads to run.
+        - heartbeat_interval: Seconds between checks for in-flight envelopes which need touching.
+        - touch_seconds: Visibility timeout to apply on each touch. Defaults to the queue's own
+                         `visibility_timeout` if it has one, otherwise DEFAULT_TOUCH_SECONDS.
+                         Envelopes are touched once half of this has elapsed since their last touch.
+        """
+        self.deferrable = deferrable_instance
+        self.concurrency = concurrency
+        self.heartbeat_interval = heartbeat_interval
+        queue = self.deferrable.backend.queue
+        self.touch_seconds = touch_seconds or getattr(queue, 'visibility_timeout', None) or DEFAULT_TOUCH_SECONDS
+
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._drained = threading.Event()
+        self._threads = []
+        self._heartbeat_thread = None
+
+    @property
+    def queue(self):
+        return self.deferrable.backend.queue
+
+    @property
+    def stopping(self):
+        return self._stopping.is_set()
+
+    def start(self):
+        """Start the consumer and heartbeat threads without blocking."""
+        self._stopping.clear()
+        self._drained.clear()
+        self._threads = []
+        for index in range(self.concurrency):
+            thread = threading.Thread(target=self._consume, name='deferrable-worker-{}'.format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, name='deferrable-heartbeat')
+        self._heartbeat_thread.daemon = True
+        self._heartbeat_thread.start()
+
+    def stop(self):
+        """Signal all threads to stop after their current item."""
+        self._stopping.set()
+
+    def join(self):
+        """Block until all consumer threads have exited. Joins with a timeout
+        so that the main thread stays responsive to signals."""
+        for thread in self._threads:
+            while thread.is_alive():
+                thread.join(1)
+        self._drained.set()
+        if self._heartbeat_thread:
+            self._heartbeat_thread.join()
+        # Hand back anything received ahead of time, rather than leaving it
+        # invisible to other consumers until its visibility timeout
+        if hasattr(self.queue, 'stop_prefetch'):
+            self.queue.stop_prefetch()
+
+    def run(self):
+        """Run the worker in the foreground until SIGTERM or SIGINT is received,
+        then drain in-flight items and return. Must be called from the main thread."""
+        previous_handlers = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            previous_handlers[signum] = signal.signal(signum, self._handle_signal)
+        try:
+            self.start()
+            self.join()
+        finally:
+            for signum, handler in previous_handlers.iteritems():
+                signal.signal(signum, handler)
+
+    def in_flight_count(self):
+        with self._in_flight_lock:
+            return len(self._in_flight)
+
+    def _handle_signal(self, signum, frame):
+        logging.info("Received signal {}, draining in-flight items".format(signum))
+        self.stop()
+
+    def _consume(self):
+        while not self._stopping.is_set():
+            try:
+                self._consume_once()
+            except Exception:
+                logging.exception("Unexpected error in deferrable worker thread")
+                time.sleep(ERROR_SLEEP_SECONDS)
+
+    def _consume_once(self):
+        envelope, item = self.queue.pop()
+        if not envelope:
+            return self.deferrable.process(envelope, item)
+        # Envelopes are not guaranteed to be hashable, so track them by identity
+        key = id(envelope)
+        with self._in_flight_lock:
+            self._in_flight[key] = [envelope, time.time()]
+        try:
+            self.deferrable.process(envelope, item)
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+
+    def _heartbeat(self):
+        # Keep touching until every consumer has drained, not just until we are asked to stop
+        while not self._drained.wait(self.heartbeat_interval):
+            self._touch_expiring_envelopes()
+
+    def _touch_expiring_envelopes(self):
+        now = time.time()
+        with self._in_flight_lock:
+            expiring = [entry for entry in self._in_flight.itervalues()
+                        if now - entry[1] >= self.touch_seconds / 2.0]
+        for entry in expiring:
+            try:
+                self.queue.touch(entry[0], self.touch_seconds)
+                entry[1] = time.time()
+            except Exception:
+                logging.exception("Error touching in-flight envelope")
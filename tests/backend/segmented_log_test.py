@@ -0,0 +1,25 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+from deferrable.backend.segmented_log import SegmentedLogBackendFactory, SegmentedLogBackend
+from deferrable.queue.segmented_log import SegmentedLogQueue
+
+class TestSegmentedLogBackendFactory(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.factory = SegmentedLogBackendFactory(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_create_backend_for_group(self):
+        for group in [None, 'testing']:
+            backend = self.factory.create_backend_for_group(group)
+            self.assertIsInstance(backend, SegmentedLogBackend)
+            self.assertIsInstance(backend.queue, SegmentedLogQueue)
+            self.assertIsInstance(backend.error_queue, SegmentedLogQueue)
+            self.assertNotEqual(backend.queue.directory, backend.error_queue.directory)
+
+class TestSegmentedLogBackend(TestCase):
+    pass
@@ -0,0 +1,26 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from deferrable.backend.sqlite import SQLiteBackendFactory, SQLiteBackend
+from deferrable.queue.sqlite import SQLiteQueue
+
+class TestSQLiteBackendFactory(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.factory = SQLiteBackendFactory(os.path.join(self.directory, 'deferrable.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_create_backend_for_group(self):
+        for group in [None, 'testing']:
+            backend = self.factory.create_backend_for_group(group)
+            self.assertIsInstance(backend, SQLiteBackend)
+            self.assertIsInstance(backend.queue, SQLiteQueue)
+            self.assertIsInstance(backend.error_queue, SQLiteQueue)
+            self.assertNotEqual(backend.queue.queue_name, backend.error_queue.queue_name)
+
+class TestSQLiteBackend(TestCase):
+    pass
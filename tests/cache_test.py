@@ -0,0 +1,73 @@
+from unittest import TestCase
+from mock import Mock
+
+import time
+
+from deferrable.cache import LRUCache, TTLCache
+
+class TestLRUCache(TestCase):
+    def test_miss_then_hit(self):
+        cache = LRUCache(2)
+        loader = Mock(return_value='value')
+        self.assertEqual(('value', False), cache.get_or_load('key', loader))
+        self.assertEqual(('value', True), cache.get_or_load('key', loader))
+        self.assertEqual(1, loader.call_count)
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.get_or_load('a', lambda: 1)
+        cache.get_or_load('b', lambda: 2)
+        cache.get_or_load('a', lambda: 1)
+        cache.get_or_load('c', lambda: 3)
+        self.assertEqual(2, len(cache))
+        self.assertEqual((1, True), cache.get_or_load('a', lambda: None))
+        self.assertEqual((None, False), cache.get_or_load('b', lambda: None))
+
+    def test_loader_errors_are_not_cached(self):
+        cache = LRUCache(2)
+        with self.assertRaises(ValueError):
+            cache.get_or_load('key', Mock(side_effect=ValueError()))
+        self.assertEqual(0, len(cache))
+
+    def test_zero_maxsize_disables_caching(self):
+        cache = LRUCache(0)
+        cache.get_or_load('key', lambda: 1)
+        self.assertEqual(0, len(cache))
+        self.assertEqual((1, False), cache.get_or_load('key', lambda: 1))
+
+    def test_clear(self):
+        cache = LRUCache(2)
+        cache.get_or_load('key', lambda: 1)
+        cache.clear()
+        self.assertEqual(0, len(cache))
+
+class TestTTLCache(TestCase):
+    def test_get_and_set(self):
+        cache = TTLCache(2)
+        self.assertIsNone(cache.get('key'))
+        cache.set('key', 'value', 10)
+        self.assertEqual('value', cache.get('key'))
+
+    def test_entries_expire(self):
+        cache = TTLCache(2)
+        cache.set('key', 'value', 0.01)
+        time.sleep(0.02)
+        self.assertEqual('default', cache.get('key', 'default'))
+        self.assertEqual(0, len(cache))
+
+    def test_non_positive_ttl_is_not_cached(self):
+        cache = TTLCache(2)
+        cache.set('key', 'value', 0)
+        self.assertEqual(0, len(cache))
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(2)
+        cache.set('a', 1, 10)
+        cache.set('b', 2, 10)
+        cache.get('a')
+        cache.set('c', 3, 10)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
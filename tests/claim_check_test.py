@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from redis import StrictRedis
+
+from deferrable.pickling import build_later_item
+from deferrable.claim_check import (FileSystemBlobStore, RedisBlobStore, CLAIM_CHECK_KEY,
+                                    check_in_item, check_out_item, release_item)
+
+def test_function(*args, **kwargs):
+    pass
+
+class BlobStoreTestMixin(object):
+    def test_put_and_get(self):
+        self.store.put('key', '\x00binary\xff')
+        self.assertEqual('\x00binary\xff', self.store.get('key'))
+
+    def test_get_missing_raises_key_error(self):
+        with self.assertRaises(KeyError):
+            self.store.get('missing')
+
+    def test_delete(self):
+        self.store.put('key', 'data')
+        self.store.delete('key')
+        with self.assertRaises(KeyError):
+            self.store.get('key')
+
+    def test_delete_missing_does_not_raise(self):
+        self.store.delete('missing')
+
+class TestFileSystemBlobStore(BlobStoreTestMixin, TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = FileSystemBlobStore(os.path.join(self.directory, 'blobs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class TestRedisBlobStore(BlobStoreTestMixin, TestCase):
+    def setUp(self):
+        self.redis_client = StrictRedis(host=os.getenv("DEFERRABLE_TEST_REDIS_HOST", "redis"))
+        self.store = RedisBlobStore(self.redis_client, prefix='deferrable.test_claim_check', expire_seconds=60)
+
+    def tearDown(self):
+        for key in self.redis_client.keys('deferrable.test_claim_check.*'):
+            self.redis_client.delete(key)
+
+    def test_expire_seconds(self):
+        self.store.put('key', 'data')
+        self.assertTrue(0 < self.redis_client.ttl('deferrable.test_claim_check.key') <= 60)
+
+class TestClaimCheckItems(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = FileSystemBlobStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_check_in_below_threshold(self):
+        item = build_later_item(test_function, 'small')
+        self.assertFalse(check_in_item(self.store, item, 1000))
+        self.assertNotIn(CLAIM_CHECK_KEY, item)
+        self.assertIn('args', item)
+
+    def test_check_in_and_out(self):
+        item = build_later_item(test_function, 'x' * 1000, a=1)
+        original = dict(item)
+        self.assertTrue(check_in_item(self.store, item, 100))
+        self.assertNotIn('args', item)
+        self.assertNotIn('kwargs', item)
+        self.assertIn(CLAIM_CHECK_KEY, item)
+
+        checked_out = check_out_item(self.store, item)
+        self.assertEqual(original['args'], checked_out['args'])
+        self.assertEqual(original['kwargs'], checked_out['kwargs'])
+        self.assertNotIn('args', item)
+
+    def test_check_in_is_idempotent(self):
+        item = build_later_item(test_function, 'x' * 1000)
+        check_in_item(self.store, item, 100)
+        self.assertFalse(check_in_item(self.store, item, 100))
+        self.assertEqual(1, len(os.listdir(self.directory)))
+
+    def test_check_out_without_claim_check(self):
+        item = build_later_item(test_function, 'small')
+        self.assertIs(item, check_out_item(self.store, item))
+
+    def test_release(self):
+        item = build_later_item(test_function, 'x' * 1000)
+        check_in_item(self.store, item, 100)
+        release_item(self.store, item)
+        self.assertEqual([], os.listdir(self.directory))
+        with self.assertRaises(KeyError):
+            check_out_item(self.store, item)
@@ -0,0 +1,72 @@
+from unittest import TestCase
+from datetime import datetime
+
+from deferrable.codec import (Codec, PickleCodec, MarshalCodec, JSONCodec,
+                              register_codec, get_codec)
+from deferrable.pickling import build_later_item_with_codec, unpickle_method_call
+
+def test_method(*args, **kwargs):
+    pass
+
+class TestCodecs(TestCase):
+    def setUp(self):
+        self.primitive = ('a', u"d'\xc9vry", 1, 2.5, None, True, [1, 2], {'k': 'v'})
+
+    def test_pickle_round_trip(self):
+        codec = PickleCodec()
+        self.assertEqual(self.primitive, codec.decode(codec.encode(self.primitive)))
+
+    def test_marshal_round_trip(self):
+        codec = MarshalCodec()
+        self.assertEqual(self.primitive, codec.decode(codec.encode(self.primitive)))
+
+    def test_json_round_trip(self):
+        codec = JSONCodec()
+        self.assertEqual(list(self.primitive), codec.decode(codec.encode(self.primitive)))
+
+    def test_json_rejects_non_string_keys(self):
+        codec = JSONCodec()
+        with self.assertRaises(TypeError):
+            codec.encode(({'a': [{1: 'b'}]},))
+
+    def test_get_codec(self):
+        self.assertIsInstance(get_codec('json'), JSONCodec)
+
+    def test_get_unknown_codec_raises(self):
+        with self.assertRaises(ValueError):
+            get_codec('bacon')
+
+    def test_register_duplicate_codec_raises(self):
+        with self.assertRaises(ValueError):
+            register_codec(JSONCodec())
+
+    def test_register_codec_without_id_raises(self):
+        with self.assertRaises(ValueError):
+            register_codec(Codec())
+
+class TestBuildLaterItemWithCodec(TestCase):
+    def test_build_and_unpickle_with_codec(self):
+        for codec_id in ['pickle', 'marshal', 'json']:
+            item = build_later_item_with_codec(codec_id, test_method, ('a',), {'b': 'c'})
+            self.assertEqual(codec_id, item['codec'])
+            method, args, kwargs = unpickle_method_call(item)
+            self.assertEqual(method, test_method)
+            self.assertEqual(list(args), ['a'])
+            self.assertEqual(kwargs, {'b': 'c'})
+
+    def test_falls_back_to_pickle_for_unsupported_args(self):
+        now = datetime.now()
+        for codec_id in ['marshal', 'json']:
+            item = build_later_item_with_codec(codec_id, test_method, (now,), {})
+            self.assertEqual('pickle', item['codec'])
+            self.assertEqual((now,), unpickle_method_call(item)[1])
+
+    def test_json_falls_back_to_pickle_for_non_string_keys(self):
+        item = build_later_item_with_codec('json', test_method, ({1: 'a'},), {})
+        self.assertEqual('pickle', item['codec'])
+        self.assertEqual(({1: 'a'},), unpickle_method_call(item)[1])
+
+    def test_unpickle_item_without_codec_uses_pickle(self):
+        item = build_later_item_with_codec('pickle', test_method, ('a',), {})
+        del item['codec']
+        self.assertEqual(('a',), unpickle_method_call(item)[1])
@@ -1,13 +1,21 @@
 from unittest import TestCase
+from mock import Mock, patch
+import cPickle as pickle
 import os
 import time
 
 from redis import StrictRedis
 
-from deferrable.debounce import (DebounceStrategy, _debounce_key, _last_push_key,
+from deferrable.debounce import (DebounceStrategy, _debounce_key, _last_push_key, debounce_keys,
+                                 legacy_key_suffix, _legacy_debounce_key, _legacy_last_push_key,
                                  set_debounce_keys_for_push_now, set_debounce_keys_for_push_delayed,
-                                 get_debounce_strategy)
+                                 get_debounce_strategy, apply_debounce, apply_debounce_batch)
 from deferrable.redis import initialize_redis_client
+from deferrable.pickling import build_later_item, dumps
+from deferrable.cache import TTLCache
+
+def test_method(*args, **kwargs):
+    pass
 
 class TestDebounce(TestCase):
     def setUp(self):
@@ -17,18 +25,54 @@ class TestDebounce(TestCase):
             'args': 'pickled_args',
             'kwargs': 'pickled_kwargs'
         }
+        self.legacy_suffix = legacy_key_suffix(dumps(test_method, legacy=True), (1,), {'b': 2, 'a': 3})
 
     def tearDown(self):
         self.redis_client.delete(_debounce_key(self.item))
         self.redis_client.delete(_last_push_key(self.item))
+        self.redis_client.delete(_legacy_debounce_key(self.legacy_suffix))
+        self.redis_client.delete(_legacy_last_push_key(self.legacy_suffix))
 
     def test_debounce_key(self):
-        expected = 'debounce.pickled_method.pickled_args.pickled_kwargs'
-        self.assertEqual(expected, _debounce_key(self.item))
+        key = _debounce_key(self.item)
+        self.assertTrue(key.startswith('debounce.unknown.'))
+        self.assertEqual(len('debounce.unknown.') + 40, len(key))
 
     def test_last_push_key(self):
-        expected = 'last_push.pickled_method.pickled_args.pickled_kwargs'
-        self.assertEqual(expected, _last_push_key(self.item))
+        key = _last_push_key(self.item)
+        self.assertTrue(key.startswith('last_push.unknown.'))
+        self.assertEqual(key.split('.')[-1], _debounce_key(self.item).split('.')[-1])
+
+    def test_keys_have_readable_method_prefix(self):
+        item = build_later_item(test_method, 'x' * 10000)
+        self.assertTrue(_debounce_key(item).startswith('debounce.{}.test_method.'.format(__name__)))
+        self.assertLess(len(_debounce_key(item)), 100)
+        self.item['method_id'] = 'some.module.method'
+        self.assertTrue(_debounce_key(self.item).startswith('debounce.some.module.method.'))
+
+    def test_keys_differ_by_arguments(self):
+        other = dict(self.item, kwargs='other_kwargs')
+        self.assertNotEqual(_debounce_key(self.item), _debounce_key(other))
+        # Moving bytes between fields must change the digest
+        shifted = dict(self.item, args='pickled_argsp', kwargs='ickled_kwargs')
+        self.assertNotEqual(_debounce_key(self.item), _debounce_key(shifted))
+
+    def test_legacy_keys(self):
+        # As written by versions which embedded the pickled call in the key
+        baseline_dumps = lambda obj: pickle.dumps(obj).encode('string_escape')
+        suffix = u"{}.{}.{}".format(baseline_dumps(test_method), baseline_dumps((1,)),
+                                    baseline_dumps(sorted({'b': 2, 'a': 3}.items())))
+        self.assertEqual(u"debounce." + suffix, _legacy_debounce_key(self.legacy_suffix))
+        self.assertEqual(u"last_push." + suffix, _legacy_last_push_key(self.legacy_suffix))
+        self.assertEqual(debounce_keys(self.item) + [u"last_push." + suffix, u"debounce." + suffix],
+                         debounce_keys(self.item, legacy_suffix=self.legacy_suffix))
+
+    def test_debounce_keys_use_given_name(self):
+        with patch('deferrable.debounce.method_name') as mock_method_name:
+            keys = debounce_keys(self.item, 'some.module.method')
+        self.assertFalse(mock_method_name.called)
+        self.assertTrue(keys[1].startswith('debounce.some.module.method.'))
+        self.assertEqual(keys[1].split('.')[-1], _debounce_key(self.item).split('.')[-1])
 
     def test_set_debounce_keys_for_push_now(self):
         set_debounce_keys_for_push_now(self.redis_client, self.item, 0.01)
@@ -69,3 +113,125 @@ class TestDebounce(TestCase):
         strategy, delay_time = get_debounce_strategy(self.redis_client, self.item, 1, True)
         self.assertEqual(strategy, DebounceStrategy.SKIP)
         self.assertEqual(delay_time, 0)
+
+    def test_apply_debounce_first_time(self):
+        strategy, delay_time = apply_debounce(self.redis_client, self.item, 1, False)
+        self.assertEqual(strategy, DebounceStrategy.PUSH_NOW)
+        self.assertEqual(delay_time, 0)
+        self.assertIsNotNone(self.redis_client.get(_last_push_key(self.item)))
+        self.assertIsNone(self.redis_client.get(_debounce_key(self.item)))
+
+    def test_apply_debounce_first_time_always_delay(self):
+        strategy, delay_time = apply_debounce(self.redis_client, self.item, 1, True)
+        self.assertEqual(strategy, DebounceStrategy.PUSH_DELAYED)
+        self.assertEqual(delay_time, 1)
+        self.assertIsNotNone(self.redis_client.get(_debounce_key(self.item)))
+
+    def test_apply_debounce_after_push_now(self):
+        apply_debounce(self.redis_client, self.item, 1, False)
+        strategy, delay_time = apply_debounce(self.redis_client, self.item, 1, False)
+        self.assertEqual(strategy, DebounceStrategy.PUSH_DELAYED)
+        self.assertEqual(delay_time, 1)
+        self.assertIsInstance(delay_time, int)
+
+    def test_apply_debounce_after_push_delayed(self):
+        apply_debounce(self.redis_client, self.item, 1, True)
+        strategy, delay_time = apply_debounce(self.redis_client, self.item, 1, False)
+        self.assertEqual(strategy, DebounceStrategy.SKIP)
+        self.assertEqual(delay_time, 0)
+
+    def test_apply_debounce_window_elapsed(self):
+        apply_debounce(self.redis_client, self.item, 0.05, False)
+        time.sleep(0.06)
+        strategy, delay_time = apply_debounce(self.redis_client, self.item, 0.05, False)
+        self.assertEqual(strategy, DebounceStrategy.PUSH_NOW)
+
+    def test_apply_debounce_matches_two_step_strategy(self):
+        set_debounce_keys_for_push_now(self.redis_client, self.item, 10)
+        expected = get_debounce_strategy(self.redis_client, self.item, 10, False)
+        self.assertEqual(expected, apply_debounce(self.redis_client, self.item, 10, False))
+
+    def test_apply_debounce_honours_legacy_debounce_key(self):
+        self.redis_client.set(_legacy_debounce_key(self.legacy_suffix), '_', px=1000)
+        keys = debounce_keys(self.item, legacy_suffix=self.legacy_suffix)
+        strategy, _ = apply_debounce(self.redis_client, self.item, 1, False, keys=keys)
+        self.assertEqual(strategy, DebounceStrategy.SKIP)
+        strategy, _ = apply_debounce(self.redis_client, self.item, 1, False)
+        self.assertEqual(strategy, DebounceStrategy.PUSH_NOW)
+
+    def test_apply_debounce_honours_legacy_last_push_key(self):
+        self.redis_client.set(_legacy_last_push_key(self.legacy_suffix), time.time(), px=2000)
+        keys = debounce_keys(self.item, legacy_suffix=self.legacy_suffix)
+        strategy, delay_time = apply_debounce(self.redis_client, self.item, 1, False, keys=keys)
+        self.assertEqual(strategy, DebounceStrategy.PUSH_DELAYED)
+        self.assertEqual(delay_time, 1)
+        self.assertIsNotNone(self.redis_client.get(_debounce_key(self.item)))
+
+    def test_apply_debounce_local_cache_skips_redis(self):
+        cache = TTLCache(10)
+        apply_debounce(self.redis_client, self.item, 1, True, local_cache=cache)
+        self.assertEqual(1, len(cache))
+        original_scripts, self.redis_client.scripts = self.redis_client.scripts, Mock()
+        try:
+            strategy, delay_time = apply_debounce(self.redis_client, self.item, 1, True, local_cache=cache)
+            self.assertFalse(self.redis_client.scripts.debounce.called)
+        finally:
+            self.redis_client.scripts = original_scripts
+        self.assertEqual(strategy, DebounceStrategy.SKIP)
+        self.assertEqual(delay_time, 0)
+
+    def test_apply_debounce_local_cache_does_not_cache_push_now(self):
+        cache = TTLCache(10)
+        apply_debounce(self.redis_client, self.item, 1, False, local_cache=cache)
+        self.assertEqual(0, len(cache))
+        strategy, _ = apply_debounce(self.redis_client, self.item, 1, False, local_cache=cache)
+        self.assertEqual(strategy, DebounceStrategy.PUSH_DELAYED)
+        self.assertEqual(1, len(cache))
+
+    def test_apply_debounce_local_cache_caches_redis_skips(self):
+        apply_debounce(self.redis_client, self.item, 1, True)
+        cache = TTLCache(10)
+        strategy, _ = apply_debounce(self.redis_client, self.item, 1, False, local_cache=cache)
+        self.assertEqual(strategy, DebounceStrategy.SKIP)
+        self.assertEqual(1, len(cache))
+
+    def test_apply_debounce_local_cache_expires_with_window(self):
+        cache = TTLCache(10)
+        apply_debounce(self.redis_client, self.item, 0.05, True, local_cache=cache)
+        time.sleep(0.06)
+        strategy, _ = apply_debounce(self.redis_client, self.item, 0.05, False, local_cache=cache)
+        self.assertNotEqual(strategy, DebounceStrategy.SKIP)
+
+    def test_apply_debounce_batch(self):
+        other_item = dict(self.item, args='other_args')
+        self.addCleanup(self.redis_client.delete, _debounce_key(other_item), _last_push_key(other_item))
+        keys, other_keys = debounce_keys(self.item), debounce_keys(other_item)
+        results = apply_debounce_batch(self.redis_client, [(keys, 1, False),
+                                                           (keys, 1, False),
+                                                           (keys, 1, False),
+                                                           (other_keys, 1, True)])
+        self.assertEqual([(DebounceStrategy.PUSH_NOW, 0),
+                          (DebounceStrategy.PUSH_DELAYED, 1),
+                          (DebounceStrategy.SKIP, 0),
+                          (DebounceStrategy.PUSH_DELAYED, 1)], results)
+
+    def test_apply_debounce_batch_single_round_trip(self):
+        pipeline = self.redis_client.pipeline(transaction=False)
+        with patch.object(self.redis_client, 'pipeline', return_value=pipeline):
+            with patch.object(pipeline, 'execute', wraps=pipeline.execute) as mock_execute:
+                keys = debounce_keys(self.item)
+                apply_debounce_batch(self.redis_client, [(keys, 1, False), (keys, 1, False)])
+        mock_execute.assert_called_once_with(raise_on_error=False)
+
+    def test_apply_debounce_batch_local_cache(self):
+        cache = TTLCache(10)
+        apply_debounce(self.redis_client, self.item, 1, True, local_cache=cache)
+        other_item = dict(self.item, args='other_args')
+        self.addCleanup(self.redis_client.delete, _debounce_key(other_item), _last_push_key(other_item))
+        results = apply_debounce_batch(self.redis_client,
+                                       [(debounce_keys(self.item), 1, False), (debounce_keys(other_item), 1, False)],
+                                       local_cache=cache)
+        self.assertEqual([(DebounceStrategy.SKIP, 0), (DebounceStrategy.PUSH_NOW, 0)], results)
+
+    def test_apply_debounce_batch_empty(self):
+        self.assertEqual([], apply_debounce_batch(self.redis_client, []))
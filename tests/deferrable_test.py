@@ -1,15 +1,23 @@
 from uuid import uuid1
+import cPickle as pickle
 import time
 import os 
+import shutil
+import tempfile
 
 from unittest import TestCase
-from mock import Mock
+from mock import Mock, call, patch
 from redis import StrictRedis
 
 from deferrable import Deferrable
+from deferrable.pickling import dumps, unpickle_method
+from deferrable.cache import TTLCache
+from deferrable.registry import registered_method_ids
 from deferrable.metadata import MetadataProducerConsumer
 from deferrable.backend.dockets import DocketsBackendFactory
 from deferrable.backend.memory import InMemoryBackendFactory
+from deferrable.error_index import InMemoryErrorIndex
+from deferrable.claim_check import FileSystemBlobStore, CLAIM_CHECK_KEY, DEFAULT_CLAIM_CHECK_THRESHOLD
 
 class CustomError(Exception):
     pass
@@ -29,7 +37,8 @@ class EventConsumer(object):
     def __init__(self):
         self.mocks = {}
         for event in ['push', 'pop', 'empty', 'complete', 'expire',
-                      'retry', 'error', 'debounce_hit', 'debounce_miss']:
+                      'retry', 'error', 'debounce_hit', 'debounce_miss',
+                      'unpickle_cache_hit', 'unpickle_cache_miss', 'debounce_error']:
             self.mocks[event] = Mock()
 
     def reset_mocks(self):
@@ -105,6 +114,16 @@ def debounced_deferrable_lambda(foo, bar, *args, **kwargs):
 def ttl_deferrable_lambda(*args, **kwargs):
     my_mock(*args, **kwargs)
 
+@instance.deferrable(codec='marshal')
+def marshal_deferrable(*args, **kwargs):
+    my_mock(*args, **kwargs)
+
+method_id_instance = Deferrable(backend, redis_client=redis_client, use_method_ids=True)
+
+@method_id_instance.deferrable(debounce_seconds=1)
+def method_id_deferrable(*args, **kwargs):
+    my_mock(*args, **kwargs)
+
 class TestDeferrable(TestCase):
     def setUp(self):
         global RETRIABLE_ALLOW_FAIL
@@ -134,6 +153,58 @@ class TestDeferrable(TestCase):
         self.assertEqual(item['id'], self.item['id'])
         self.assertEqual(item['error']['error_type'], 'ZeroDivisionError')
 
+    def test_errors_are_recorded_in_error_index(self):
+        instance.error_index = InMemoryErrorIndex()
+        method = __name__ + '.simple_deferrable'
+        try:
+            for i in range(3):
+                simple_deferrable.later(i)
+            my_mock.side_effect = [KeyError(), KeyError(), ZeroDivisionError()]
+            with patch('deferrable.error_index.method_name') as mock_method_name:
+                for _ in range(3):
+                    instance.run_once()
+            # The method was already loaded to execute the item
+            self.assertFalse(mock_method_name.called)
+            self.assertEqual([{'method': method, 'error_type': 'KeyError', 'count': 2},
+                              {'method': method, 'error_type': 'ZeroDivisionError', 'count': 1}],
+                             instance.error_index.top('testing'))
+            self.assertEqual([{'method': method, 'count': 3}], instance.error_index.top('testing', by=['method']))
+            error_ids = [item['error']['id'] for _, item in backend.error_queue.pop_batch(3)
+                         if item['error']['error_type'] == 'KeyError']
+            self.assertEqual(sorted(error_ids), sorted(instance.error_index.recent_ids('testing', method, 'KeyError')))
+        finally:
+            instance.error_index = None
+            my_mock.side_effect = None
+
+    def test_error_index_does_not_reload_unloadable_method(self):
+        instance.error_index = InMemoryErrorIndex()
+        simple_deferrable.later(1)
+        envelope, item = backend.queue.pop()
+        backend.queue.complete(envelope)
+        item['method'] = 'not a pickle'
+        backend.queue.push(item)
+        try:
+            with patch('deferrable.deferrable.unpickle_method', wraps=unpickle_method) as mock_unpickle:
+                instance.run_once()
+            self.assertEqual(1, mock_unpickle.call_count)
+            self.assertEqual([{'method': 'unknown', 'count': 1}], instance.error_index.top('testing', by=['method']))
+        finally:
+            instance.error_index = None
+        backend.error_queue.pop_batch(1)
+
+    def test_error_index_failure_does_not_affect_processing(self):
+        instance.error_index = Mock()
+        instance.error_index.record.side_effect = Exception()
+        try:
+            try:
+                1/0
+            except:
+                instance._push_item_to_error_queue(self.item)
+        finally:
+            instance.error_index = None
+        event_consumer.assert_event_emitted('error')
+        self.assertEqual(1, backend.error_queue.stats()['available'])
+
     def test_deferrable_decorator(self):
         @instance.deferrable
         def method(*args, **kwargs):
@@ -163,6 +234,204 @@ class TestDeferrable(TestCase):
         event_consumer.assert_event_emitted('complete')
         my_mock.assert_called_once_with(u"d'\xc9vry")
 
+    def test_later_many(self):
+        failed_items = simple_deferrable.later_many([((1,), {'b': 2}), ((3,), {})])
+        self.assertEqual([], failed_items)
+        self.assertEqual(2, len(event_consumer.mocks['push'].mock_calls))
+        instance.run_once()
+        instance.run_once()
+        my_mock.assert_has_calls([call(1, b=2), call(3)])
+
+    def test_later_many_chunks_by_max_push_batch_size(self):
+        with patch.object(backend.queue, 'MAX_PUSH_BATCH_SIZE', 2):
+            with patch.object(backend.queue, 'push_batch', wraps=backend.queue.push_batch) as push_batch:
+                simple_deferrable.later_many([((index,), {}) for index in range(5)])
+        self.assertEqual(3, push_batch.call_count)
+        self.assertEqual(5, backend.queue.stats()['available'])
+
+    def test_later_many_returns_failed_items(self):
+        def fail_second(items):
+            return [(item, index != 1) for index, item in enumerate(items)]
+        with patch.object(backend.queue, 'push_batch', side_effect=fail_second):
+            failed_items = simple_deferrable.later_many([((index,), {}) for index in range(3)])
+        self.assertEqual(1, len(failed_items))
+        self.assertEqual(2, len(event_consumer.mocks['push'].mock_calls))
+
+    def test_run_batch(self):
+        simple_deferrable.later_many([((1,), {'b': 2}), ((3,), {})])
+        self.assertEqual(2, instance.run_batch(10))
+        self.assertEqual(2, len(event_consumer.mocks['pop'].mock_calls))
+        self.assertEqual(2, len(event_consumer.mocks['complete'].mock_calls))
+        my_mock.assert_has_calls([call(1, b=2), call(3)], any_order=True)
+
+        event_consumer.reset_mocks()
+        self.assertEqual(0, instance.run_batch(10))
+        event_consumer.assert_event_emitted('empty')
+        event_consumer.assert_event_not_emitted('pop')
+
+    def test_run_batch_retries_and_errors(self):
+        retriable_deferrable.later(True)
+        simple_deferrable.later(1)
+        instance.run_batch(10)
+        event_consumer.assert_event_emitted('retry')
+        self.assertEqual(2, len(event_consumer.mocks['complete'].mock_calls))
+        self.assertEqual(1, backend.queue.stats()['available'])
+
+        instance.run_batch(10)
+        instance.run_batch(10)
+        event_consumer.assert_event_emitted('error')
+        self.assertEqual(0, backend.queue.stats()['available'])
+        self.assertEqual(1, backend.error_queue.stats()['available'])
+
+    def test_run_batch_does_not_complete_failed_retry_push(self):
+        retriable_deferrable.later(True)
+        with patch.object(backend.queue, 'push_batch', side_effect=lambda items: [(item, False) for item in items]):
+            instance.run_batch(10)
+        event_consumer.assert_event_not_emitted('retry')
+        event_consumer.assert_event_not_emitted('complete')
+        dockets_queue = backend.queue.queue
+        self.assertEqual(1, dockets_queue.redis.llen(dockets_queue._working_queue_key()))
+        dockets_queue.complete(None)
+
+    def test_later_async(self):
+        simple_deferrable.later_async(1, b=2).get(timeout=5)
+        event_consumer.assert_event_emitted('push')
+        instance.run_once()
+        my_mock.assert_called_once_with(1, b=2)
+
+    def test_run_once_async(self):
+        simple_deferrable.later(1, b=2)
+        instance.run_once_async().get(timeout=5)
+        event_consumer.assert_event_emitted('complete')
+        my_mock.assert_called_once_with(1, b=2)
+
+    def test_process_async(self):
+        simple_deferrable.later(1, b=2)
+        envelope, item = backend.queue.pop()
+        instance.process_async(envelope, item).get(timeout=5)
+        event_consumer.assert_event_emitted('complete')
+        my_mock.assert_called_once_with(1, b=2)
+
+    def test_function_with_codec(self):
+        marshal_deferrable.later(1, b=u"d'\xc9vry")
+        instance.run_once()
+        event_consumer.assert_event_emitted('complete')
+        my_mock.assert_called_once_with(1, b=u"d'\xc9vry")
+
+    def test_items_are_readable_by_older_consumers(self):
+        simple_deferrable.later(1, b=2)
+        envelope, item = backend.queue.pop()
+        legacy_loads = lambda field: pickle.loads(field.decode('string_escape'))
+        self.assertEqual(simple_deferrable, legacy_loads(item['method']))
+        self.assertEqual((1,), legacy_loads(item['args']))
+        self.assertEqual([('b', 2)], legacy_loads(item['kwargs']))
+        self.assertEqual([CustomError], legacy_loads(item['error_classes']))
+        backend.queue.complete(envelope)
+
+    def test_serialized_fields_are_cached(self):
+        with patch('deferrable.deferrable.dumps', wraps=dumps) as mock_dumps:
+            @instance.deferrable
+            def cached_method(*args, **kwargs):
+                pass
+            with patch('deferrable.deferrable.serialize_method', return_value={'method': dumps(simple_deferrable)}) as mock_serialize:
+                cached_method.later(1)
+                cached_method.later(2)
+        self.assertEqual(1, mock_serialize.call_count)
+        self.assertEqual(1, mock_dumps.call_count)
+        self.assertEqual(2, backend.queue.stats()['available'])
+
+    def test_methods_are_registered_when_decorated(self):
+        self.assertIn(__name__ + '.simple_deferrable', registered_method_ids())
+
+    def test_method_ids(self):
+        method_id_deferrable.later(1, b=2)
+        envelope, item = backend.queue.pop()
+        self.assertNotIn('method', item)
+        self.assertEqual(__name__ + '.method_id_deferrable', item['method_id'])
+        instance.process(envelope, item)
+        my_mock.assert_called_once_with(1, b=2)
+
+    def test_method_ids_debounce(self):
+        key = str(uuid1())
+        method_id_deferrable.later(key)
+        method_id_deferrable.later(key)
+        self.assertEqual(1, backend.queue.stats()['available'])
+
+    def test_unpickle_cache(self):
+        instance.unpickle_cache.clear()
+        simple_deferrable.later(1)
+        simple_deferrable.later(2)
+        with patch('deferrable.deferrable.unpickle_method', wraps=unpickle_method) as mock_unpickle:
+            instance.run_once()
+            # Error classes are only decoded if the method raises
+            self.assertEqual(1, event_consumer.mocks['unpickle_cache_miss'].call_count)
+            event_consumer.assert_event_not_emitted('unpickle_cache_hit')
+            instance.run_once()
+            self.assertEqual(1, event_consumer.mocks['unpickle_cache_hit'].call_count)
+        self.assertEqual(1, mock_unpickle.call_count)
+        my_mock.assert_has_calls([call(1), call(2)])
+
+    def test_debounce_cache(self):
+        instance.debounce_cache = TTLCache(10)
+        key = str(uuid1())
+        try:
+            debounced_deferrable_always_delay.later(key, 1)
+            # The clock is only read when Redis is about to be consulted
+            with patch('deferrable.debounce.time') as mock_time:
+                debounced_deferrable_always_delay.later(key, 1)
+                self.assertFalse(mock_time.time.called)
+        finally:
+            instance.debounce_cache = None
+        self.assertEqual(1, event_consumer.mocks['debounce_hit'].call_count)
+        self.assertEqual(1, backend.queue.stats()['delayed'])
+
+    def test_later_many_debounce(self):
+        key = str(uuid1())
+        failed = debounced_deferrable.later_many([((key, 1), {}), ((key, 1), {}), ((key, 1), {}), ((key, 2), {})])
+        self.assertEqual([], failed)
+        self.assertEqual(1, event_consumer.mocks['debounce_hit'].call_count)
+        self.assertEqual(3, event_consumer.mocks['debounce_miss'].call_count)
+        self.assertEqual(3, event_consumer.mocks['push'].call_count)
+        stats = backend.queue.stats()
+        self.assertEqual(2, stats['available'])
+        self.assertEqual(1, stats['delayed'])
+
+    def test_later_many_debounce_error_pushes_immediately(self):
+        with patch('deferrable.deferrable.apply_debounce_batch', side_effect=Exception()):
+            debounced_deferrable.later_many([((str(uuid1()), 1), {})])
+        event_consumer.assert_event_emitted('debounce_error')
+        self.assertEqual(1, backend.queue.stats()['available'])
+
+    def _set_baseline_debounce_key(self, method, *args, **kwargs):
+        # As written by versions which embedded the pickled call in the key
+        baseline_dumps = lambda obj: pickle.dumps(obj).encode('string_escape')
+        key = u"debounce.{}.{}.{}".format(baseline_dumps(method), baseline_dumps(args),
+                                          baseline_dumps(sorted(kwargs.items())))
+        redis_client.set(key, '_', px=1000)
+        self.addCleanup(redis_client.delete, key)
+
+    def test_debounce_honours_baseline_keys(self):
+        for under_test in [debounced_deferrable, method_id_deferrable]:
+            key = str(uuid1())
+            self._set_baseline_debounce_key(under_test, key, 1, b=2)
+            under_test.later(key, 1, b=2)
+            under_test.later_many([((key, 1), {'b': 2})])
+            stats = backend.queue.stats()
+            self.assertEqual(0, stats['available'])
+            self.assertEqual(0, stats['delayed'])
+        self.assertEqual(2, event_consumer.mocks['debounce_hit'].call_count)
+
+    def test_debounce_does_not_decode_method(self):
+        with patch('deferrable.debounce.method_name') as mock_method_name:
+            debounced_deferrable.later(str(uuid1()), 1)
+            debounced_deferrable.later_many([((str(uuid1()), 1), {})])
+        self.assertFalse(mock_method_name.called)
+        self.assertEqual(2, backend.queue.stats()['available'])
+
+    def test_unknown_codec_raises(self):
+        with self.assertRaises(ValueError):
+            instance.deferrable(codec='bacon')(lambda: None)
+
     def test_simple_function_callable_normally(self):
         simple_deferrable('bacon')
         event_consumer.assert_event_not_emitted('push')
@@ -378,6 +647,21 @@ class TestDeferrable(TestCase):
             self.assertFalse(my_mock.called)
             self.tearDown()
 
+    def test_ttl_expiry_does_not_decode_item(self):
+        instance.unpickle_cache.clear()
+        ttl_deferrable.later('beans')
+        ttl_deferrable.later('cornbread')
+        time.sleep(1.5)
+        with patch('deferrable.deferrable.unpickle_args') as mock_unpickle_args:
+            with patch('deferrable.deferrable.unpickle_method', wraps=unpickle_method) as mock_unpickle_method:
+                instance.run_once()
+                instance.run_once()
+        self.assertEqual(2, event_consumer.mocks['expire'].call_count)
+        self.assertFalse(mock_unpickle_args.called)
+        # The method is only logged, through the unpickle cache
+        self.assertEqual(1, mock_unpickle_method.call_count)
+        self.assertEqual(1, event_consumer.mocks['unpickle_cache_hit'].call_count)
+
     def test_simple_function_with_metadata(self):
         metadata_id = uuid1()
         metadata_mock = Mock()
@@ -403,3 +687,82 @@ class TestDeferrable(TestCase):
         instance.register_metadata_producer_consumer(ExampleMetadataProducerConsumer())
         with self.assertRaises(ValueError):
             instance.register_metadata_producer_consumer(ExampleMetadataProducerConsumer())
+
+class TestDeferrableClaimCheck(TestCase):
+    def setUp(self):
+        global RETRIABLE_ALLOW_FAIL
+        RETRIABLE_ALLOW_FAIL = True
+        self.directory = tempfile.mkdtemp()
+        instance.claim_check_store = FileSystemBlobStore(self.directory)
+        instance.claim_check_threshold = 100
+
+    def tearDown(self):
+        instance.claim_check_store = None
+        instance.claim_check_threshold = DEFAULT_CLAIM_CHECK_THRESHOLD
+        shutil.rmtree(self.directory)
+        event_consumer.reset_mocks()
+        backend.queue.flush()
+        backend.error_queue.flush()
+        my_mock.reset_mock()
+
+    def test_small_arguments_are_queued_inline(self):
+        simple_deferrable.later(1, b=2)
+        _, item = backend.queue.pop()
+        self.assertNotIn(CLAIM_CHECK_KEY, item)
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_large_arguments_are_claim_checked_and_released(self):
+        large = 'x' * 1000
+        simple_deferrable.later(large, b=2)
+        self.assertEqual(1, len(os.listdir(self.directory)))
+        instance.run_once()
+        event_consumer.assert_event_emitted('complete')
+        my_mock.assert_called_once_with(large, b=2)
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_queued_item_does_not_contain_arguments(self):
+        simple_deferrable.later('x' * 1000)
+        envelope, item = backend.queue.pop()
+        self.assertIn(CLAIM_CHECK_KEY, item)
+        self.assertNotIn('args', item)
+        self.assertNotIn('kwargs', item)
+        instance.process(envelope, item)
+        my_mock.assert_called_once_with('x' * 1000)
+
+    def test_claim_check_is_kept_across_retries(self):
+        large = 'x' * 1000
+        retriable_deferrable.later(large)
+        instance.run_once()
+        event_consumer.assert_event_emitted('retry')
+        self.assertEqual(1, len(os.listdir(self.directory)))
+        global RETRIABLE_ALLOW_FAIL
+        RETRIABLE_ALLOW_FAIL = False
+        instance.run_once()
+        self.assertEqual(2, my_mock.call_count)
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_claim_check_is_kept_for_error_queue(self):
+        simple_deferrable.later('x' * 1000)
+        my_mock.side_effect = Exception()
+        try:
+            instance.run_once()
+        finally:
+            my_mock.side_effect = None
+        event_consumer.assert_event_emitted('error')
+        self.assertEqual(1, backend.error_queue.stats()['available'])
+        self.assertEqual(1, len(os.listdir(self.directory)))
+
+    def test_run_batch_releases_claim_checks(self):
+        simple_deferrable.later_many([(('x' * 1000,), {}), (('y' * 1000,), {})])
+        self.assertEqual(2, len(os.listdir(self.directory)))
+        instance.run_batch(10)
+        self.assertEqual(2, my_mock.call_count)
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_claim_checked_item_without_store_goes_to_error_queue(self):
+        simple_deferrable.later('x' * 1000)
+        instance.claim_check_store = None
+        instance.run_once()
+        event_consumer.assert_event_emitted('error')
+        self.assertFalse(my_mock.called)
+        self.assertEqual(1, backend.error_queue.stats()['available'])
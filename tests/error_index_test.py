@@ -0,0 +1,85 @@
+import os
+import time
+from unittest import TestCase
+from redis import StrictRedis
+
+from deferrable.error_index import InMemoryErrorIndex, RedisErrorIndex, HOUR_SECONDS
+from deferrable.pickling import serialize_method
+
+def failing_method():
+    pass
+
+def other_method():
+    pass
+
+METHOD = __name__ + '.failing_method'
+OTHER_METHOD = __name__ + '.other_method'
+
+def error_item(error_id, error_type, method=failing_method, ts=None):
+    item = {'error': {'id': error_id, 'error_type': error_type, 'ts': ts or time.time()}}
+    item.update(serialize_method(method))
+    return item
+
+class ErrorIndexTestMixin(object):
+    def test_top(self):
+        for i in range(3):
+            self.index.record('testing', error_item(str(i), 'KeyError'))
+        self.index.record('testing', error_item('3', 'ValueError'))
+        self.index.record('testing', error_item('4', 'KeyError', method=other_method))
+        self.index.record('other', error_item('5', 'KeyError'))
+
+        self.assertEqual([{'method': METHOD, 'error_type': 'KeyError', 'count': 3},
+                          {'method': METHOD, 'error_type': 'ValueError', 'count': 1},
+                          {'method': OTHER_METHOD, 'error_type': 'KeyError', 'count': 1}],
+                         sorted(self.index.top('testing'), key=lambda row: (-row['count'], row['method'], row['error_type'])))
+        self.assertEqual([{'error_type': 'KeyError', 'count': 4}], self.index.top('testing', by=['error_type'], n=1))
+        self.assertEqual([{'method': METHOD, 'count': 4}, {'method': OTHER_METHOD, 'count': 1}],
+                         self.index.top('testing', by=['method']))
+
+    def test_time_range(self):
+        now = time.time()
+        self.index.record('testing', error_item('1', 'KeyError', ts=now - 2 * HOUR_SECONDS))
+        self.index.record('testing', error_item('2', 'KeyError', ts=now))
+        self.assertEqual(2, self.index.top('testing', by=['method'])[0]['count'])
+        self.assertEqual(1, self.index.top('testing', by=['method'], since=now - HOUR_SECONDS)[0]['count'])
+        by_hour = self.index.top('testing', by=['hour'])
+        self.assertEqual(sorted([int(now // HOUR_SECONDS) * HOUR_SECONDS,
+                                 int((now - 2 * HOUR_SECONDS) // HOUR_SECONDS) * HOUR_SECONDS]),
+                         sorted(row['hour'] for row in by_hour))
+
+    def test_unknown_dimension(self):
+        with self.assertRaises(ValueError):
+            self.index.top('testing', by=['hostname'])
+
+    def test_recent_ids(self):
+        for i in range(5):
+            self.index.record('testing', error_item(str(i), 'KeyError'))
+        self.assertEqual(['4', '3', '2'], self.index.recent_ids('testing', METHOD, 'KeyError'))
+        self.assertEqual([], self.index.recent_ids('testing', METHOD, 'ValueError'))
+
+class TestInMemoryErrorIndex(ErrorIndexTestMixin, TestCase):
+    def setUp(self):
+        self.index = InMemoryErrorIndex(recent_ids_size=3)
+
+    def test_old_hours_are_dropped(self):
+        index = InMemoryErrorIndex(retention_hours=1)
+        index.record('testing', error_item('1', 'KeyError', ts=time.time() - 3 * HOUR_SECONDS))
+        index.record('testing', error_item('2', 'KeyError'))
+        self.assertEqual(1, index.top('testing', by=['method'])[0]['count'])
+
+class TestRedisErrorIndex(ErrorIndexTestMixin, TestCase):
+    def setUp(self):
+        self.redis_client = StrictRedis(host=os.getenv("DEFERRABLE_TEST_REDIS_HOST","redis"), db=15)
+        self.index = RedisErrorIndex(self.redis_client, prefix='test.error_index', recent_ids_size=3)
+        self.addCleanup(self._delete_keys)
+        self._delete_keys()
+
+    def _delete_keys(self):
+        keys = self.redis_client.keys('test.error_index.*')
+        if keys:
+            self.redis_client.delete(*keys)
+
+    def test_keys_expire(self):
+        self.index.record('testing', error_item('1', 'KeyError'))
+        for key in self.redis_client.keys('test.error_index.*'):
+            self.assertGreater(self.redis_client.ttl(key), 0)
@@ -0,0 +1,43 @@
+from unittest import TestCase
+from mock import Mock
+
+from deferrable.item import LazyItem
+from deferrable.pickling import build_later_item, dumps
+
+def test_method(*args, **kwargs):
+    pass
+
+class TestLazyItem(TestCase):
+    def setUp(self):
+        self.item = build_later_item(test_method, 'a', b='c')
+        self.item['error_classes'] = dumps([ValueError])
+
+    def test_decodes_fields(self):
+        lazy_item = LazyItem(self.item)
+        self.assertIs(test_method, lazy_item.method)
+        self.assertEqual(('a',), lazy_item.args)
+        self.assertEqual({'b': 'c'}, lazy_item.kwargs)
+        self.assertEqual((ValueError,), lazy_item.error_classes)
+
+    def test_nothing_decoded_until_accessed(self):
+        method_loader, args_loader, error_classes_loader = Mock(), Mock(), Mock()
+        lazy_item = LazyItem(self.item, method_loader, args_loader, error_classes_loader)
+        for field in ['method', 'args', 'kwargs', 'error_classes']:
+            self.assertFalse(lazy_item.is_decoded(field))
+        self.assertFalse(method_loader.called)
+        self.assertFalse(args_loader.called)
+        self.assertFalse(error_classes_loader.called)
+
+    def test_fields_decoded_once(self):
+        args_loader = Mock(return_value=(('a',), {'b': 'c'}))
+        lazy_item = LazyItem(self.item, args_loader=args_loader)
+        lazy_item.args
+        lazy_item.kwargs
+        lazy_item.args
+        args_loader.assert_called_once_with(self.item)
+        self.assertTrue(lazy_item.is_decoded('kwargs'))
+        self.assertFalse(lazy_item.is_decoded('method'))
+
+    def test_missing_error_classes(self):
+        self.item['error_classes'] = dumps(None)
+        self.assertEqual((), LazyItem(self.item).error_classes)
@@ -1,11 +1,17 @@
 from unittest import TestCase
 from mock import Mock
 
-from deferrable.pickling import pretty_unpickle, build_later_item, unpickle_method_call
+import cPickle as pickle
+
+from deferrable.pickling import (pretty_unpickle, build_later_item, build_later_item_with_codec, unpickle_method_call,
+                                 loads, dumps, validate_compression, encode_item, decode_item, is_encoded_item, payload_stats, ENVELOPE_HEADER)
 
 def test_method(*args, **kwargs):
     pass
 
+def legacy_dumps(obj):
+    return pickle.dumps(obj).encode('string_escape')
+
 class TestPickling(TestCase):
     def test_pickle_and_unpickle_item(self):
         item = build_later_item(test_method, 'a', b='c')
@@ -18,3 +24,69 @@ class TestPickling(TestCase):
         # Just a weak test to make sure it doesn't throw anything
         item = build_later_item(test_method, 'a', b='c')
         print pretty_unpickle(item)
+
+    def test_pretty_unpickle_claim_checked_item(self):
+        item = build_later_item(test_method, 'a', b='c')
+        del item['args'], item['kwargs']
+        item['claim_check'] = 'some-key'
+        self.assertIn('<claim check some-key>', pretty_unpickle(item))
+
+    def test_dumps_uses_binary_protocol(self):
+        self.assertTrue(dumps(('a',)).startswith('\x80'))
+        self.assertEqual(('a',), loads(dumps(('a',))))
+
+    def test_legacy_dumps(self):
+        self.assertEqual(legacy_dumps(('a',)), dumps(('a',), legacy=True))
+
+    def test_build_legacy_item(self):
+        item = build_later_item_with_codec('pickle', test_method, ('a',), {'b': 'c'}, legacy=True)
+        self.assertEqual(legacy_dumps(test_method), item['method'])
+        self.assertEqual(legacy_dumps(('a',)), item['args'])
+        self.assertEqual(legacy_dumps([('b', 'c')]), item['kwargs'])
+
+    def test_compression_requires_envelopes(self):
+        validate_compression('zlib', use_envelopes=True)
+        with self.assertRaises(ValueError):
+            validate_compression('zlib', use_envelopes=False)
+
+    def test_loads_legacy_string_escaped_pickle(self):
+        self.assertEqual((u"d'\xc9vry",), loads(legacy_dumps((u"d'\xc9vry",))))
+        self.assertEqual((u"d'\xc9vry",), loads(unicode(legacy_dumps((u"d'\xc9vry",)))))
+
+    def test_unpickle_legacy_item(self):
+        item = {'method': legacy_dumps(test_method), 'args': legacy_dumps(('a',)),
+                'kwargs': legacy_dumps([('b', 'c')])}
+        self.assertEqual((test_method, ('a',), {'b': 'c'}), unpickle_method_call(item))
+
+    def test_encode_and_decode_item(self):
+        item = build_later_item(test_method, 'a', b='c')
+        payload = encode_item(item)
+        self.assertTrue(is_encoded_item(payload))
+        self.assertEqual(item, decode_item(payload))
+
+    def test_decode_legacy_item(self):
+        item = {'method': legacy_dumps(test_method), 'attempts': 0}
+        self.assertEqual(item, decode_item(legacy_dumps(item)))
+
+    def test_decode_newer_version_raises(self):
+        payload = encode_item({})
+        _, version, flags = ENVELOPE_HEADER.unpack_from(payload)
+        payload = ENVELOPE_HEADER.pack('\xde\xfe', version + 1, flags) + payload[ENVELOPE_HEADER.size:]
+        with self.assertRaises(ValueError):
+            decode_item(payload)
+
+    def test_encode_item_with_compression(self):
+        item = {'args': dumps(('a' * 10000,))}
+        for compression in ['zlib', 'bz2']:
+            payload = encode_item(item, compression=compression)
+            self.assertEqual(item, decode_item(payload))
+            stats = payload_stats(payload)
+            self.assertEqual(compression, stats['compression'])
+            self.assertEqual(len(payload), stats['encoded_size'])
+            self.assertLess(stats['encoded_size'], stats['raw_size'])
+
+    def test_encode_item_below_compression_threshold(self):
+        item = {'args': dumps(('a' * 100,))}
+        payload = encode_item(item, compression='zlib', compression_threshold=1000)
+        self.assertIsNone(payload_stats(payload)['compression'])
+        self.assertEqual(item, decode_item(payload))
@@ -0,0 +1,67 @@
+import os
+import time
+import threading
+
+from unittest import TestCase
+from redis import StrictRedis
+
+from deferrable import Deferrable
+from deferrable.backend.dockets import DocketsBackendFactory
+from deferrable.prefork import PreforkSupervisor, EventCounter
+
+redis_client = StrictRedis(host=os.getenv("DEFERRABLE_TEST_REDIS_HOST","redis"))
+factory = DocketsBackendFactory(redis_client, wait_time=0)
+backend = factory.create_backend_for_group('prefork_testing')
+instance = Deferrable(backend, redis_client=redis_client)
+
+@instance.deferrable
+def record_pid(key):
+    redis_client.rpush(key, os.getpid())
+
+class TestEventCounter(TestCase):
+    def test_counts_events(self):
+        counter = EventCounter()
+        counter.on_push({})
+        counter.on_push({})
+        counter.on_complete({})
+        self.assertEqual({'push': 2, 'complete': 1}, counter.snapshot())
+
+    def test_ignores_other_attributes(self):
+        self.assertFalse(hasattr(EventCounter(), 'something_else'))
+
+class TestPreforkSupervisor(TestCase):
+    def setUp(self):
+        self.key = 'prefork_testing.pids'
+
+    def tearDown(self):
+        backend.queue.flush()
+        backend.error_queue.flush()
+        redis_client.delete(self.key)
+
+    def _run_until_completed(self, supervisor, count, timeout=10):
+        def stop_when_done():
+            deadline = time.time() + timeout
+            while supervisor.event_counts.get('complete', 0) < count and time.time() < deadline:
+                time.sleep(0.05)
+            supervisor.stop()
+        stopper = threading.Thread(target=stop_when_done)
+        stopper.start()
+        supervisor.run()
+        stopper.join()
+
+    def test_processes_items_in_children_and_aggregates_events(self):
+        record_pid.later_many([((self.key,), {}) for _ in range(6)])
+        supervisor = PreforkSupervisor(instance, processes=2, poll_interval=0.05)
+        self._run_until_completed(supervisor, 6)
+        self.assertEqual(6, supervisor.event_counts['complete'])
+        self.assertEqual(6, supervisor.event_counts['pop'])
+        pids = set(redis_client.lrange(self.key, 0, -1))
+        self.assertNotIn(str(os.getpid()), pids)
+        self.assertEqual({}, supervisor._children)
+
+    def test_recycles_children_after_max_tasks(self):
+        record_pid.later_many([((self.key,), {}) for _ in range(4)])
+        supervisor = PreforkSupervisor(instance, processes=1, max_tasks_per_child=1, poll_interval=0.05)
+        self._run_until_completed(supervisor, 4)
+        self.assertEqual(4, supervisor.event_counts['complete'])
+        self.assertEqual(4, len(set(redis_client.lrange(self.key, 0, -1))))
@@ -1,8 +1,11 @@
 """Tests for basic queue behavior (push, pop, complete) across all
 queue implementations."""
 
+import atexit
 import logging
 import os
+import shutil
+import tempfile
 import time
 
 from unittest import TestCase
@@ -14,6 +17,11 @@ from boto.sqs.connection import SQSConnection
 from deferrable.backend.dockets import DocketsBackendFactory
 from deferrable.backend.memory import InMemoryBackendFactory
 from deferrable.backend.sqs import SQSBackendFactory
+from deferrable.backend.sqlite import SQLiteBackendFactory
+from deferrable.backend.segmented_log import SegmentedLogBackendFactory
+
+TEMP_DIRECTORY = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, TEMP_DIRECTORY, True)
 
 class TestAllQueueImplementations(TestCase):
     def setUp(self):
@@ -48,6 +56,22 @@ class TestAllQueueImplementations(TestCase):
             print "Testing Memory Queue..."
         yield backend.queue
 
+        backend = SQLiteBackendFactory(os.path.join(TEMP_DIRECTORY, 'base_test.db')).create_backend_for_group('testing')
+        if verbose:
+            print "Testing SQLite Queue..."
+        yield backend.queue
+        if verbose:
+            print "Testing SQLite Error Queue..."
+        yield backend.error_queue
+
+        backend = SegmentedLogBackendFactory(os.path.join(TEMP_DIRECTORY, 'segmented_log')).create_backend_for_group('testing')
+        if verbose:
+            print "Testing Segmented Log Queue..."
+        yield backend.queue
+        if verbose:
+            print "Testing Segmented Log Error Queue..."
+        yield backend.error_queue
+
         fake_sqs = mock_sqs()
         fake_sqs.start()
         factory = SQSBackendFactory(lambda: SQSConnection(), wait_time=None)
@@ -1,9 +1,15 @@
 from unittest import TestCase
+from mock import patch
 from redis import StrictRedis
+import cPickle as pickle
+import marshal
+import simplejson
+import time
 import os
 
 from deferrable.backend.dockets import DocketsBackendFactory
-from deferrable.queue.dockets import DocketsQueue, DocketsErrorQueue
+from deferrable.queue.dockets import DocketsQueue, DocketsErrorQueue, DocketsSerializer
+from deferrable.pickling import PAYLOAD_STATS_KEY, is_encoded_item, dumps
 
 class TestDocketsQueue(TestCase):
     def setUp(self):
@@ -16,5 +22,174 @@ class TestDocketsQueue(TestCase):
         error_queue = self.queue.make_error_queue()
         self.assertIsInstance(error_queue, DocketsErrorQueue)
 
+    def test_pop_legacy_json_envelope(self):
+        legacy_item = {'args': pickle.dumps(('a',)).encode('string_escape'), 'attempts': 0}
+        envelope = {'first_ts': time.time(), 'ts': time.time(), 'item': legacy_item, 'v': 1,
+                    'ttl': None, 'attempts': 0, 'max_attempts': 3, 'error_classes': pickle.dumps(None)}
+        dockets_queue = self.queue.queue
+        self.redis_client.lpush(dockets_queue._queue_key(), simplejson.dumps(envelope, sort_keys=True))
+        try:
+            popped_envelope, item = self.queue.pop()
+            self.assertIsNone(item.pop(PAYLOAD_STATS_KEY)['compression'])
+            self.assertEqual(legacy_item, item)
+            self.queue.complete(popped_envelope)
+        finally:
+            self.queue.flush()
+
+    def test_push_pop_compressed(self):
+        backend = DocketsBackendFactory(self.redis_client, wait_time=0, compression='bz2', use_envelopes=True).create_backend_for_group('test')
+        try:
+            item = {'args': 'a' * 10000, 'error': {'id': 'test_compressed'}}
+            for queue in [backend.queue, backend.error_queue]:
+                queue.push(item)
+                self.assertEqual('bz2', item[PAYLOAD_STATS_KEY]['compression'])
+                envelope, popped_item = queue.pop()
+                self.assertEqual(item['args'], popped_item['args'])
+                self.assertEqual('bz2', popped_item[PAYLOAD_STATS_KEY]['compression'])
+                queue.complete(envelope)
+        finally:
+            backend.queue.flush()
+            backend.error_queue.flush()
+
+    def test_complete_out_of_order_removes_own_envelope(self):
+        queue = DocketsBackendFactory(self.redis_client, wait_time=0).create_backend_for_group('out_of_order').queue
+        queue.flush()
+        self.addCleanup(queue.flush)
+        queue.push_batch([{'id': i} for i in range(3)])
+        popped = [queue.pop() for _ in range(3)]
+        self.assertTrue(queue.complete(popped[1][0]))
+        self.assertFalse(queue.complete(popped[1][0]))
+        self.assertEqual([(popped[2][0], True)], queue.complete_batch([popped[2][0]]))
+        # Only the envelope which was not completed is left to be reclaimed
+        working = self.redis_client.lrange(queue.queue._working_queue_key(), 0, -1)
+        self.assertEqual([popped[0][0].serialized_envelope], working)
+
+    def _count_pipelines(self, queue):
+        """Counts the pipelines executed by the queue's Redis client."""
+        executed = []
+        redis_client = queue.queue.redis
+        original_pipeline = redis_client.pipeline
+        def pipeline(*args, **kwargs):
+            pipe = original_pipeline(*args, **kwargs)
+            original_execute = pipe.execute
+            def execute(*args, **kwargs):
+                executed.append(pipe)
+                return original_execute(*args, **kwargs)
+            pipe.execute = execute
+            return pipe
+        redis_client.pipeline = pipeline
+        self.addCleanup(delattr, redis_client, 'pipeline')
+        return executed
+
+    def test_batch_operations_use_one_pipeline_each(self):
+        queue = DocketsBackendFactory(self.redis_client, wait_time=0).create_backend_for_group('batch').queue
+        queue.flush()
+        self.addCleanup(queue.flush)
+        executed = self._count_pipelines(queue)
+
+        result = queue.push_batch([{'id': i} for i in range(20)])
+        self.assertTrue(all(success for _, success in result))
+        self.assertEqual(1, len(executed))
+
+        batch = queue.pop_batch(15)
+        self.assertEqual(range(15), [item['id'] for _, item in batch])
+        self.assertEqual(2, len(executed))
+
+        result = queue.complete_batch([envelope for envelope, _ in batch])
+        self.assertTrue(all(success for _, success in result))
+        self.assertEqual(3, len(executed))
+        self.assertEqual({'available': 5, 'in_flight': 0, 'delayed': 0}, queue.stats())
+
+    def test_pop_batch_moves_due_delayed_items(self):
+        queue = DocketsBackendFactory(self.redis_client, wait_time=0).create_backend_for_group('batch').queue
+        queue.flush()
+        self.addCleanup(queue.flush)
+        queue.push_batch([{'id': 1, 'delay': 0.1}, {'id': 2}])
+        self.assertEqual([2], [item['id'] for _, item in queue.pop_batch(10)])
+        time.sleep(0.11)
+        self.assertEqual([1], [item['id'] for _, item in queue.pop_batch(10)])
+
+    def test_pop_batch_skips_undeserializable_envelopes(self):
+        queue = DocketsBackendFactory(self.redis_client, wait_time=0).create_backend_for_group('batch').queue
+        queue.flush()
+        self.addCleanup(queue.flush)
+        queue.push({'id': 1})
+        self.redis_client.lpush(queue.queue._queue_key(), 'not an envelope')
+        queue.push({'id': 2})
+        self.assertEqual([1, 2], [item['id'] for _, item in queue.pop_batch(10)])
+        # The bad envelope was removed from the working queue
+        self.assertEqual(2, self.redis_client.llen(queue.queue._working_queue_key()))
+
+    def test_pop_batch_blocks_for_first_item(self):
+        queue = DocketsBackendFactory(self.redis_client, wait_time=1).create_backend_for_group('batch').queue
+        queue.flush()
+        self.addCleanup(queue.flush)
+        self.assertEqual([], queue.pop_batch(10))
+
+class TestDocketsSerializer(TestCase):
+    def test_small_payloads_are_not_compressed(self):
+        serializer = DocketsSerializer(compression='zlib', use_envelopes=True)
+        envelope = {'item': {'args': 'a'}}
+        self.assertEqual(envelope, serializer.deserialize(serializer.serialize(envelope)))
+        self.assertIsNone(envelope['item'][PAYLOAD_STATS_KEY]['compression'])
+
+    def test_unsupported_compression_raises(self):
+        with self.assertRaises(ValueError):
+            DocketsSerializer(compression='bacon')
+        with self.assertRaises(ValueError):
+            DocketsSerializer(compression='zlib')
+
+    def test_writes_legacy_json_by_default(self):
+        serializer = DocketsSerializer()
+        envelope = {'item': {'args': pickle.dumps(('a',)).encode('string_escape'), 'codec': 'pickle'}}
+        payload = serializer.serialize(envelope)
+        self.assertEqual(envelope['item']['args'], simplejson.loads(payload)['item']['args'])
+        self.assertEqual(envelope, serializer.deserialize(payload))
+
+    def test_writes_envelopes_for_items_older_consumers_cannot_read(self):
+        serializer = DocketsSerializer()
+        envelope = {'item': {'args': marshal.dumps((u"d'\xc9vry",)), 'codec': 'marshal'}}
+        self.assertTrue(is_encoded_item(serializer.serialize(envelope)))
+        # e.g. a retry of an item written by a producer with use_envelopes
+        envelope = {'item': {'args': dumps((u"d'\xc9vry",)), 'codec': 'pickle'}}
+        self.assertTrue(is_encoded_item(serializer.serialize(envelope)))
+        self.assertEqual(envelope, serializer.deserialize(serializer.serialize(envelope)))
+
 class TestDocketsErrorQueue(TestCase):
-    pass
+    def setUp(self):
+        self.redis_client = StrictRedis(host=os.getenv("DEFERRABLE_TEST_REDIS_HOST","redis"))
+        self.backend = DocketsBackendFactory(self.redis_client).create_backend_for_group('test_errors')
+        self.error_queue = self.backend.error_queue
+        self.error_queue.flush()
+        self.addCleanup(self.error_queue.flush)
+        self.error_queue.push_batch([{'id': i, 'error': {'id': 'error_{}'.format(i)}} for i in range(1200)])
+
+    def test_pop_and_pop_batch_do_not_fetch_every_key(self):
+        with patch.object(self.redis_client, 'hkeys') as hkeys:
+            envelope, item = self.error_queue.pop()
+            batch = self.error_queue.pop_batch(100)
+        self.assertFalse(hkeys.called)
+        self.assertIsNotNone(item)
+        self.assertEqual(100, len(batch))
+        self.assertEqual(100, len(set(item['id'] for _, item in batch)))
+
+    def test_iter_errors_yields_every_error_once_while_completing(self):
+        seen = set()
+        for envelope, item in self.error_queue.iter_errors(batch_size=100):
+            seen.add(item['id'])
+            self.error_queue.complete(envelope)
+        self.assertEqual(set(range(1200)), seen)
+        self.assertEqual(0, self.error_queue.stats()['available'])
+
+    def test_complete_batch_reports_each_envelope(self):
+        batch = self.error_queue.pop_batch(10)
+        envelopes = [envelope for envelope, _ in batch]
+        self.error_queue.complete(envelopes[0])
+        result = self.error_queue.complete_batch(envelopes)
+        self.assertEqual([False] + [True] * 9, [success for _, success in result])
+        self.assertEqual(1190, self.error_queue.stats()['available'])
+
+    def test_flush(self):
+        self.error_queue.flush()
+        self.assertEqual(0, self.error_queue.stats()['available'])
+        self.assertEqual((None, None), self.error_queue.pop())
@@ -1,29 +1,102 @@
 from unittest import TestCase
 import time
+import threading
+
+from mock import patch
 
 from deferrable.backend.memory import InMemoryBackendFactory
 from deferrable.queue.memory import InMemoryQueue
 
 class TestInMemoryQueue(TestCase):
     def setUp(self):
-        self.factory = InMemoryBackendFactory()
+        self.factory = InMemoryBackendFactory(visibility_timeout=0.1)
         self.backend = self.factory.create_backend_for_group('test')
         self.queue = self.backend.queue
-        self.main_queue = self.queue.queue
-        self.delay_queue = self.queue.delay_queue
 
-    def test_push_to_delay_queue(self):
-        self.queue._push_to_delay_queue(1, 1)
-        self.assertEqual(1, self.delay_queue.qsize())
-        self.assertEqual(0, self.main_queue.qsize())
+    def test_push_with_delay(self):
+        self.queue.push({'id': 1, 'delay': 0.1})
+        self.assertEqual({'available': 0, 'in_flight': 0, 'delayed': 1}, self.queue.stats())
+        self.assertEqual((None, None), self.queue.pop())
+
+        time.sleep(0.11)
+        self.assertEqual({'available': 1, 'in_flight': 0, 'delayed': 0}, self.queue.stats())
+        envelope, item = self.queue.pop()
+        self.assertEqual({'id': 1, 'delay': 0.1}, item)
+
+    def test_delayed_items_are_ordered_by_due_time(self):
+        self.queue.push({'id': 1, 'delay': 0.2})
+        self.queue.push({'id': 2, 'delay': 0.1})
+        time.sleep(0.21)
+        self.assertEqual([2, 1], [item['id'] for _, item in self.queue.pop_batch(2)])
+
+    def test_blocking_pop_wakes_when_delayed_item_is_due(self):
+        queue = InMemoryQueue('test', timeout=5)
+        queue.push({'id': 1, 'delay': 0.1})
+        start = time.time()
+        envelope, item = queue.pop()
+        self.assertEqual(1, item['id'])
+        self.assertLess(time.time() - start, 1)
 
-    def test_move_from_delay_queue(self):
-        self.queue._push_to_delay_queue(1, 0.1)
-        self.queue._move_from_delay_queue()
-        self.assertEqual(1, self.delay_queue.qsize())
-        self.assertEqual(0, self.main_queue.qsize())
+    def test_blocking_pop_wakes_on_push(self):
+        queue = InMemoryQueue('test', timeout=5)
+        timer = threading.Timer(0.05, queue.push, [{'id': 1}])
+        timer.start()
+        start = time.time()
+        envelope, item = queue.pop()
+        timer.join()
+        self.assertEqual(1, item['id'])
+        self.assertLess(time.time() - start, 1)
 
+    def test_blocking_pop_times_out(self):
+        queue = InMemoryQueue('test', timeout=0.05)
+        self.assertEqual((None, None), queue.pop())
+
+    def test_in_flight_until_complete(self):
+        self.queue.push({'id': 1})
+        envelope, item = self.queue.pop()
+        self.assertEqual({'available': 0, 'in_flight': 1, 'delayed': 0}, self.queue.stats())
+        self.assertTrue(self.queue.complete(envelope))
+        self.assertEqual({'available': 0, 'in_flight': 0, 'delayed': 0}, self.queue.stats())
+        self.assertFalse(self.queue.complete(envelope))
+
+    def test_reclaims_expired_in_flight_items_to_back_of_queue(self):
+        self.queue.push({'id': 1})
+        envelope, item = self.queue.pop()
+        self.queue.push({'id': 2})
         time.sleep(0.11)
-        self.queue._move_from_delay_queue()
-        self.assertEqual(0, self.delay_queue.qsize())
-        self.assertEqual(1, self.main_queue.qsize())
+        self.assertEqual({'available': 2, 'in_flight': 0, 'delayed': 0}, self.queue.stats())
+        self.assertEqual([2, 1], [item['id'] for _, item in self.queue.pop_batch(2)])
+        # The stale envelope cannot complete the redelivered item
+        self.assertFalse(self.queue.complete(envelope))
+        self.assertEqual(2, self.queue.stats()['in_flight'])
+
+    def test_touch_extends_visibility(self):
+        clock = [1000.0]
+        with patch('deferrable.queue.memory.time') as mock_time:
+            mock_time.time.side_effect = lambda: clock[0]
+            self.queue.push({'id': 1})
+            envelope, item = self.queue.pop()
+            clock[0] += 0.06
+            self.assertTrue(self.queue.touch(envelope, 0.1))
+            # Past the original visibility timeout, but within the touched one
+            clock[0] += 0.06
+            self.assertEqual(1, self.queue.stats()['in_flight'])
+            clock[0] += 0.05
+            self.assertEqual(0, self.queue.stats()['in_flight'])
+            self.assertFalse(self.queue.touch(envelope, 0.1))
+
+    def test_pop_batch_and_complete_batch(self):
+        self.queue.push_batch([{'id': i} for i in range(5)])
+        batch = self.queue.pop_batch(3)
+        self.assertEqual([0, 1, 2], [item['id'] for _, item in batch])
+        result = self.queue.complete_batch([envelope for envelope, _ in batch])
+        self.assertTrue(all(success for _, success in result))
+        self.assertEqual({'available': 2, 'in_flight': 0, 'delayed': 0}, self.queue.stats())
+
+    def test_flush(self):
+        self.queue.push({'id': 1})
+        self.queue.push({'id': 2, 'delay': 10})
+        self.queue.pop()
+        self.queue.push({'id': 3})
+        self.queue.flush()
+        self.assertEqual({'available': 0, 'in_flight': 0, 'delayed': 0}, self.queue.stats())
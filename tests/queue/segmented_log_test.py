@@ -0,0 +1,165 @@
+import os
+import time
+import fcntl
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from unittest import TestCase
+
+from deferrable.backend.segmented_log import SegmentedLogBackendFactory
+from deferrable.pickling import PAYLOAD_STATS_KEY
+from deferrable.queue.segmented_log import RECORD_HEADER
+
+def push_from_other_process(directory, count):
+    queue = SegmentedLogBackendFactory(directory).create_backend_for_group('test').queue
+    # The child inherits the parent's log state, which it must not use
+    queue.reset_connections()
+    queue.push_batch([{'id': i} for i in range(count)])
+
+class TestSegmentedLogQueue(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.factory = SegmentedLogBackendFactory(self.directory, visibility_timeout=0.1, poll_interval=0.01)
+        self.backend = self.factory.create_backend_for_group('test')
+        self.queue = self.backend.queue
+
+    def tearDown(self):
+        for queue in (self.backend.queue, self.backend.error_queue):
+            queue.reset_connections()
+        shutil.rmtree(self.directory)
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.queue.directory) if name.endswith('.log'))
+
+    def _restart(self):
+        """Drop all in-process state, as if the consuming process had restarted."""
+        self.queue.reset_connections()
+
+    def test_items_are_durable(self):
+        self.queue.push({'id': 1})
+        self._restart()
+        envelope, item = self.queue.pop()
+        self.assertEqual(1, item['id'])
+
+    def test_completed_items_are_not_redelivered_after_restart(self):
+        self.queue.push_batch([{'id': i} for i in range(3)])
+        envelope, item = self.queue.pop()
+        self.queue.complete(envelope)
+        # Popped but not completed, so it must be redelivered
+        self.queue.pop()
+        self._restart()
+        self.assertEqual({'available': 2, 'in_flight': 0, 'delayed': 0}, self.queue.stats())
+        self.assertEqual([1, 2], [item['id'] for _, item in self.queue.pop_batch(10)])
+
+    def test_queues_are_separate(self):
+        self.queue.push({'id': 1})
+        self.assertEqual(0, self.backend.error_queue.stats()['available'])
+        self.assertEqual(0, self.factory.create_backend_for_group('other').queue.stats()['available'])
+
+    def test_binary_and_compressed_payloads(self):
+        queue = SegmentedLogBackendFactory(self.directory, compression='zlib').create_backend_for_group('compressed').queue
+        item = {'args': '\x80\x00\xff' * 1000}
+        queue.push(item)
+        envelope, popped_item = queue.pop()
+        self.assertEqual(item['args'], popped_item['args'])
+        self.assertEqual('zlib', popped_item[PAYLOAD_STATS_KEY]['compression'])
+        queue.reset_connections()
+
+    def test_push_with_delay(self):
+        self.queue.push({'id': 1, 'delay': 0.1})
+        self.assertEqual({'available': 0, 'in_flight': 0, 'delayed': 1}, self.queue.stats())
+        self.assertEqual((None, None), self.queue.pop())
+        time.sleep(0.11)
+        envelope, item = self.queue.pop()
+        self.assertEqual(1, item['id'])
+
+    def test_reclaims_expired_in_flight_items(self):
+        self.queue.push({'id': 1})
+        envelope, item = self.queue.pop()
+        time.sleep(0.11)
+        self.assertEqual(1, self.queue.stats()['available'])
+        redelivered_envelope, item = self.queue.pop()
+        self.assertEqual(1, item['id'])
+        # The stale envelope can neither touch nor complete the redelivered item
+        self.assertFalse(self.queue.touch(envelope, 10))
+        self.assertFalse(self.queue.complete(envelope))
+        self.assertTrue(self.queue.complete(redelivered_envelope))
+
+    def test_touch_extends_visibility(self):
+        self.queue.push({'id': 1})
+        envelope, item = self.queue.pop()
+        self.assertTrue(self.queue.touch(envelope, 10))
+        time.sleep(0.11)
+        self.assertEqual(1, self.queue.stats()['in_flight'])
+
+    def test_segments_roll_over_and_are_compacted_once_completed(self):
+        queue = SegmentedLogBackendFactory(self.directory, segment_size=256).create_backend_for_group('test').queue
+        for i in range(10):
+            queue.push({'id': i, 'padding': 'x' * 100})
+        self.assertGreater(len(self._segments()), 2)
+        batch = queue.pop_batch(10)
+        self.assertEqual(range(10), [item['id'] for _, item in batch])
+        queue.complete_batch([envelope for envelope, _ in batch[:-1]])
+        # Only the newest segment, which may still be appended to, is kept
+        self.assertEqual(1, len(self._segments()))
+        queue.complete(batch[-1][0])
+        self.assertEqual(1, len(self._segments()))
+
+    def test_partial_record_is_repaired_before_appending(self):
+        self.queue.push({'id': 1})
+        self._restart()
+        path = os.path.join(self.queue.directory, self._segments()[-1])
+        with open(path, 'ab') as f:
+            # A record whose payload was never fully written
+            f.write(RECORD_HEADER.pack(1000, 0) + 'partial')
+        self.queue.push({'id': 2})
+        self.assertEqual([1, 2], [item['id'] for _, item in self.queue.pop_batch(10)])
+
+    def test_only_one_process_may_consume(self):
+        self.queue.stats()
+        with open(os.path.join(self.queue.directory, 'consume.lock'), 'a') as lock_file:
+            self.assertRaises(IOError, fcntl.flock, lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_pushes_from_other_processes(self):
+        self.queue.push({'id': 'local'})
+        process = multiprocessing.Process(target=push_from_other_process, args=(self.directory, 5))
+        process.start()
+        process.join()
+        self.assertEqual(6, len(self.queue.pop_batch(10)))
+
+    def test_flush(self):
+        self.queue.push_batch([{'id': i} for i in range(3)])
+        self.queue.pop()
+        self.queue.flush()
+        self.assertEqual({'available': 0, 'in_flight': 0, 'delayed': 0}, self.queue.stats())
+        self.assertEqual([], self._segments())
+        self.queue.push({'id': 4})
+        envelope, item = self.queue.pop()
+        self.assertEqual(4, item['id'])
+
+    def test_blocking_pop(self):
+        queue = SegmentedLogBackendFactory(self.directory, timeout=5).create_backend_for_group('test').queue
+        timer = threading.Timer(0.05, self.queue.push, [{'id': 1}])
+        timer.start()
+        start = time.time()
+        envelope, item = queue.pop()
+        timer.join()
+        self.assertEqual(1, item['id'])
+        self.assertLess(time.time() - start, 1)
+
+    def test_concurrent_poppers_receive_distinct_items(self):
+        self.queue.push_batch([{'id': i} for i in range(100)])
+        received = []
+        def pop_all():
+            while True:
+                batch = self.queue.pop_batch(7)
+                if not batch:
+                    return
+                received.extend(item['id'] for _, item in batch)
+        threads = [threading.Thread(target=pop_all) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(range(100), sorted(received))
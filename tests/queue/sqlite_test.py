@@ -0,0 +1,131 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from deferrable.backend.sqlite import SQLiteBackendFactory
+from deferrable.pickling import PAYLOAD_STATS_KEY
+
+class TestSQLiteQueue(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'deferrable.db')
+        self.factory = SQLiteBackendFactory(self.path, visibility_timeout=0.1, poll_interval=0.01)
+        self.backend = self.factory.create_backend_for_group('test')
+        self.queue = self.backend.queue
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_wal_mode(self):
+        journal_mode, = self.queue.connection.execute('PRAGMA journal_mode').fetchone()
+        self.assertEqual('wal', journal_mode)
+
+    def test_items_are_durable(self):
+        self.queue.push({'id': 1})
+        queue = SQLiteBackendFactory(self.path).create_backend_for_group('test').queue
+        envelope, item = queue.pop()
+        self.assertEqual(1, item['id'])
+
+    def test_queues_are_separate(self):
+        self.queue.push({'id': 1})
+        self.assertEqual(0, self.backend.error_queue.stats()['available'])
+        self.assertEqual(0, self.factory.create_backend_for_group('other').queue.stats()['available'])
+
+    def test_binary_and_compressed_payloads(self):
+        queue = SQLiteBackendFactory(self.path, compression='zlib').create_backend_for_group('compressed').queue
+        item = {'args': '\x80\x00\xff' * 1000}
+        queue.push(item)
+        envelope, popped_item = queue.pop()
+        self.assertEqual(item['args'], popped_item['args'])
+        self.assertEqual('zlib', popped_item[PAYLOAD_STATS_KEY]['compression'])
+
+    def test_undecodable_items_are_moved_aside(self):
+        self.queue.push({'id': 1})
+        with self.queue._transaction() as connection:
+            connection.execute('INSERT INTO deferrable_items (queue, payload, visible_at) VALUES (?, ?, ?)',
+                               (self.queue.queue_name, buffer('not an item'), time.time()))
+        self.queue.push({'id': 2})
+        self.assertEqual([1, 2], [item['id'] for _, item in self.queue.pop_batch(10)])
+        time.sleep(0.11)
+        self.assertEqual([1, 2], [item['id'] for _, item in self.queue.pop_batch(10)])
+        undecodable, = self.queue.connection.execute('SELECT COUNT(*) FROM deferrable_items WHERE queue = ?',
+                                                     (self.queue.undecodable_queue_name,)).fetchone()
+        self.assertEqual(1, undecodable)
+
+    def test_push_with_delay(self):
+        self.queue.push({'id': 1, 'delay': 0.1})
+        self.assertEqual({'available': 0, 'in_flight': 0, 'delayed': 1}, self.queue.stats())
+        self.assertEqual((None, None), self.queue.pop())
+        time.sleep(0.11)
+        envelope, item = self.queue.pop()
+        self.assertEqual(1, item['id'])
+
+    def test_in_flight_until_complete(self):
+        self.queue.push({'id': 1})
+        envelope, item = self.queue.pop()
+        self.assertEqual({'available': 0, 'in_flight': 1, 'delayed': 0}, self.queue.stats())
+        self.assertTrue(self.queue.complete(envelope))
+        self.assertEqual({'available': 0, 'in_flight': 0, 'delayed': 0}, self.queue.stats())
+
+    def test_reclaims_expired_in_flight_items(self):
+        self.queue.push({'id': 1})
+        envelope, item = self.queue.pop()
+        time.sleep(0.11)
+        self.assertEqual(1, self.queue.stats()['available'])
+        redelivered_envelope, item = self.queue.pop()
+        self.assertEqual(1, item['id'])
+        # The stale envelope can neither touch nor complete the redelivered item
+        self.assertFalse(self.queue.touch(envelope, 10))
+        self.assertFalse(self.queue.complete(envelope))
+        self.assertTrue(self.queue.complete(redelivered_envelope))
+
+    def test_touch_extends_visibility(self):
+        self.queue.push({'id': 1})
+        envelope, item = self.queue.pop()
+        self.assertTrue(self.queue.touch(envelope, 10))
+        time.sleep(0.11)
+        self.assertEqual(1, self.queue.stats()['in_flight'])
+
+    def test_batch_operations(self):
+        result = self.queue.push_batch([{'id': i} for i in range(5)])
+        self.assertTrue(all(success for _, success in result))
+        batch = self.queue.pop_batch(3)
+        self.assertEqual([0, 1, 2], [item['id'] for _, item in batch])
+        result = self.queue.complete_batch([envelope for envelope, _ in batch])
+        self.assertTrue(all(success for _, success in result))
+        self.assertEqual({'available': 2, 'in_flight': 0, 'delayed': 0}, self.queue.stats())
+
+    def test_blocking_pop(self):
+        queue = SQLiteBackendFactory(self.path, timeout=5, poll_interval=0.01).create_backend_for_group('test').queue
+        timer = threading.Timer(0.05, self.queue.push, [{'id': 1}])
+        timer.start()
+        start = time.time()
+        envelope, item = queue.pop()
+        timer.join()
+        self.assertEqual(1, item['id'])
+        self.assertLess(time.time() - start, 1)
+
+    def test_concurrent_poppers_receive_distinct_items(self):
+        self.queue.push_batch([{'id': i} for i in range(100)])
+        received = []
+        def pop_all():
+            queue = SQLiteBackendFactory(self.path).create_backend_for_group('test').queue
+            while True:
+                batch = queue.pop_batch(7)
+                if not batch:
+                    return
+                received.extend(item['id'] for _, item in batch)
+        threads = [threading.Thread(target=pop_all) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(range(100), sorted(received))
+
+    def test_reset_connections(self):
+        connection = self.queue.connection
+        self.queue.reset_connections()
+        self.assertIsNot(connection, self.queue.connection)
@@ -1,4 +1,217 @@
+import os
+import time
 from unittest import TestCase
+import cPickle as pickle
+
+from boto.exception import SQSError
+from boto.sqs.connection import SQSConnection
+from boto.sqs.message import Message
+from boto.sqs.queue import Queue
+from boto.sqs.batchresults import ResultEntry
+from mock import patch
+from moto import mock_sqs
+
+from deferrable.backend.sqs import SQSBackendFactory
+from deferrable.queue.sqs import SEND_BATCH_MAX_BYTES, SQSPrefetcher, _send_batch_chunks
+
+# Unpatched, for tests which wrap it
+original_write_batch = Queue.write_batch
+from deferrable.pickling import PAYLOAD_STATS_KEY
 
 class TestSQSQueue(TestCase):
-    pass
+    def setUp(self):
+        self.fake_sqs = mock_sqs()
+        self.fake_sqs.start()
+        factory = SQSBackendFactory(lambda: SQSConnection(), wait_time=None)
+        self.queue = factory.create_backend_for_group('testing').queue
+
+    def tearDown(self):
+        self.fake_sqs.stop()
+
+    def test_push_pop_binary_envelope(self):
+        item = {'args': '\x80\x02\xde\xfe', 'delay': 0}
+        self.queue.push(item)
+        envelope, popped_item = self.queue.pop()
+        self.assertEqual(item, popped_item)
+
+    def test_push_writes_legacy_message_by_default(self):
+        item = {'args': pickle.dumps(('a',)).encode('string_escape'), 'attempts': 0}
+        self.queue.push(item)
+        message = self.queue.queue.read()
+        # As read by older versions
+        legacy_item = pickle.loads(message.get_body().decode('string_escape'))
+        self.assertEqual(item['args'], legacy_item['args'])
+
+    def test_pop_legacy_message(self):
+        item = {'args': pickle.dumps(('a',)).encode('string_escape'), 'attempts': 0}
+        self.queue.queue.write(Message(body=pickle.dumps(item).encode('string_escape')))
+        envelope, popped_item = self.queue.pop()
+        self.assertIsNone(popped_item.pop(PAYLOAD_STATS_KEY)['compression'])
+        self.assertEqual(item, popped_item)
+
+    def test_push_pop_compressed(self):
+        self.queue.use_envelopes = True
+        self.queue.compression = 'zlib'
+        item = {'args': 'a' * 10000}
+        self.queue.push(item)
+        self.assertEqual('zlib', item[PAYLOAD_STATS_KEY]['compression'])
+        envelope, popped_item = self.queue.pop()
+        self.assertEqual(item['args'], popped_item['args'])
+        self.assertLess(popped_item[PAYLOAD_STATS_KEY]['encoded_size'], 1000)
+        self.assertGreater(popped_item[PAYLOAD_STATS_KEY]['raw_size'], 10000)
+
+    def _pop_all(self):
+        items = []
+        while True:
+            batch = self.queue.pop_batch(10)
+            if not batch:
+                return items
+            items.extend(item for _, item in batch)
+
+    def test_push_batch_larger_than_one_request(self):
+        with patch.object(Queue, 'write_batch', autospec=True, side_effect=original_write_batch) as write_batch:
+            result = self.queue.push_batch([{'id': i} for i in range(35)])
+        self.assertEqual(range(35), [item['id'] for item, _ in result])
+        self.assertTrue(all(success for _, success in result))
+        self.assertEqual(4, write_batch.call_count)
+        self.assertEqual(range(35), sorted(item['id'] for item in self._pop_all()))
+
+    def test_push_batch_retries_failed_entries(self):
+        calls = []
+        def fail_first_entry_once(queue, entries):
+            calls.append(len(entries))
+            response = original_write_batch(queue, entries[1:] if len(calls) == 1 else entries)
+            if len(calls) == 1:
+                response.errors.append(ResultEntry(id=entries[0][0], sender_fault='false'))
+            return response
+        self.queue.push_retry_delay = 0
+        with patch.object(Queue, 'write_batch', autospec=True, side_effect=fail_first_entry_once):
+            result = self.queue.push_batch([{'id': i} for i in range(3)])
+        self.assertEqual([3, 1], calls)
+        self.assertTrue(all(success for _, success in result))
+        self.assertEqual(3, len(self._pop_all()))
+
+    def test_push_batch_does_not_retry_sender_faults(self):
+        def reject_first_entry(queue, entries):
+            response = original_write_batch(queue, entries[1:])
+            response.errors.append(ResultEntry(id=entries[0][0], sender_fault='true'))
+            return response
+        with patch.object(Queue, 'write_batch', autospec=True, side_effect=reject_first_entry) as write_batch:
+            result = self.queue.push_batch([{'id': i} for i in range(3)])
+        self.assertEqual(1, write_batch.call_count)
+        self.assertEqual([False, True, True], [success for _, success in result])
+
+    def test_push_batch_gives_up_after_retries(self):
+        self.queue.push_retry_delay = 0
+        with patch.object(Queue, 'write_batch', autospec=True, side_effect=Exception()) as write_batch:
+            result = self.queue.push_batch([{'id': i} for i in range(3)])
+        self.assertEqual(self.queue.push_retries + 1, write_batch.call_count)
+        self.assertFalse(any(success for _, success in result))
+
+    def test_push_batch_rejects_oversized_items(self):
+        result = self.queue.push_batch([{'id': 0, 'args': os.urandom(SEND_BATCH_MAX_BYTES)}, {'id': 1}])
+        self.assertEqual([False, True], [success for _, success in result])
+
+    def test_no_visibility_timeout(self):
+        factory = SQSBackendFactory(lambda: SQSConnection(), visibility_timeout=None, wait_time=None)
+        queue = factory.create_backend_for_group('testing_default_visibility').queue
+        self.assertIsNone(queue.prefetch_max_age)
+        queue.push({'id': 1})
+        envelope, item = queue.pop()
+        self.assertEqual(1, item['id'])
+
+class TestSQSPrefetch(TestCase):
+    def setUp(self):
+        self.fake_sqs = mock_sqs()
+        self.fake_sqs.start()
+        factory = SQSBackendFactory(lambda: SQSConnection(), visibility_timeout=30, wait_time=1,
+                                    prefetch=20, prefetch_threads=2)
+        self.queue = factory.create_backend_for_group('testing').queue
+
+    def tearDown(self):
+        threads = self.queue.prefetcher._threads
+        self.queue.stop_prefetch()
+        # Let receives in progress finish against the mock
+        for thread in threads:
+            thread.join()
+        self.fake_sqs.stop()
+
+    def _in_flight(self):
+        return int(self.queue.queue.get_attributes()['ApproximateNumberOfMessagesNotVisible'])
+
+    def test_pop_from_buffer(self):
+        self.queue.push_batch([{'id': i} for i in range(15)])
+        envelope, item = self.queue.pop()
+        self.assertIsNotNone(item)
+        popped = [item['id']] + [item['id'] for _, item in self.queue.pop_batch(10)]
+        while len(popped) < 15:
+            batch = self.queue.pop_batch(10)
+            self.assertTrue(batch)
+            popped.extend(item['id'] for _, item in batch)
+        self.assertEqual(range(15), sorted(popped))
+
+    def test_pop_waits_for_prefetch(self):
+        self.assertEqual((None, None), self.queue.pop())
+        self.queue.push({'id': 1})
+        envelope, item = self.queue.pop()
+        self.assertEqual(1, item['id'])
+
+    def test_stale_messages_are_released(self):
+        self.queue.prefetcher.max_age = 0
+        self.queue.push({'id': 1})
+        self.queue.pop_batch(10)
+        # Every message is stale as soon as it is buffered, so it is never handed out
+        self.assertEqual([], self.queue.prefetcher.take(10, 0))
+
+    def test_no_visibility_timeout_uses_queue_visibility_timeout(self):
+        factory = SQSBackendFactory(lambda: SQSConnection(), visibility_timeout=None, wait_time=1, prefetch=20)
+        queue = factory.create_backend_for_group('testing_default_visibility').queue
+        queue.queue.set_attribute('VisibilityTimeout', 40)
+        self.assertEqual(10, queue.prefetcher.max_age)
+
+    def test_stopping_prefetch_thread_releases_stale_messages(self):
+        prefetcher = SQSPrefetcher(self.queue, buffer_size=1, threads=1, max_age=0)
+        prefetcher._buffer.append(('message', 0))
+        # Stop while the thread waits for room in the buffer
+        prefetcher._condition.wait = lambda timeout: setattr(prefetcher, '_stopping', True)
+        with patch.object(prefetcher, '_release') as mock_release:
+            prefetcher._run()
+        mock_release.assert_called_once_with(self.queue.queue, ['message'])
+
+    def test_stop_prefetch_releases_buffer(self):
+        self.queue.push_batch([{'id': i} for i in range(5)])
+        self.queue.pop()
+        deadline = time.time() + 5
+        while len(self.queue.prefetcher._buffer) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(5, self._in_flight())
+        # Not supported by moto. Entries of a real batch succeed or fail independently.
+        def change_visibility_one_at_a_time(connection, queue, messages):
+            for message, visibility_timeout in messages:
+                try:
+                    connection.change_message_visibility(queue, message.receipt_handle, visibility_timeout)
+                except SQSError:
+                    pass
+        threads = self.queue.prefetcher._threads
+        with patch.object(SQSConnection, 'change_message_visibility_batch', autospec=True,
+                          side_effect=change_visibility_one_at_a_time):
+            self.queue.stop_prefetch()
+            # Receives in progress release what they get
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, self._in_flight())
+
+    def test_flush_clears_buffer(self):
+        self.queue.push_batch([{'id': i} for i in range(5)])
+        self.queue.pop()
+        self.queue.flush()
+        self.assertEqual(0, len(self.queue.prefetcher._buffer))
+
+class TestSendBatchChunks(TestCase):
+    def test_chunks_by_count_and_size(self):
+        entries = [(str(i), 'x' * 100, 0) for i in range(25)]
+        self.assertEqual([10, 10, 5], [len(chunk) for chunk in _send_batch_chunks(entries)])
+        entries = [(str(i), 'x' * (SEND_BATCH_MAX_BYTES / 3), 0) for i in range(7)]
+        chunks = _send_batch_chunks(entries)
+        self.assertEqual([3, 3, 1], [len(chunk) for chunk in chunks])
+        self.assertEqual(entries, [entry for chunk in chunks for entry in chunk])
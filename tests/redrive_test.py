@@ -0,0 +1,136 @@
+import os
+import time
+from unittest import TestCase
+from redis import StrictRedis
+
+from deferrable.backend.dockets import DocketsBackendFactory
+from deferrable.backend.memory import InMemoryBackendFactory
+from deferrable.pickling import serialize_method
+from deferrable.ttl import item_is_expired
+from deferrable.redrive import ErrorFilter, RateLimiter, redrive, main, _parse_time
+
+def failing_method():
+    pass
+
+def other_method():
+    pass
+
+def error_item(index, error_type='TimeoutError', method=failing_method, ts=None, group='testing'):
+    item = {'id': index, 'group': group, 'attempts': 4, 'max_attempts': 5,
+            'error': {'id': 'error_{}'.format(index), 'error_type': error_type, 'ts': ts or time.time()}}
+    item.update(serialize_method(method))
+    return item
+
+# Module scope so that the command line can import it
+memory_backend_factory = InMemoryBackendFactory()
+memory_backend = memory_backend_factory.create_backend_for_group('testing')
+memory_backend_factory.create_backend_for_group = lambda group: memory_backend
+
+class TestErrorFilter(TestCase):
+    def test_matches_everything_by_default(self):
+        self.assertTrue(ErrorFilter().matches(error_item(1)))
+
+    def test_criteria(self):
+        item = error_item(1, ts=1000)
+        self.assertTrue(ErrorFilter(error_types=['KeyError', 'TimeoutError']).matches(item))
+        self.assertFalse(ErrorFilter(error_types=['KeyError']).matches(item))
+        self.assertTrue(ErrorFilter(method_names=[__name__ + '.failing_method']).matches(item))
+        self.assertFalse(ErrorFilter(method_names=[__name__ + '.other_method']).matches(item))
+        self.assertTrue(ErrorFilter(groups=['testing']).matches(item))
+        self.assertFalse(ErrorFilter(groups=['other']).matches(item))
+        self.assertTrue(ErrorFilter(since=1000, until=1001).matches(item))
+        self.assertFalse(ErrorFilter(since=1001).matches(item))
+        self.assertFalse(ErrorFilter(until=1000).matches(item))
+
+class RedriveTestMixin(object):
+    def test_redrive_everything(self):
+        self.backend.error_queue.push_batch([error_item(i) for i in range(250)])
+        stats = redrive(self.backend, batch_size=50)
+        self.assertEqual({'scanned': 250, 'matched': 250, 'redriven': 250, 'failed': 0}, stats)
+        self.assertEqual(0, self.backend.error_queue.stats()['available'])
+        items = self.backend.queue.pop_batch(250)
+        self.assertEqual(range(250), sorted(item['id'] for _, item in items))
+        for _, item in items:
+            self.assertEqual(0, item['attempts'])
+            self.assertNotIn('error', item)
+
+    def test_redrive_filtered(self):
+        self.backend.error_queue.push_batch([error_item(i, error_type='TimeoutError' if i % 2 else 'KeyError')
+                                             for i in range(20)])
+        stats = redrive(self.backend, ErrorFilter(error_types=['TimeoutError']), batch_size=7, concurrency=2)
+        self.assertEqual({'scanned': 20, 'matched': 10, 'redriven': 10, 'failed': 0}, stats)
+        self.assertEqual(10, self.backend.error_queue.stats()['available'])
+        remaining = self.backend.error_queue.pop_batch(20)
+        self.assertEqual(set(range(0, 20, 2)), set(item['id'] for _, item in remaining))
+
+    def test_dry_run(self):
+        self.backend.error_queue.push_batch([error_item(i) for i in range(10)])
+        stats = redrive(self.backend, ErrorFilter(method_names=[__name__ + '.failing_method']), dry_run=True)
+        self.assertEqual({'scanned': 10, 'matched': 10, 'redriven': 0, 'failed': 0}, stats)
+        self.assertEqual(10, self.backend.error_queue.stats()['available'])
+        self.assertEqual(0, self.backend.queue.stats()['available'])
+
+    def test_limit(self):
+        self.backend.error_queue.push_batch([error_item(i) for i in range(10)])
+        stats = redrive(self.backend, batch_size=3, limit=4)
+        self.assertEqual(4, stats['matched'])
+        self.assertEqual(4, stats['redriven'])
+        self.assertEqual(6, self.backend.error_queue.stats()['available'])
+
+    def test_redriven_items_get_their_full_ttl_again(self):
+        item = error_item(1)
+        item.update({'ttl_seconds': 60, 'item_queued_timestamp': time.time() - 120})
+        self.backend.error_queue.push(item)
+        redrive(self.backend)
+        _, redriven = self.backend.queue.pop()
+        self.assertFalse(item_is_expired(redriven))
+
+class TestRedriveInMemory(RedriveTestMixin, TestCase):
+    def setUp(self):
+        self.backend = memory_backend
+        self.backend.queue.flush()
+        self.backend.error_queue.flush()
+
+    def test_command_line(self):
+        self.backend.error_queue.push_batch([error_item(i, error_type='TimeoutError' if i % 2 else 'KeyError')
+                                             for i in range(10)])
+        main([__name__ + ':memory_backend_factory', '--group', 'testing', '--error-type', 'KeyError',
+              '--since', '2000-01-01T00:00'])
+        self.assertEqual(5, self.backend.queue.stats()['available'])
+        self.assertEqual(5, self.backend.error_queue.stats()['available'])
+
+    def test_scan_longer_than_visibility_timeout(self):
+        backend = InMemoryBackendFactory(visibility_timeout=0.05).create_backend_for_group('testing')
+        backend.error_queue.push_batch([error_item(i, error_type='TimeoutError' if i % 2 else 'KeyError')
+                                        for i in range(20)])
+        # Unmatched items become visible again long before the rate limited scan ends
+        stats = redrive(backend, ErrorFilter(error_types=['TimeoutError']), batch_size=2, concurrency=1,
+                        items_per_second=50)
+        self.assertEqual({'scanned': 20, 'matched': 10, 'redriven': 10, 'failed': 0}, stats)
+        self.assertEqual(10, backend.queue.stats()['available'])
+        self.assertEqual(set(range(0, 20, 2)), set(item['id'] for _, item in backend.error_queue.pop_batch(20)))
+
+class TestRedriveDockets(RedriveTestMixin, TestCase):
+    def setUp(self):
+        redis_client = StrictRedis(host=os.getenv("DEFERRABLE_TEST_REDIS_HOST","redis"), db=15)
+        self.backend = DocketsBackendFactory(redis_client, wait_time=0).create_backend_for_group('redrive')
+        self.backend.queue.flush()
+        self.backend.error_queue.flush()
+        self.addCleanup(self.backend.queue.flush)
+        self.addCleanup(self.backend.error_queue.flush)
+
+class TestRateLimiter(TestCase):
+    def test_spaces_out_items(self):
+        limiter = RateLimiter(100)
+        start = time.time()
+        for _ in range(3):
+            limiter.acquire(5)
+        # The first acquire is immediate, the next two wait for 5 items each
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+class TestParseTime(TestCase):
+    def test_formats(self):
+        self.assertEqual(1000.5, _parse_time('1000.5'))
+        self.assertEqual(86400, _parse_time('1970-01-02'))
+        self.assertEqual(86400 + 3600 + 60, _parse_time('1970-01-02T01:01'))
+        self.assertEqual(86400 + 3600 + 61, _parse_time('1970-01-02T01:01:01'))
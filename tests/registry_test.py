@@ -0,0 +1,45 @@
+from unittest import TestCase
+
+from deferrable.registry import method_id, register_method, registered_method_ids, get_method
+from deferrable.pickling import serialize_method, build_later_item_with_codec, unpickle_method_call, dumps
+
+def test_method(*args, **kwargs):
+    pass
+
+def unregistered_method():
+    pass
+
+class TestRegistry(TestCase):
+    def test_method_id(self):
+        self.assertEqual(test_method.__module__ + '.test_method', method_id(test_method))
+
+    def test_register_and_get(self):
+        key = register_method(test_method)
+        self.assertIn(key, registered_method_ids())
+        self.assertIs(test_method, get_method(key))
+
+    def test_get_unregistered_method_from_module(self):
+        self.assertIs(unregistered_method, get_method(__name__ + '.unregistered_method'))
+
+    def test_get_unknown_method_raises(self):
+        with self.assertRaises(ValueError):
+            get_method(__name__ + '.no_such_method')
+        with self.assertRaises(ValueError):
+            get_method('no_such_module.no_such_method')
+
+class TestSerializeMethod(TestCase):
+    def test_pickled_method(self):
+        self.assertEqual({'method': dumps(test_method)}, serialize_method(test_method))
+
+    def test_method_id(self):
+        self.assertEqual({'method_id': __name__ + '.test_method'},
+                         serialize_method(test_method, use_method_id=True))
+
+    def test_round_trip_with_method_id(self):
+        item = build_later_item_with_codec('pickle', test_method, ('a',), {'b': 'c'},
+                                           serialized_method=serialize_method(test_method, use_method_id=True))
+        self.assertNotIn('method', item)
+        method, args, kwargs = unpickle_method_call(item)
+        self.assertIs(test_method, method)
+        self.assertEqual(('a',), args)
+        self.assertEqual({'b': 'c'}, kwargs)
@@ -0,0 +1,74 @@
+import signal
+import time
+
+from unittest import TestCase
+from mock import Mock, patch
+
+from deferrable import Deferrable
+from deferrable.backend.memory import InMemoryBackendFactory
+from deferrable.worker import Worker, DEFAULT_TOUCH_SECONDS
+
+factory = InMemoryBackendFactory(timeout=0.05)
+backend = factory.create_backend_for_group('worker_testing')
+instance = Deferrable(backend)
+
+my_mock = Mock()
+
+@instance.deferrable
+def simple_deferrable(*args, **kwargs):
+    my_mock(*args, **kwargs)
+
+@instance.deferrable
+def slow_deferrable(seconds):
+    time.sleep(seconds)
+    my_mock(seconds)
+
+class TestWorker(TestCase):
+    def tearDown(self):
+        backend.queue.flush()
+        backend.error_queue.flush()
+        my_mock.reset_mock()
+
+    def _wait_for_calls(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(my_mock.mock_calls) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_touch_seconds_default(self):
+        self.assertEqual(DEFAULT_TOUCH_SECONDS, Worker(instance).touch_seconds)
+
+    def test_touch_seconds_from_queue_visibility_timeout(self):
+        with patch.object(backend.queue, 'visibility_timeout', 60, create=True):
+            self.assertEqual(60, Worker(instance).touch_seconds)
+
+    def test_processes_items_concurrently(self):
+        for index in range(4):
+            slow_deferrable.later(0.2)
+        worker = Worker(instance, concurrency=4)
+        start = time.time()
+        worker.start()
+        self._wait_for_calls(4)
+        worker.stop()
+        worker.join()
+        self.assertEqual(4, len(my_mock.mock_calls))
+        self.assertLess(time.time() - start, 0.6)
+
+    def test_touches_long_running_envelopes(self):
+        slow_deferrable.later(0.3)
+        worker = Worker(instance, heartbeat_interval=0.05, touch_seconds=0.1)
+        with patch.object(backend.queue, 'touch') as touch:
+            worker.start()
+            self._wait_for_calls(1)
+            worker.stop()
+            worker.join()
+        self.assertTrue(touch.called)
+        self.assertEqual(0, worker.in_flight_count())
+
+    def test_signal_drains_in_flight_items(self):
+        slow_deferrable.later(0.2)
+        worker = Worker(instance)
+        worker.start()
+        time.sleep(0.1)
+        worker._handle_signal(signal.SIGTERM, None)
+        worker.join()
+        my_mock.assert_called_once_with(0.2)